@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""Time it takes to run a Git hook that has nothing to do.
+
+Runs ``gitmesh pre-receive`` with an empty standard input, the way Git runs
+it for each push, without and with the plug-in cache (see
+``gitmesh.plugins``).  Run with::
+
+    python benchmarks/hook_startup.py
+
+The bare interpreter's start-up time is given as a baseline.
+"""
+
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from gitmesh.plugins import CACHE_VAR
+
+
+RUNS = 20
+"""Number of times each command is run."""
+
+
+def run(command, env):
+    ref = timeit.default_timer()
+    subprocess.run(
+        command, env=env, input=b'', check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return timeit.default_timer() - ref
+
+
+def measure(command, env):
+    durations = [run(command, env) for _ in range(RUNS)]
+    return min(durations), statistics.median(durations)
+
+
+def main():
+    hook = [sys.executable, '-m', 'gitmesh', 'pre-receive']
+    with tempfile.TemporaryDirectory() as folder:
+        cache = dict(os.environ)
+        cache[CACHE_VAR] = os.path.join(folder, 'plugins.json')
+        no_cache = dict(os.environ)
+        no_cache[CACHE_VAR] = ''
+        print('%-20s %10s %10s' % ('', 'min', 'median'))
+        for label, command, env in [
+            ('python', [sys.executable, '-c', 'pass'], no_cache),
+            ('hook (no cache)', hook, no_cache),
+            ('hook (cached)', hook, cache),
+        ]:
+            best, median = measure(command, env)
+            print('%-20s %9.1fms %9.1fms' % (
+                label, best * 1000.0, median * 1000.0,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Time and memory used to format repository listings of increasing size.
+
+Compares the streaming JSON encoder used by ``GET /repositories`` with
+building the whole document and serializing it in one go.  Names come from
+a real storage folder, through the repository index, the way the server
+gets them.  Run with::
+
+    python benchmarks/json_listing.py
+
+Creating the repository folders takes a while (they're empty, but there
+are a lot of them), so it isn't part of the measurements.  Neither is
+loading the index, which the server does once (and then keeps up to date
+with inotify).  Peak memory (as seen by ``tracemalloc``) excludes the
+index itself, which the server keeps in memory regardless.
+"""
+
+
+import asyncio
+import json
+import os
+import tempfile
+import timeit
+import tracemalloc
+
+from gitmesh.server import iter_json, RepositoryURLs
+from gitmesh.storage import Storage
+
+
+SIZES = [10, 1000, 10000, 100000, 300000]
+"""Number of repositories in each listing."""
+
+LEGACY_MAX_SIZE = 100000
+"""Largest listing formatted the old way (it needs gigabytes beyond this)."""
+
+
+def populate(path, start, stop):
+    """Create (empty) repository folders ``start`` to ``stop``."""
+    for i in range(start, stop):
+        os.mkdir(os.path.join(path, 'repository-%07d.git' % i))
+
+
+def streaming(storage, urls):
+    size = 0
+    for chunk in iter_json('repositories', (
+        urls(name) for name in storage.iter_repositories()
+    )):
+        size += len(chunk)
+    return size
+
+
+def legacy(storage, urls):
+    return len(json.dumps({
+        'repositories': [urls(name) for name in storage.iter_repositories()],
+    }).encode('utf-8'))
+
+
+def measure(function, *args):
+    """Time a run, then measure peak memory in another (tracing is slow)."""
+    ref = timeit.default_timer()
+    size = function(*args)
+    duration = timeit.default_timer() - ref
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size, peak, duration
+
+
+def main():
+    urls = RepositoryURLs(
+        'http://localhost:8080/repositories/\0.git/',
+        'http://localhost:8080/repositories/\0',
+        'http://localhost:8080/repositories/\0',
+    )
+    print('%10s %14s %14s %10s %14s %10s' % (
+        'repos', 'bytes', 'stream peak', 'time', 'legacy peak', 'time',
+    ))
+    loop = asyncio.new_event_loop()
+    with tempfile.TemporaryDirectory() as folder:
+        count = 0
+        for n in SIZES:
+            populate(folder, count, n)
+            count = n
+            storage = Storage(folder)
+            try:
+                # Load the repository index and follow changes, like the
+                # server does.
+                storage.watch(loop=loop)
+                size, peak, duration = measure(streaming, storage, urls)
+                row = '%10d %14d %14d %9.2fs' % (n, size, peak, duration)
+                if n <= LEGACY_MAX_SIZE:
+                    _, peak, duration = measure(legacy, storage, urls)
+                    row += ' %14d %9.2fs' % (peak, duration)
+                print(row, flush=True)
+            finally:
+                storage.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 
-import pkg_resources
+import os.path
 
-version = pkg_resources.resource_string('gitmesh', 'version.txt')
-version = version.decode('utf-8').strip()
+# NOTE: Git hooks import this package (see ``gitmesh.hookclient``), so keep
+#       it light: ``pkg_resources`` alone takes longer to import than the
+#       hook takes to run.
+with open(os.path.join(os.path.dirname(__file__), 'version.txt')) as stream:
+    version = stream.read().strip()
 """Package version (as a dotted string)."""
@@ -3,29 +3,30 @@
 
 import asyncio
 import click
-import fluent.sender
-import importlib
 import os
-import pkg_resources
 import signal
 import structlog
 import structlog.processors
 import sys
+import traceback
 
 from datetime import datetime, timezone
 from inspect import iscoroutine
 from urllib.parse import urlsplit
 
-from gitmesh.server import serve_until
-from gitmesh.storage import Storage
-
-
-def find_entry_points(group):
-    for entry_point in pkg_resources.iter_entry_points(group):
-        module = importlib.import_module('.'.join(
-            [entry_point.module_name] + list(entry_point.attrs[:-1])
-        ))
-        yield entry_point.name, getattr(module, entry_point.attrs[-1])
+# NOTE: Git hooks run this module, so modules only needed by some commands
+#       (e.g. aiohttp for ``serve``) are imported by these commands.
+from gitmesh.imports import IMPORT_PROTOCOLS
+from gitmesh.plugins import find_entry_points, is_batched, run_plugins
+from gitmesh.storage import LAYOUTS, Storage, touch_ref_state
+from gitmesh.verdicts import (
+    discard_verdicts,
+    prune_verdicts,
+    PUSH_VAR,
+    verdicts_path,
+    write_verdicts,
+)
+from gitmesh.workqueue import enqueue, QUEUE_VAR, REPLAY_VAR, REPOSITORY_VAR
 
 
 class FluentLoggerFactory:
@@ -50,6 +51,7 @@ class FluentLoggerFactory:
         return FluentLoggerFactory(parts.path[1:], host, port)
 
     def __init__(self, app, host, port):
+        import fluent.sender
         self._app = app
         self._host = host
         self._port = port
@@ -156,8 +158,15 @@ def configure_logging(log_format, utc, endpoint):
 @click.option('--logging-endpoint',
               default='file:///dev/stdout',
               envvar='GITMESH_LOGGING_ENDPOINT')
+@click.option('--plugin-timeout', default=0.0,
+              envvar='GITMESH_PLUGIN_TIMEOUT',
+              help='Seconds each hook plug-in may run (0: no limit).')
+@click.option('--hook-timeout', default=0.0,
+              envvar='GITMESH_HOOK_TIMEOUT',
+              help='Seconds all plug-ins of a hook may run (0: no limit).')
 @click.pass_context
-def cli(ctx, log_format, utc_timestamps, logging_endpoint):
+def cli(ctx, log_format, utc_timestamps, logging_endpoint,
+        plugin_timeout, hook_timeout):
 
     # Initialize logger.
     configure_logging(
@@ -178,6 +187,8 @@ def cli(ctx, log_format, utc_timestamps, logging_endpoint):
 
     # Inject context.
     ctx.obj['log'] = log
+    ctx.obj['plugin_timeout'] = plugin_timeout or None
+    ctx.obj['hook_timeout'] = hook_timeout or None
 
 
 def _await(loop, r):
@@ -187,6 +198,54 @@ def _await(loop, r):
     return r
 
 
+def _run_plugins(ctx, hook, plugins, verbose=False, **kwds):
+    """Run plug-ins for a Git hook (see ``gitmesh.plugins.run_plugins()``)."""
+    loop = ctx.obj['loop']
+    return _await(loop, run_plugins(
+        hook, plugins, kwds, ctx.obj['log'],
+        timeout=ctx.obj['plugin_timeout'],
+        deadline=ctx.obj['hook_timeout'],
+        verbose=verbose,
+        loop=loop,
+    ))
+
+
+def _check_updates(ctx, plugins, updates):
+    """Run update plug-ins for each ref, return the refs they rejected.
+
+    Like the update hook, a ref is rejected when a plug-in fails for it
+    (including by exiting, e.g. with ``sys.exit(1)``), and other plug-ins
+    don't run for that ref.  Batched plug-ins (see
+    ``gitmesh.plugins.batched()``) run first, once for all refs.
+    """
+    rejected = set()
+    batch = [(name, plugin) for name, plugin in plugins if is_batched(plugin)]
+    if batch:
+        try:
+            for refs in _run_plugins(ctx, 'update', batch, verbose=True,
+                                     updates={
+                                         ref: (old, new)
+                                         for ref, old, new in updates
+                                     }):
+                rejected.update(refs or ())
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            rejected.update(ref for ref, _, _ in updates)
+    plugins = [
+        (name, plugin) for name, plugin in plugins if not is_batched(plugin)
+    ]
+    for ref, old, new in updates:
+        if ref in rejected:
+            continue
+        try:
+            _run_plugins(ctx, 'update', plugins, verbose=True,
+                         ref=ref, old=old, new=new)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            rejected.add(ref)
+    return rejected
+
+
 @cli.command(name='pre-receive')
 @click.pass_context
 def pre_receive(ctx):
@@ -202,15 +261,32 @@ def pre_receive(ctx):
     loop = ctx.obj['loop']
     try:
         pre_receive_hooks = list(find_entry_points('gitmesh.pre_receive'))
-        updates = [
-            line.strip().split(' ', 2) for line in sys.stdin
+        lines = [
+            line.strip().split(' ', 2) for line in sys.stdin if line.strip()
         ]
         updates = {
-            update[2]: (update[0], update[1]) for update in updates
+            update[2]: (update[0], update[1]) for update in lines
         }
-        for _, pre_receive_hook in pre_receive_hooks:
-            print('Running hook %r.' % _)
-            _await(loop, pre_receive_hook(updates=updates))
+        _run_plugins(ctx, 'pre-receive', pre_receive_hooks, verbose=True,
+                     updates=updates)
+
+        # Run update plug-ins for all refs now, rather than in a new process
+        # for each ref.  Only the update hook can reject a single ref, so it
+        # still runs, but only looks up verdicts left here (see bin/update).
+        git_dir = os.environ.get('GIT_DIR', '.')
+        path = verdicts_path(git_dir, os.environ.get(PUSH_VAR))
+        if path is not None:
+            prune_verdicts(git_dir)
+            changes = [(ref, old, new) for old, new, ref in lines]
+            rejected = _check_updates(
+                ctx, list(find_entry_points('gitmesh.update')), changes,
+            )
+            write_verdicts(path, [
+                (ref, old, new, ref not in rejected)
+                for ref, old, new in changes
+            ])
+            log.info('git.hooks.update.batch', refs=len(changes),
+                     rejected=sorted(rejected))
     finally:
         loop.close()
 
@@ -229,9 +305,8 @@ def update(ctx, ref, old, new):
     loop = ctx.obj['loop']
     try:
         update_hooks = list(find_entry_points('gitmesh.update'))
-        for _, update_hook in update_hooks:
-            print('Running hook %r.' % _)
-            _await(loop, update_hook(ref=ref, old=old, new=new))
+        _run_plugins(ctx, 'update', update_hooks, verbose=True,
+                     ref=ref, old=old, new=new)
     finally:
         loop.close()
 
@@ -244,6 +319,17 @@ def post_receive(ctx):
     log = ctx.obj['log']
     log.info('git.hooks.post-receive')
 
+    # Invalidate ref advertisements the server may have cached (the push
+    # already did, if the work queue is running this again).
+    if 'GIT_DIR' in os.environ and REPLAY_VAR not in os.environ:
+        touch_ref_state(os.environ['GIT_DIR'])
+
+    # Verdicts left by the pre-receive hook are no longer needed.
+    path = verdicts_path(os.environ.get('GIT_DIR', '.'),
+                         os.environ.get(PUSH_VAR))
+    if path is not None:
+        discard_verdicts(path)
+
     loop = ctx.obj['loop']
     try:
         post_receive_hooks = list(find_entry_points('gitmesh.post_receive'))
@@ -253,9 +339,16 @@ def post_receive(ctx):
         updates = {
             update[2]: (update[0], update[1]) for update in updates
         }
-        for hook_name, post_receive_hook in post_receive_hooks:
-            log.info(event='post_update', hook=hook_name)
-            _await(loop, post_receive_hook(updates=updates))
+        # Let `gitmesh serve` run plug-ins once the client is gone.
+        queue = os.environ.get(QUEUE_VAR)
+        repository = os.environ.get(REPOSITORY_VAR)
+        if post_receive_hooks and queue and repository:
+            job = enqueue(queue, repository, updates,
+                          os.environ.get('GITMESH_REQUEST_ID'))
+            log.info('git.hooks.post-receive.queue', job=job)
+            return
+        _run_plugins(ctx, 'post-receive', post_receive_hooks,
+                     updates=updates)
     finally:
         loop.close()
 
@@ -272,20 +365,89 @@ def post_update(ctx, refs):
     loop = ctx.obj['loop']
     try:
         post_update_hooks = list(find_entry_points('gitmesh.post_update'))
-        for hook_name, post_update_hook in post_update_hooks:
-            log.info(event='git.hooks.post_update', hook=hook_name)
-            _await(loop, post_update_hook(refs=list(refs)))
+        _run_plugins(ctx, 'post-update', post_update_hooks,
+                     refs=list(refs))
     finally:
         loop.close()
 
 
+@cli.command(name='migrate')
+@click.option('--layout', type=click.Choice(LAYOUTS), required=True,
+              help='On-disk layout to move all repositories to.')
+@click.pass_context
+def migrate(ctx, layout):
+    """Change the storage layout (safe while the server runs)."""
+
+    log = ctx.obj['log']
+    log.info('storage.migrate.start', layout=layout)
+
+    count = 0
+    for name in Storage('.').migrate(layout):
+        log.info('storage.migrate.move', name=name, layout=layout)
+        count += 1
+
+    log.info('storage.migrate.done', layout=layout, count=count)
+
+
 @cli.command(name='serve')
 @click.option('--host', default='0.0.0.0')
 @click.option('--port', default=8080)
+@click.option('--pack-cache-size', default=1024**3,
+              help='Disk space for cached fetch responses (0 to disable).')
+@click.option('--max-pushes', default=0,
+              help='Concurrent pushes (defaults to the number of CPUs).')
+@click.option('--max-fetches', default=0,
+              help='Concurrent fetches (defaults to the number of CPUs).')
+@click.option('--max-advertisements', default=0,
+              help='Concurrent ref advertisements (defaults to 2x CPUs).')
+@click.option('--queue-size', default=64,
+              help='Requests waiting for each of the above.')
+@click.option('--maintenance-threshold', default=10,
+              help='Pushes to a repository before it is repacked.')
+@click.option('--maintenance-concurrency', default=1,
+              help='Repositories maintained concurrently.')
+@click.option('--quiet-hours', default=None,
+              help='Only start maintenance between these hours (e.g. 1-5).')
+@click.option('--bundle-delay', default=30.0,
+              help='Seconds without pushes before generating a bundle.')
+@click.option('--bundles-kept', default=2,
+              help='Clone bundles kept for each repository.')
+@click.option('--trash-rate', default=64 * 1024**2,
+              help='Bytes per second deleted from the trash (0: no limit).')
+@click.option('--io-threads', default=4,
+              help='Threads for blocking file system calls.')
+@click.option('--batch-concurrency', default=16,
+              help='Operations run concurrently for each batch request.')
+@click.option('--import-concurrency', default=2,
+              help='Repositories imported concurrently.')
+@click.option('--import-protocols', default=IMPORT_PROTOCOLS,
+              help='Transports allowed for imports (e.g. https:ssh).')
+@click.option('--hook-socket', default='.gitmesh-hooks.sock',
+              help='Unix socket for Git hooks (empty to run hooks slowly).')
+@click.option('--hook-workers', default=0,
+              help='Processes running Git hooks (defaults to CPUs).')
+@click.option('--queue-concurrency', default=4,
+              help='Repositories running post-receive plug-ins at once.')
+@click.option('--queue-attempts', default=5,
+              help='Attempts at running post-receive plug-ins for a push.')
 @click.pass_context
-def serve(ctx, host, port):
+def serve(ctx, host, port, pack_cache_size,
+          max_pushes, max_fetches, max_advertisements, queue_size,
+          maintenance_threshold, maintenance_concurrency, quiet_hours,
+          bundle_delay, bundles_kept, trash_rate, io_threads,
+          batch_concurrency, import_concurrency, import_protocols,
+          hook_socket, hook_workers, queue_concurrency, queue_attempts):
     """Run the server until SIGINT/CTRL-C is received."""
 
+    from gitmesh.bundles import Bundles
+    from gitmesh.hookd import HookDaemon
+    from gitmesh.imports import Imports
+    from gitmesh.maintenance import Maintenance, parse_quiet_hours
+    from gitmesh.server import Scheduler, serve_until
+    from gitmesh.storage import FileSystemExecutor
+    from gitmesh.trash import Reaper
+    from gitmesh.workqueue import WorkQueue
+
     log = ctx.obj['log']
     log.info('serve', host=host, port=port)
 
@@ -298,11 +460,79 @@ def serve(ctx, host, port):
     else:
         loop.add_signal_handler(signal.SIGINT, cancel.set_result, None)
 
+    # Admission control for Git processes.
+    cpus = os.cpu_count() or 1
+    scheduler = Scheduler(limits={
+        'push': (max_pushes or cpus, queue_size),
+        'fetch': (max_fetches or cpus, queue_size),
+        'advertise': (max_advertisements or 2 * cpus, queue_size),
+    })
+
+    # Background repository maintenance.
+    storage = Storage('.', executor=FileSystemExecutor(io_threads))
+    try:
+        maintenance = Maintenance(
+            storage,
+            threshold=maintenance_threshold,
+            concurrency=maintenance_concurrency,
+            quiet_hours=quiet_hours and parse_quiet_hours(quiet_hours),
+            log=log,
+        )
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--quiet-hours')
+
+    # Clone bundles, generated after pushes.
+    bundles = Bundles(
+        storage,
+        keep=bundles_kept,
+        delay=bundle_delay,
+        log=log,
+    )
+
+    # Deleted repositories, removed in the background.
+    reaper = Reaper(storage, rate=trash_rate or None, log=log)
+
+    # Repositories imported from elsewhere.
+    imports = Imports(
+        storage,
+        concurrency=import_concurrency,
+        protocols=import_protocols,
+        reaper=reaper,
+        log=log,
+    )
+
+    # Resident workers for Git hooks.
+    hooks = None
+    if hook_socket:
+        hooks = HookDaemon(
+            os.path.abspath(hook_socket),
+            workers=hook_workers or cpus,
+            log=log,
+        )
+
+    # Post-receive plug-ins, run after the client is gone.
+    queue = WorkQueue(
+        storage,
+        concurrency=queue_concurrency,
+        max_attempts=queue_attempts,
+        runner=hooks and hooks.run,
+        log=log,
+    )
+
     # Serve "forever".
     loop.run_until_complete(serve_until(
         cancel,
-        storage=Storage('.'),
+        storage=storage,
         host=host, port=port, log=log, loop=loop,
+        pack_cache_size=pack_cache_size,
+        scheduler=scheduler,
+        maintenance=maintenance,
+        bundles=bundles,
+        reaper=reaper,
+        batch_concurrency=batch_concurrency,
+        imports=imports,
+        hooks=hooks,
+        queue=queue,
     ))
 
 
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import functools
+import os
+import structlog
+import timeit
+import uuid
+
+from datetime import datetime, timezone
+from subprocess import CalledProcessError
+
+from gitmesh.storage import UnknownRepository
+
+
+BUNDLES_DIR = 'gitmesh-bundles'
+"""Folder, inside each repository, where we keep its clone bundles."""
+
+
+class Bundles(object):
+    """Pre-generated clone bundles.
+
+    After a push, a ``git bundle`` snapshot of the repository is generated
+    in the background once no other push arrived for ``delay`` seconds.
+    The latest ``keep`` bundles are kept so that clients still downloading
+    an older one can resume.  At most ``concurrency`` bundles are generated
+    at once.
+    """
+
+    def __init__(self, storage, keep=2, delay=30.0, concurrency=1,
+                 log=None, clock=None):
+        self._storage = storage
+        self._keep = keep
+        self._delay = delay
+        self._log = log or structlog.get_logger()
+        self._clock = clock or timeit.default_timer
+        self._budget = asyncio.Semaphore(concurrency)
+        self._timers = {}
+        self._running = {}
+        self._pending = set()
+
+    def _path(self, name):
+        return os.path.join(self._storage.open_repo(name).path, BUNDLES_DIR)
+
+    async def list(self, name):
+        """List bundles for repository ``name``, newest first.
+
+        Each bundle is a dictionary with its file ``name``, ``size`` (in
+        bytes) and ``created`` timestamp (ISO 8601).
+        """
+        return await self._storage.executor.call('bundles', self._list, name)
+
+    def _list(self, name):
+        path = self._path(name)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return []
+        bundles = []
+        for bundle in names:
+            if not bundle.endswith('.bundle'):
+                continue
+            st = os.stat(os.path.join(path, bundle))
+            bundles.append((st.st_mtime_ns, bundle, st.st_size))
+        bundles.sort(reverse=True)
+        return [
+            {
+                'name': bundle,
+                'size': size,
+                'created': datetime.fromtimestamp(
+                    mtime / 1e9, timezone.utc,
+                ).isoformat(),
+            }
+            for mtime, bundle, size in bundles
+        ]
+
+    async def latest(self, name):
+        """File name of the newest bundle for ``name`` (``None`` if none)."""
+        bundles = await self.list(name)
+        return bundles[0]['name'] if bundles else None
+
+    def notify_push(self, name):
+        """Generate a bundle for ``name`` once pushes settle down."""
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        loop = asyncio.get_event_loop()
+        self._timers[name] = loop.call_later(self._delay, self.schedule, name)
+
+    def forget(self, name):
+        """Stop generating bundles for ``name`` (e.g. once deleted)."""
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        self._pending.discard(name)
+
+    def schedule(self, name):
+        """Start generating a bundle for ``name`` in the background."""
+        self._timers.pop(name, None)
+        if name in self._running:
+            # Pushes arrived while we were busy, go again when done.
+            self._pending.add(name)
+            return False
+        task = asyncio.ensure_future(self.generate(name))
+        self._running[name] = task
+
+        def done(task):
+            del self._running[name]
+            if name in self._pending:
+                self._pending.discard(name)
+                self.schedule(name)
+
+        task.add_done_callback(done)
+        return True
+
+    async def generate(self, name):
+        """Generate a bundle for ``name`` (waits for the concurrency budget).
+
+        Returns the bundle's file name, or ``None`` if the repository has
+        nothing to bundle (or is gone).
+        """
+        async with self._budget:
+            return await self._generate(name)
+
+    async def _generate(self, name):
+        try:
+            repo = await self._storage.find_repo(name)
+        except UnknownRepository:
+            return None
+        path = os.path.join(repo.path, BUNDLES_DIR)
+        await self._storage.executor.call(
+            'bundles', functools.partial(os.makedirs, path, exist_ok=True),
+        )
+        bundle = '%s.bundle' % uuid.uuid4().hex
+        temp = os.path.join(path, bundle + '.tmp')
+        self._log.info('bundle.start', name=name, bundle=bundle)
+        ref = self._clock()
+        try:
+            await repo.run(['git', 'bundle', 'create', temp, '--all'])
+            os.replace(temp, os.path.join(path, bundle))
+        except CalledProcessError as error:
+            # Most likely an empty repository.
+            self._log.info('bundle.fail', name=name, bundle=bundle,
+                           duration=self._clock() - ref, errors=error.output)
+            return None
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+        self._log.info('bundle.done', name=name, bundle=bundle,
+                       duration=self._clock() - ref)
+        await self._storage.executor.call('bundles', self.prune, name)
+        self._storage.bump()
+        return bundle
+
+    def prune(self, name):
+        """Delete all but the latest bundles for ``name``."""
+        path = self._path(name)
+        for bundle in self._list(name)[self._keep:]:
+            os.unlink(os.path.join(path, bundle['name']))
+
+    async def close(self):
+        """Cancel pending and running bundle generation."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
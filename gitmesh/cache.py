@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import hashlib
+import os
+import uuid
+
+from collections import OrderedDict
+
+from gitmesh.storage import FileSystemExecutor
+
+
+class RefAdvertisementCache(object):
+    """In-memory cache of ``info/refs`` ref advertisements.
+
+    Entries are keyed by repository name, service and Git protocol (the
+    ``Git-Protocol`` header, if any), and are only valid for the ref state
+    fingerprint they were computed for (see
+    ``gitmesh.storage.ref_state``).  At most ``capacity`` repositories are
+    kept, least recently used ones are evicted first.
+    """
+
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def get(self, name, service, fingerprint, protocol=None):
+        """Return the cached advertisement, or ``None`` on a cache miss."""
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != fingerprint:
+            self.misses += 1
+            return None
+        data = entry[1].get((service, protocol))
+        if data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(name)
+        self.hits += 1
+        return data
+
+    def put(self, name, service, fingerprint, data, protocol=None):
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != fingerprint:
+            entry = (fingerprint, {})
+        entry[1][(service, protocol)] = data
+        self._entries[name] = entry
+        self._entries.move_to_end(name)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, name):
+        """Drop all advertisements for repository ``name``."""
+        if self._entries.pop(name, None) is not None:
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+class _Flight(object):
+    """Response that is being produced (and written to disk) right now.
+
+    The producer and the requests following it share the file descriptor,
+    so readers don't care whether the file has been renamed into place (or
+    deleted) yet.  It is closed once all of them are done with it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self):
+        await self._changed.wait()
+
+    def close(self):
+        if self.done and self.readers == 0 and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _open_entry(path):
+    stream = open(path, 'rb')
+    os.utime(path)
+    return stream
+
+
+def _create(path):
+    return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
+                   0o644)
+
+
+def _write(fd, chunk):
+    view = memoryview(chunk)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _unlink(paths):
+    for path in paths:
+        os.unlink(path)
+
+
+class PackCache(object):
+    """Disk-backed cache of ``git-upload-pack`` responses.
+
+    Entries are files in ``path``, named after their key (see ``key()``).
+    The total size of all entries is kept under ``max_size`` bytes by
+    evicting the least recently used entries first.
+
+    Concurrent requests for the same key share a single producer: the first
+    request starts it and every request (including the first one) follows
+    the response as it is written to disk.  Followers that go away don't
+    interrupt the producer.
+
+    Reads and writes are ``pack_cache`` operations of ``executor``.
+    """
+
+    def __init__(self, path, max_size, chunk_size=64*1024, executor=None):
+        self._path = path
+        self._max_size = max_size
+        self._chunk_size = chunk_size
+        self._fs = executor or FileSystemExecutor()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        return self._size
+
+    @staticmethod
+    def key(name, fingerprint, body):
+        """Compute the cache key for an upload-pack request."""
+        digest = hashlib.sha256()
+        digest.update(name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(repr(fingerprint).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(body)
+        return digest.hexdigest()
+
+    def _load(self):
+        """Index entries left behind by a previous run."""
+        entries = []
+        for name in os.listdir(self._path):
+            path = os.path.join(self._path, name)
+            if name.endswith('.tmp'):
+                os.unlink(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        _unlink(self._evict())
+
+    def _evict(self):
+        """Drop entries until we fit, returns the files to delete."""
+        paths = []
+        while self._size > self._max_size:
+            key, size = self._entries.popitem(last=False)
+            paths.append(os.path.join(self._path, key))
+            self._size -= size
+            self.evictions += 1
+        return paths
+
+    async def fetch(self, key, produce, consume):
+        """Stream the response for ``key`` to ``consume``.
+
+        On a cache miss, ``produce(write)`` is started to generate the
+        response.  It must call ``await write(chunk)`` for each chunk of
+        output and raise an exception on failure.  ``consume(chunk)`` is
+        called with chunks of the response as they become available.  If the
+        producer fails, its exception is raised after all the output it
+        produced has been consumed.
+        """
+        path = os.path.join(self._path, key)
+
+        # Cache hit.
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            try:
+                stream = await self._fs.call('pack_cache', _open_entry, path)
+            except FileNotFoundError:  # pragma: no cover
+                # Evicted in the meantime.
+                pass
+            else:
+                self.hits += 1
+                with stream:
+                    chunk = await self._fs.call(
+                        'pack_cache', stream.read, self._chunk_size,
+                    )
+                    while chunk:
+                        await consume(chunk)
+                        chunk = await self._fs.call(
+                            'pack_cache', stream.read, self._chunk_size,
+                        )
+                return
+
+        # Start a producer, unless one is running already.
+        flight = self._flights.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = self._flights[key] = _Flight(
+                '%s.%s.tmp' % (path, uuid.uuid4().hex),
+            )
+            asyncio.ensure_future(self._produce(key, flight, produce))
+        else:
+            self.joins += 1
+
+        # Follow the output as it is written to disk.
+        flight.readers += 1
+        try:
+            offset = 0
+            while True:
+                if offset < flight.size:
+                    chunk = await self._fs.call(
+                        'pack_cache', os.pread, flight.fd,
+                        min(flight.size - offset, self._chunk_size), offset,
+                    )
+                    offset += len(chunk)
+                    await consume(chunk)
+                    continue
+                if flight.done:
+                    break
+                await flight.wait()
+        finally:
+            flight.readers -= 1
+            flight.close()
+        if flight.error is not None:
+            raise flight.error
+
+    async def _produce(self, key, flight, produce):
+
+        async def write(chunk):
+            await self._fs.call('pack_cache', _write, flight.fd, chunk)
+            flight.size += len(chunk)
+            flight.notify()
+
+        completed = False
+        try:
+            flight.fd = await self._fs.call('pack_cache', _create, flight.path)
+            await produce(write)
+            # Requests keep joining the flight until the entry is in place,
+            # otherwise they could miss both.
+            await self._fs.call('pack_cache', os.replace, flight.path,
+                                os.path.join(self._path, key))
+            completed = True
+        except Exception as error:
+            flight.error = error
+        finally:
+            del self._flights[key]
+            if completed:
+                self._entries[key] = flight.size
+                self._size += flight.size
+                paths = self._evict()
+            else:
+                paths = [flight.path] if flight.fd is not None else []
+                flight.error = flight.error or asyncio.CancelledError()
+            try:
+                await self._fs.call('pack_cache', _unlink, paths)
+            finally:
+                flight.done = True
+                flight.close()
+                flight.notify()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self._size,
+            'max_size': self._max_size,
+            'in_flight': len(self._flights),
+            'hits': self.hits,
+            'misses': self.misses,
+            'joins': self.joins,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import os
+import socket
+import struct
+import sys
+
+
+SOCKET_VAR = 'GITMESH_HOOK_SOCKET'
+"""Environment variable naming the hook daemon's socket."""
+
+FRAME = struct.Struct('!cI')
+"""Frame header: kind (``OUTPUT`` or ``STATUS``) and payload size."""
+
+OUTPUT = b'o'
+STATUS = b'x'
+
+
+def frame(kind, data):
+    return FRAME.pack(kind, len(data)) + data
+
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def connect(path, timeout=None):
+    """Connect to the hook daemon (``None`` if it's not running)."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def forward(sock, argv, stdin, stdout):
+    """Run the hook through the daemon, return its exit status."""
+    header = {
+        'argv': argv,
+        'env': dict(os.environ),
+        'cwd': os.getcwd(),
+    }
+    with sock:
+        sock.sendall(json.dumps(header).encode('utf-8') + b'\n')
+        sock.sendall(stdin.read())
+        sock.shutdown(socket.SHUT_WR)
+        while True:
+            try:
+                kind, size = FRAME.unpack(_read_exactly(sock, FRAME.size))
+                data = _read_exactly(sock, size)
+            except EOFError:
+                stdout.write(b'Lost connection to the hook daemon.\n')
+                stdout.flush()
+                return 1
+            if kind == STATUS:
+                return int(data.decode('ascii'))
+            stdout.write(data)
+            stdout.flush()
+
+
+def run_locally(argv):
+    """Run the hook in this process (the slow way)."""
+    from gitmesh.__main__ import main
+    sys.argv = ['gitmesh'] + argv
+    return main()
+
+
+def main(argv=None):
+    """Run a Git hook through the hook daemon of ``gitmesh serve``.
+
+    Starting ``python -m gitmesh`` loads all our dependencies and plugins,
+    and Git runs some hooks once per ref.  Instead, the hook scripts run
+    this tiny client, which only uses the standard library: it sends its
+    arguments, environment and standard input over the Unix socket named
+    by ``GITMESH_HOOK_SOCKET`` and relays the output and exit status (see
+    ``gitmesh.hookd``).  When the daemon can't be reached, the hook runs in
+    this process instead.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    path = os.environ.get(SOCKET_VAR)
+    sock = path and connect(path, timeout=1.0)
+    if not sock:
+        return run_locally(argv)
+    return forward(sock, argv, sys.stdin.buffer, sys.stdout.buffer)
+
+
+# Required for `python -m gitmesh.hookclient`.
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
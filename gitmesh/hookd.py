@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import io
+import json
+import os
+import structlog
+import sys
+import timeit
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+
+from gitmesh.hookclient import frame, OUTPUT, STATUS
+
+
+def run_hook(argv, env, cwd, stdin):
+    """Run ``gitmesh <argv>`` in a hook worker process.
+
+    Returns the hook's output (standard output and error) and exit status.
+    """
+    import click
+    from gitmesh.__main__ import cli
+
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(cwd)
+    output = io.StringIO()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                cli.main(args=argv, prog_name='gitmesh',
+                         obj={'loop': loop}, standalone_mode=False)
+                status = 0
+            except click.ClickException as error:
+                error.show(file=output)
+                status = error.exit_code
+            except SystemExit as error:
+                status = error.code if isinstance(error.code, int) else 1
+            except Exception:
+                traceback.print_exc(file=output)
+                status = 1
+    finally:
+        sys.stdin = sys.__stdin__
+        loop.close()
+    return output.getvalue().encode('utf-8'), status
+
+
+class HookDaemon(object):
+    """Runs Git hooks on behalf of ``gitmesh.hookclient``.
+
+    Hooks run in a pool of ``workers`` processes that stay up between
+    pushes, so dependencies and plugins are only loaded once per worker.
+    Clients connect to the Unix socket at ``path``.
+    """
+
+    def __init__(self, path, workers=None, log=None, clock=None):
+        self._path = path
+        self._workers = workers or os.cpu_count() or 1
+        self._log = log or structlog.get_logger()
+        self._clock = clock or timeit.default_timer
+        self._pool = None
+        self._server = None
+
+    @property
+    def path(self):
+        return self._path
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        if os.path.exists(self._path):
+            # Left over by a server that didn't shut down cleanly.
+            os.unlink(self._path)
+        self._pool = ProcessPoolExecutor(max_workers=self._workers)
+        # Fork the workers right away, before the server gets busy.
+        await asyncio.gather(*[
+            loop.run_in_executor(self._pool, os.getpid)
+            for _ in range(self._workers)
+        ])
+        self._server = await asyncio.start_unix_server(
+            self._handle, path=self._path,
+        )
+
+    async def run(self, argv, env, cwd, stdin):
+        """Run a hook in the worker pool, return its output and status.
+
+        If a worker dies, the pool is replaced and the hook runs again (once)
+        on the new pool.
+        """
+        loop = asyncio.get_event_loop()
+        for _ in range(2):
+            pool = self._pool
+            try:
+                return await loop.run_in_executor(
+                    pool, run_hook, argv, env, cwd, stdin,
+                )
+            except BrokenProcessPool:
+                # Every hook in flight fails along with the dead worker, only
+                # the first one to notice starts over with fresh workers.
+                if self._pool is pool:
+                    self._log.info('hook.pool.restart')
+                    pool.shutdown(wait=False)
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self._workers,
+                    )
+        return b'Hook worker died.\n', 1
+
+    async def _handle(self, reader, writer):
+        try:
+            header = json.loads((await reader.readline()).decode('utf-8'))
+            stdin = await reader.read()
+            ref = self._clock()
+            output, status = await self.run(
+                header['argv'], header['env'], header['cwd'], stdin,
+            )
+            self._log.info('hook.run', argv=header['argv'], status=status,
+                           duration=self._clock() - ref,
+                           request=header['env'].get('GITMESH_REQUEST_ID'))
+            if output:
+                writer.write(frame(OUTPUT, output))
+            writer.write(frame(STATUS, str(status).encode('ascii')))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            os.unlink(self._path)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import re
+import structlog
+import timeit
+import uuid
+
+from asyncio import subprocess
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from gitmesh.storage import kill_process, RepositoryExists, start_process
+
+
+IMPORTS_DIR = '.imports'
+"""Folder, inside the storage folder, where imports are cloned to."""
+
+IMPORT_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+IMPORT_PROTOCOLS = 'https:http:git:ssh'
+"""Transports allowed for imports by default (not ``file`` or ``ext``)."""
+
+_PROGRESS = re.compile(
+    r'^(?:remote: )?(?P<phase>[A-Za-z][A-Za-z ]*):\s+(?P<percent>\d+)%'
+)
+
+_LINES = re.compile(r'[\r\n]')
+
+
+def parse_progress(line):
+    """Parse a Git progress line (e.g. ``Receiving objects:  45% (9/20)``).
+
+    Returns a ``{'phase': ..., 'percent': ...}`` dictionary, or ``None``.
+    """
+    match = _PROGRESS.match(line.strip())
+    if match is None:
+        return None
+    return {
+        'phase': match.group('phase'),
+        'percent': int(match.group('percent')),
+    }
+
+
+class Imports(object):
+    """Repositories being imported from another server.
+
+    Each import runs ``git clone --mirror`` in the background (at most
+    ``concurrency`` at once) into a staging folder, and moves the result
+    into the storage once complete.  Jobs can be followed (``get()``) and
+    cancelled (``cancel()``); the last ``keep`` finished jobs are kept
+    around so that clients can find out how they went.
+
+    Only ``protocols`` (e.g. ``'https:ssh'``) may be used as transports
+    (see ``GIT_ALLOW_PROTOCOL`` in git(1)), since clients shouldn't get to
+    copy repositories (or run commands) on the server.  ``None`` allows all
+    of them.
+    """
+
+    def __init__(self, storage, concurrency=2, keep=100,
+                 protocols=IMPORT_PROTOCOLS, reaper=None, log=None,
+                 clock=None):
+        self._storage = storage
+        self._keep = keep
+        self._protocols = protocols
+        self._reaper = reaper
+        self._log = log or structlog.get_logger()
+        self._clock = clock or timeit.default_timer
+        self._budget = asyncio.Semaphore(concurrency)
+        self._jobs = OrderedDict()
+        self._tasks = {}
+
+    def get(self, job_id):
+        """Details of job ``job_id`` (``None`` if unknown)."""
+        job = self._jobs.get(job_id)
+        return job and dict(job)
+
+    def importing(self, name):
+        """Check if repository ``name`` is being imported."""
+        return any(
+            job['name'] == name for job_id, job in self._jobs.items()
+            if job_id in self._tasks
+        )
+
+    def start(self, name, url):
+        """Start importing ``url`` as repository ``name``.
+
+        Raises ``RepositoryExists`` if ``name`` is already being imported.
+        """
+        if self.importing(name):
+            raise RepositoryExists
+        job = {
+            'id': uuid.uuid4().hex,
+            'name': name,
+            'clone_url': url,
+            'state': 'queued',
+            'progress': None,
+            'error': None,
+            'created': datetime.utcnow().replace(
+                tzinfo=timezone.utc,
+            ).isoformat(),
+            'duration': None,
+        }
+        self._jobs[job['id']] = job
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks[job['id']] = task
+
+        def done(task):
+            del self._tasks[job['id']]
+            if task.cancelled():
+                job['state'] = 'cancelled'
+                self._log.info('import.cancel', job=job['id'], name=name)
+            elif task.exception() is not None:
+                job['state'] = 'failed'
+                job['error'] = str(task.exception())
+            self.prune()
+
+        task.add_done_callback(done)
+        self._log.info('import.queue', job=job['id'], name=name, url=url)
+        return dict(job)
+
+    def cancel(self, job_id):
+        """Cancel job ``job_id`` (returns ``False`` if it already ended)."""
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    def prune(self):
+        """Forget the oldest finished jobs."""
+        finished = [
+            job_id for job_id in self._jobs if job_id not in self._tasks
+        ]
+        for job_id in finished[:max(0, len(finished) - self._keep)]:
+            del self._jobs[job_id]
+
+    async def wait(self, job_id):
+        """Wait until job ``job_id`` ends."""
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.wait([task])
+        return self.get(job_id)
+
+    async def _run(self, job):
+        async with self._budget:
+            await self._import(job)
+
+    async def _import(self, job):
+        job['state'] = 'running'
+        staging = os.path.join(self._storage.path, IMPORTS_DIR)
+        path = os.path.join(staging, job['id'] + '.git')
+        os.makedirs(staging, exist_ok=True)
+        self._log.info('import.start', job=job['id'], name=job['name'])
+        ref = self._clock()
+        env = {'GIT_TERMINAL_PROMPT': '0'}
+        if self._protocols:
+            env['GIT_ALLOW_PROTOCOL'] = self._protocols
+        try:
+            process = await start_process(
+                ['git', 'clone', '--mirror', '--progress', '--',
+                 job['clone_url'], path],
+                env=env, split=True, stdin=subprocess.DEVNULL,
+            )
+            try:
+                _, errors, status = await asyncio.gather(
+                    process.stdout.read(),
+                    self._follow(job, process.stderr),
+                    process.wait(),
+                )
+            except asyncio.CancelledError:
+                kill_process(process)
+                await process.wait()
+                raise
+            if status != 0:
+                job['state'] = 'failed'
+                job['error'] = errors
+            else:
+                try:
+                    await self._storage.adopt_repo(
+                        job['name'], path, install_hooks=True,
+                    )
+                except RepositoryExists:
+                    job['state'] = 'failed'
+                    job['error'] = 'Repository exists.'
+                else:
+                    job['state'] = 'done'
+        finally:
+            job['duration'] = self._clock() - ref
+            if os.path.exists(path):
+                self._discard(path)
+        self._log.info('import.done', job=job['id'], name=job['name'],
+                       state=job['state'], duration=job['duration'],
+                       errors=job['error'])
+
+    async def _follow(self, job, stream, chunk_size=4096):
+        """Track progress in Git's output, return the last few lines."""
+        lines = []
+        buffer = ''
+        while True:
+            chunk = await stream.read(chunk_size)
+            buffer += chunk.decode('utf-8', 'replace')
+            *done, buffer = _LINES.split(buffer)
+            if not chunk:
+                done.append(buffer)
+            for line in done:
+                if not line.strip():
+                    continue
+                progress = parse_progress(line)
+                if progress is not None:
+                    job['progress'] = progress
+                else:
+                    lines = (lines + [line])[-10:]
+            if not chunk:
+                return '\n'.join(lines)
+
+    def _discard(self, path):
+        """Move a failed import to the trash."""
+        os.makedirs(self._storage.trash_path, exist_ok=True)
+        os.rename(path, os.path.join(
+            self._storage.trash_path, os.path.basename(path),
+        ))
+        if self._reaper is not None:
+            self._reaper.wake()
+
+    async def close(self):
+        """Cancel all jobs."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
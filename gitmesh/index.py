@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import bisect
+import ctypes
+import ctypes.util
+import os
+import re
+import struct
+import structlog
+import threading
+import time
+
+
+# See inotify(7).
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct('iIII')
+
+
+def _inotify():
+    """Load inotify functions from the C library (``None`` if unavailable).
+    """
+    name = ctypes.util.find_library('c')
+    if name is None:  # pragma: no cover
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):  # pragma: no cover
+        return None
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32,
+    ]
+    return libc
+
+
+SHARD_DEPTH = 2
+"""Levels of shard folders in the sharded layout (e.g. ``ab/cd/name.git``).
+"""
+
+_SHARD = re.compile(r'^[0-9a-f]{2}$')
+
+
+def _is_repository(name):
+    return name.endswith('.git') and not name.startswith('.')
+
+
+def _is_shard(name):
+    return _SHARD.match(name) is not None
+
+
+class RepositoryIndex(object):
+    """Sorted, in-memory index of the repositories in ``path``.
+
+    Repositories can be directly in ``path`` (flat layout) and/or in shard
+    folders (sharded layout, see ``SHARD_DEPTH``).
+
+    The index is loaded from disk once and then kept up to date by the
+    storage as it creates and deletes repositories.  Changes made by other
+    processes are picked up through inotify when ``watch()`` was called
+    (every shard folder is watched), or by checking the folder's mtime
+    before each query otherwise (which only covers the flat layout).  If a
+    folder can't be watched (e.g. once ``fs.inotify.max_user_watches`` is
+    reached), we go back to checking the mtime.  ``on_change()`` is called
+    whenever the set of names changes.
+
+    Updates may come from worker threads (the storage updates the index off
+    the event loop) as well as from the event loop (inotify events).
+    """
+
+    def __init__(self, path, on_change=None, log=None):
+        self._path = path
+        self._on_change = on_change or (lambda: None)
+        self._log = log or structlog.get_logger()
+        self._names = None
+        self._mtime = None
+        self._fd = None
+        self._loop = None
+        self._libc = None
+        self._watches = {}
+        self._lock = threading.RLock()
+
+    def _scan(self, folder='', depth=0, names=None, folders=None):
+        """List repositories and shard folders under ``folder``."""
+        names = [] if names is None else names
+        folders = [] if folders is None else folders
+        folders.append((folder, depth))
+        for entry in os.scandir(os.path.join(self._path, folder)):
+            if not entry.is_dir():
+                continue
+            if _is_repository(entry.name):
+                names.append(entry.name[:-4])
+            elif depth < SHARD_DEPTH and _is_shard(entry.name):
+                self._scan(os.path.join(folder, entry.name), depth + 1,
+                           names, folders)
+        return names, folders
+
+    def load(self):
+        """(Re)build the index from disk."""
+        with self._lock:
+            st = os.stat(self._path)
+            names, folders = self._scan()
+            names.sort()
+            for folder, depth in folders:
+                self._watch(folder, depth)
+            if names != self._names:
+                self._names = names
+                self._on_change()
+            # Changes made within the file system's timestamp granularity
+            # don't change the mtime, so don't trust it until it has
+            # settled.
+            self._mtime = None
+            if time.time() - st.st_mtime > 1.0:
+                self._mtime = st.st_mtime_ns
+
+    def refresh(self):
+        """Make sure the index reflects the contents of the folder."""
+        with self._lock:
+            if self._names is None:
+                self.load()
+            elif self._fd is None:
+                if os.stat(self._path).st_mtime_ns != self._mtime:
+                    self.load()
+
+    def add(self, name):
+        with self._lock:
+            self.refresh()
+            i = bisect.bisect_left(self._names, name)
+            if i == len(self._names) or self._names[i] != name:
+                self._names.insert(i, name)
+                self._on_change()
+
+    def discard(self, name):
+        with self._lock:
+            self.refresh()
+            i = bisect.bisect_left(self._names, name)
+            if i < len(self._names) and self._names[i] == name:
+                del self._names[i]
+                self._on_change()
+
+    def __len__(self):
+        self.refresh()
+        return len(self._names)
+
+    def names(self, prefix='', after=None, limit=None):
+        """List repository names starting with ``prefix``, in order.
+
+        Resumes after name ``after`` and returns at most ``limit`` names.
+        Only costs as much as the number of names returned.
+        """
+        self.refresh()
+        return self._page(prefix, after, limit)
+
+    def _page(self, prefix, after, limit):
+        start = bisect.bisect_left(self._names, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(self._names, after))
+        names = []
+        # Index rather than slice, slicing would copy the rest of the list.
+        for i in range(start, len(self._names)):
+            name = self._names[i]
+            if not name.startswith(prefix):
+                break
+            if limit is not None and len(names) >= limit:
+                break
+            names.append(name)
+        return names
+
+    def iter_names(self, prefix='', after=None, batch_size=1024,
+                   refresh=True):
+        """Iterate over repository names starting with ``prefix``, in order.
+
+        Names are fetched in batches, so the index may change while the
+        caller is iterating: each batch resumes after the last name seen.
+        The folder is only checked once, before the first batch (checking
+        it for every batch could rescan it every time, see ``load()``), and
+        not at all if ``refresh`` is false and the index is loaded already.
+        """
+        if refresh or self._names is None:
+            self.refresh()
+        while True:
+            names = self._page(prefix, after, batch_size)
+            for name in names:
+                yield name
+            if len(names) < batch_size:
+                return
+            after = names[-1]
+
+    def watch(self, loop=None):
+        """Follow changes made by other processes using inotify.
+
+        Returns ``False`` if inotify is not available (or some folder can't
+        be watched), in which case we keep checking the folder's mtime
+        instead.
+        """
+        if self._fd is not None:
+            return True
+        libc = _inotify()
+        if libc is None:  # pragma: no cover
+            return False
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:  # pragma: no cover
+            return False
+        self._fd = fd
+        self._libc = libc
+        self._loop = loop or asyncio.get_event_loop()
+        self._loop.add_reader(fd, self._read_events)
+        # Catch up with anything that happened before we started watching
+        # (this also watches all folders).
+        self.load()
+        return self._fd is not None
+
+    def _watch(self, folder, depth):
+        if self._fd is None:
+            return
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+            IN_ONLYDIR
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(os.path.join(self._path, folder)), mask,
+        )
+        if wd < 0:
+            # Changes in that folder would go unnoticed.
+            errno = ctypes.get_errno()
+            self._log.info('index.watch.fail', folder=folder, errno=errno,
+                           error=os.strerror(errno))
+            self._unwatch()
+            return
+        self._watches[wd] = (folder, depth)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:  # pragma: no cover
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            entry = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+            offset += size
+            if mask & IN_Q_OVERFLOW:  # pragma: no cover
+                self.load()
+                continue
+            if mask & IN_IGNORED:
+                # The folder is gone.
+                self._watches.pop(wd, None)
+                continue
+            if not (mask & IN_ISDIR) or wd not in self._watches:
+                continue
+            folder, depth = self._watches[wd]
+            if _is_repository(entry):
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add(entry[:-4])
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.discard(entry[:-4])
+            elif depth < SHARD_DEPTH and _is_shard(entry):
+                if mask & IN_CREATE:
+                    # Watch the new shard folder, and catch up with anything
+                    # created in it before we started watching.
+                    names, folders = self._scan(
+                        os.path.join(folder, entry), depth + 1,
+                    )
+                    for shard in folders:
+                        self._watch(*shard)
+                    for name in names:
+                        self.add(name)
+                elif mask & (IN_MOVED_FROM | IN_MOVED_TO):  # pragma: no cover
+                    # Shard folders moved around, start over.
+                    self.load()
+
+    def _unwatch(self):
+        """Go back to checking the mtime (see ``refresh()``)."""
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self._loop = None
+        self._libc = None
+        self._watches.clear()
+        # We may have missed changes already.
+        self._mtime = None
+
+    def close(self):
+        """Stop watching for changes."""
+        if self._fd is not None:
+            self._unwatch()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import json
+import os
+import structlog
+import timeit
+
+from datetime import datetime, timezone
+from subprocess import CalledProcessError
+
+from gitmesh.storage import UnknownRepository
+
+
+MAINTENANCE_TASKS = [
+    ('repack', ['git', 'repack', '-a', '-d', '--write-bitmap-index']),
+    ('multi-pack-index', ['git', 'multi-pack-index', 'write']),
+    ('commit-graph', ['git', 'commit-graph', 'write', '--reachable']),
+]
+"""Commands run (in order) to keep fetches fast."""
+
+MAINTENANCE_STATE = 'gitmesh-maintenance.json'
+"""File, inside each repository, where we keep its maintenance state."""
+
+
+def parse_quiet_hours(value):
+    """Parse ``"HH-HH"`` into a pair of hours (end is exclusive)."""
+    try:
+        start, end = value.split('-', 1)
+        start, end = int(start), int(end)
+    except ValueError:
+        raise ValueError('Invalid quiet hours: "%s".' % value)
+    if not (0 <= start < 24 and 0 <= end < 24):
+        raise ValueError('Invalid quiet hours: "%s".' % value)
+    return start, end
+
+
+class Maintenance(object):
+    """Background repository maintenance.
+
+    Pushes are counted per repository (see ``notify_push()``) and, once a
+    repository has received ``threshold`` pushes, it is repacked with
+    bitmaps and gets a fresh multi-pack-index and commit-graph.  At most
+    ``concurrency`` repositories are maintained at once.  When
+    ``quiet_hours`` is set to a pair of hours (e.g. ``(1, 5)``, in local
+    time), maintenance only starts during that window.
+
+    Push counts are saved every ``interval`` seconds and on ``close()``, so
+    that they survive restarts.
+    """
+
+    def __init__(self, storage, threshold=10, concurrency=1,
+                 quiet_hours=None, interval=60.0, log=None,
+                 clock=None, now=None):
+        self._storage = storage
+        self._threshold = threshold
+        self._quiet_hours = quiet_hours
+        self._interval = interval
+        self._log = log or structlog.get_logger()
+        self._clock = clock or timeit.default_timer
+        self._now = now or datetime.now
+        self._budget = asyncio.Semaphore(concurrency)
+        self._states = {}
+        self._pushes = {}  # Pushes to repositories whose state isn't loaded.
+        self._dirty = set()
+        self._tasks = set()
+
+    async def _state(self, name):
+        state = self._states.get(name)
+        if state is None:
+            state = await self._storage.executor.call(
+                'maintenance', self._load, name,
+            )
+            # Someone else may have loaded it in the mean time.
+            state = self._states.setdefault(name, state)
+        state['pushes'] += self._pushes.pop(name, 0)
+        return state
+
+    def _load(self, name):
+        path = os.path.join(
+            self._storage.open_repo(name).path, MAINTENANCE_STATE,
+        )
+        try:
+            with open(path, 'r') as stream:
+                state = json.load(stream)
+        except FileNotFoundError:
+            state = {
+                'pushes': 0,
+                'last_run': None,
+                'duration': None,
+                'tasks': {},
+                'error': None,
+            }
+        state['running'] = False
+        return state
+
+    def _save(self, name, state):
+        path = os.path.join(
+            self._storage.open_repo(name).path, MAINTENANCE_STATE,
+        )
+        with open(path + '.tmp', 'w') as stream:
+            json.dump(
+                {k: v for k, v in state.items() if k != 'running'},
+                stream,
+            )
+        os.replace(path + '.tmp', path)
+
+    def notify_push(self, name):
+        """Count a push to repository ``name``.
+
+        The push is only counted towards maintenance once the repository's
+        state is loaded (at the latest, on the next ``flush()``).
+        """
+        state = self._states.get(name)
+        if state is None:
+            self._pushes[name] = self._pushes.get(name, 0) + 1
+        else:
+            state['pushes'] += 1
+        self._dirty.add(name)
+
+    def forget(self, name):
+        """Drop the state for repository ``name`` (e.g. once deleted)."""
+        self._states.pop(name, None)
+        self._pushes.pop(name, None)
+        self._dirty.discard(name)
+
+    async def flush(self):
+        """Save push counts gathered since they were last saved."""
+        names, self._dirty = self._dirty, set()
+        for name in sorted(names):
+            try:
+                state = await self._state(name)
+                await self._storage.executor.call(
+                    'maintenance', self._save, name, dict(state),
+                )
+            except FileNotFoundError:
+                # Deleted in the mean time.
+                self.forget(name)
+
+    async def state(self, name):
+        """Maintenance state for repository ``name``."""
+        return dict(await self._state(name))
+
+    def in_quiet_hours(self):
+        if self._quiet_hours is None:
+            return True
+        start, end = self._quiet_hours
+        hour = self._now().hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def due(self):
+        """List repositories that need maintenance (see ``notify_push()``).
+        """
+        return sorted(
+            name for name, state in self._states.items()
+            if state['pushes'] >= self._threshold and not state['running']
+        )
+
+    async def schedule(self, name):
+        """Start maintenance for repository ``name`` in the background."""
+        state = await self._state(name)
+        if state['running']:
+            return False
+        state['running'] = True
+        task = asyncio.ensure_future(self.maintain(name))
+        self._tasks.add(task)
+
+        def done(task):
+            self._tasks.discard(task)
+            state['running'] = False
+
+        task.add_done_callback(done)
+        return True
+
+    async def maintain(self, name):
+        """Maintain repository ``name`` (waits for the concurrency budget).
+        """
+        state = await self._state(name)
+        state['running'] = True
+        try:
+            async with self._budget:
+                await self._maintain(name, state)
+        finally:
+            state['running'] = False
+
+    async def _maintain(self, name, state):
+        try:
+            repo = await self._storage.find_repo(name)
+        except UnknownRepository:  # pragma: no cover
+            # Deleted in the mean time.
+            return
+        options = await self._storage.executor.call(
+            'maintenance', repo.repack_options,
+        )
+        pushes = state['pushes']
+        self._log.info('maintenance.start', name=name, pushes=pushes)
+        ref = self._clock()
+        tasks = {}
+        error = None
+        for task, command in MAINTENANCE_TASKS:
+            if task == 'repack':
+                command = command + options
+            task_ref = self._clock()
+            try:
+                await repo.run(command)
+            except CalledProcessError as exc:
+                error = '%s: %s' % (task, exc.output)
+                break
+            finally:
+                tasks[task] = self._clock() - task_ref
+        duration = self._clock() - ref
+        self._log.info('maintenance.done', name=name, duration=duration,
+                       tasks=tasks, error=error)
+        state.update({
+            # Pushes received while we ran count towards the next run.
+            'pushes': state['pushes'] - pushes,
+            'last_run': datetime.utcnow().replace(
+                tzinfo=timezone.utc,
+            ).isoformat(),
+            'duration': duration,
+            'tasks': tasks,
+            'error': error,
+        })
+        try:
+            await self._storage.executor.call(
+                'maintenance', self._save, name, dict(state),
+            )
+        except FileNotFoundError:  # pragma: no cover
+            # Deleted in the mean time.
+            pass
+
+    async def run(self):
+        """Periodically start maintenance for repositories that need it."""
+        while True:
+            await self.flush()
+            if self.in_quiet_hours():
+                for name in self.due():
+                    await self.schedule(name)
+            await asyncio.sleep(self._interval)
+
+    async def close(self):
+        """Cancel maintenance in progress and save push counts."""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        await self.flush()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import sys
+import threading
+import timeit
+
+from inspect import iscoroutine
+
+try:
+    from importlib import metadata
+except ImportError:  # pragma: no cover
+    import importlib_metadata as metadata
+
+
+CACHE_VAR = 'GITMESH_PLUGIN_CACHE'
+"""Environment variable naming the plugin cache file (empty to disable)."""
+
+GROUP_PREFIX = 'gitmesh.'
+"""Only entry points in these groups are plugins."""
+
+_METADATA_SUFFIXES = ('.dist-info', '.egg-info', '.egg-link', '.egg')
+
+
+def cache_path():
+    """Where to cache plugins (``None`` when caching is disabled)."""
+    path = os.environ.get(CACHE_VAR)
+    if path is not None:
+        return path or None
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache',
+    )
+    return os.path.join(root, 'gitmesh', 'plugins.json')
+
+
+def fingerprint(path):
+    """Digest of the metadata of distributions installed on ``path``.
+
+    Changes whenever a distribution is installed, upgraded or removed, but
+    only takes a few ``stat()`` calls to compute.
+    """
+    digest = hashlib.sha1()
+    for folder in path:
+        try:
+            names = sorted(os.listdir(folder or '.'))
+        except OSError:
+            # Missing folders, zip files, etc.
+            continue
+        for name in names:
+            if not name.endswith(_METADATA_SUFFIXES):
+                continue
+            try:
+                mtime = os.stat(os.path.join(folder, name)).st_mtime
+            except OSError:  # pragma: no cover
+                continue
+            digest.update(('%s\0%r\0' % (
+                os.path.join(folder, name), mtime,
+            )).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def scan(path):
+    """Find plugins in distributions installed on ``path`` (slow).
+
+    Returns ``{group: [(name, 'module:attr'), ...]}``.
+    """
+    groups = {}
+    seen = set()
+    for distribution in metadata.distributions(path=path):
+        # Like ``pkg_resources``, the first one found on ``path`` wins.
+        name = (distribution.metadata['Name'] or '').lower()
+        if name in seen:
+            continue
+        seen.add(name)
+        for entry_point in distribution.entry_points:
+            if entry_point.group.startswith(GROUP_PREFIX):
+                groups.setdefault(entry_point.group, []).append(
+                    (entry_point.name, entry_point.value),
+                )
+    return groups
+
+
+def load(value):
+    """Import the object named by an entry point (e.g. ``'echo:update'``)."""
+    module, _, attrs = value.partition(':')
+    target = importlib.import_module(module.strip())
+    for attr in filter(None, attrs.strip().split('.')):
+        target = getattr(target, attr)
+    return target
+
+
+class PluginRegistry(object):
+    """Plugins (setuptools entry points) installed on ``path``.
+
+    Hooks look plugins up on every push and scanning the metadata of every
+    installed distribution is slow, so results are kept in memory and in
+    the ``cache`` file, and only scanned again when ``fingerprint()``
+    changes.
+    """
+
+    def __init__(self, path=None, cache=None):
+        self._path = sys.path if path is None else path
+        self._cache = cache
+        self._key = None
+        self._groups = {}
+
+    def entry_points(self, group):
+        """Names and object references of plugins in ``group``."""
+        key = fingerprint(self._path)
+        if key != self._key:
+            self._groups = self._load(key)
+            self._key = key
+        return list(self._groups.get(group, []))
+
+    def _load(self, key):
+        if self._cache:
+            try:
+                with open(self._cache, 'r') as stream:
+                    cached = json.load(stream)
+                if cached['key'] == key:
+                    return {
+                        group: [tuple(plugin) for plugin in plugins]
+                        for group, plugins in cached['groups'].items()
+                    }
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        groups = scan(self._path)
+        if self._cache:
+            try:
+                _write_json(self._cache, {'key': key, 'groups': groups})
+            except OSError:
+                pass
+        return groups
+
+
+def _write_json(path, data):
+    """Replace the contents of ``path`` atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'w') as stream:
+        json.dump(data, stream)
+    os.replace(temp, path)
+
+
+_registry = None
+
+
+def registry():
+    """Registry for this process' ``sys.path``."""
+    global _registry
+    if _registry is None:
+        _registry = PluginRegistry(cache=cache_path())
+    return _registry
+
+
+def find_entry_points(group):
+    """Load plugins in ``group``, yields ``(name, plugin)`` pairs."""
+    for name, value in registry().entry_points(group):
+        yield name, load(value)
+
+
+def independent(plugin=None, timeout=None):
+    """Mark a plugin as safe to run concurrently with other plugins.
+
+    Use as ``@independent`` or ``@independent(timeout=5.0)``, where
+    ``timeout`` (in seconds) replaces the default per-plugin deadline.
+    """
+    def mark(plugin):
+        plugin.gitmesh_independent = True
+        plugin.gitmesh_timeout = timeout
+        return plugin
+    if plugin is None:
+        return mark
+    return mark(plugin)
+
+
+def batched(plugin):
+    """Mark an update plug-in as checking all ref updates at once.
+
+    Instead of ``plugin(ref=..., old=..., new=...)`` for each ref, it's
+    called once as ``plugin(updates={ref: (old, new), ...})`` and returns
+    the refs it rejects.
+    """
+    plugin.gitmesh_batched = True
+    return plugin
+
+
+def is_batched(plugin):
+    return getattr(plugin, 'gitmesh_batched', False) is True
+
+
+def _independent(plugin):
+    return getattr(plugin, 'gitmesh_independent', False) is True
+
+
+class _PluginExit(Exception):
+    """Carries a plugin's ``SystemExit`` out of its task.
+
+    Tasks let ``SystemExit`` escape the event loop right away, which would
+    leave other plugins behind.
+    """
+
+
+async def _catch_exit(awaitable):
+    try:
+        return await awaitable
+    except SystemExit as error:
+        raise _PluginExit(error)
+
+
+def _call_in_thread(loop, function, kwds):
+    """Call ``function(**kwds)`` in a daemon thread, returns a future.
+
+    Unlike ``loop.run_in_executor()``, the hook doesn't wait for the thread
+    before exiting when the plugin overruns its deadline.
+    """
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            # Cancelled: we're past the deadline.
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def run():
+        result, error = None, None
+        try:
+            result = function(**kwds)
+        except (Exception, SystemExit) as exception:
+            error = exception
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:  # pragma: no cover
+            # The hook gave up on us and closed its event loop.
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+async def run_plugins(hook, plugins, kwds, log, timeout=None, deadline=None,
+                      verbose=False, loop=None):
+    """Run ``hook``'s ``plugins``, passing ``kwds`` as keyword arguments.
+
+    Plugins run one after the other, in order, except for those marked with
+    ``independent()``, which run concurrently with all the others (plain
+    functions in threads).  Each plugin gets ``timeout`` seconds (unless it
+    sets its own) and all of them get ``deadline`` seconds; plain functions
+    that aren't independent can't be interrupted and have no timeout.
+
+    When plugins fail (or exit, e.g. with ``sys.exit()``), the first error
+    (sequential plugins first) is raised once all independent plugins are
+    done.  Otherwise, returns what each plugin returned, in order.
+    """
+    loop = loop or asyncio.get_event_loop()
+    results = [None] * len(plugins)
+
+    async def run(index, name, plugin):
+        concurrent = _independent(plugin)
+        limit = concurrent and plugin.gitmesh_timeout or timeout
+        if verbose:
+            print('Running hook %r.' % name)
+        status = 'failed'
+        ref = timeit.default_timer()
+        try:
+            if concurrent and not asyncio.iscoroutinefunction(plugin):
+                result = _call_in_thread(loop, plugin, kwds)
+            else:
+                result = plugin(**kwds)
+            if iscoroutine(result) or isinstance(result, asyncio.Future):
+                result = await asyncio.wait_for(_catch_exit(result), limit)
+            results[index] = result
+            status = 'ok'
+        except SystemExit as error:
+            raise _PluginExit(error)
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        finally:
+            log.info('git.hooks.plugin', hook=hook, plugin=name,
+                     independent=concurrent, status=status,
+                     duration=timeit.default_timer() - ref)
+
+    async def chain(plugins):
+        for index, name, plugin in plugins:
+            await run(index, name, plugin)
+
+    # Start independent plugins first, so that they're already running
+    # when a plain function blocks the event loop.
+    tasks = [
+        asyncio.ensure_future(run(index, name, plugin), loop=loop)
+        for index, (name, plugin) in enumerate(plugins)
+        if _independent(plugin)
+    ]
+    tasks.insert(0, asyncio.ensure_future(chain([
+        (index, name, plugin) for index, (name, plugin) in enumerate(plugins)
+        if not _independent(plugin)
+    ]), loop=loop))
+    try:
+        errors = await asyncio.wait_for(
+            asyncio.gather(*tasks, return_exceptions=True), deadline,
+        )
+    except asyncio.TimeoutError:
+        log.info('git.hooks.timeout', hook=hook, deadline=deadline)
+        raise
+    for error in errors:
+        if isinstance(error, _PluginExit):
+            raise error.args[0]
+        if isinstance(error, BaseException):
+            raise error
+    return results
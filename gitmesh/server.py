@@ -4,18 +4,40 @@
 import asyncio
 import json
 import os
+import re
 import structlog
 import timeit
 import uuid
+import zlib
 
 from aiohttp import web
+from collections import deque, OrderedDict
 from datetime import datetime, timezone
-from voluptuous import Schema, Required, MultipleInvalid
+from subprocess import CalledProcessError
+from urllib.parse import urlencode
+from voluptuous import (
+    All,
+    Any,
+    Coerce,
+    MultipleInvalid,
+    Range,
+    Required,
+    Schema,
+)
 
+from gitmesh.bundles import Bundles, BUNDLES_DIR
+from gitmesh.cache import PackCache, RefAdvertisementCache
+from gitmesh.hookclient import SOCKET_VAR
+from gitmesh.imports import Imports, IMPORT_STATES
+from gitmesh.maintenance import Maintenance
 from gitmesh.storage import (
+    check_name,
+    kill_process,
     RepositoryExists,
     UnknownRepository,
 )
+from gitmesh.trash import Reaper
+from gitmesh.workqueue import QUEUE_VAR, REPOSITORY_VAR, WorkQueue
 
 
 async def inject_request_id(app, handler):
@@ -90,6 +112,8 @@ async def access_log_middleware(app, handler):
 Index = Schema({
     Required('list'): str,  # GET to query repository listing.
     Required('create'): str,  # POST to create new repository.
+    Required('metrics'): str,  # GET to query server metrics.
+    Required('batch'): str,  # POST to create/delete many repositories.
 })
 
 
@@ -98,20 +122,101 @@ RepositoryDetails = Schema({
     Required('clone'): [str],
     Required('details'): str,  # GET to refresh snapshot.
     Required('delete'): str,  # POST here to delete.
+    'bundles': [{  # newest first (not included in listings).
+        Required('url'): str,  # GET to download (supports ranges).
+        Required('size'): int,  # bytes.
+        Required('created'): str,  # ISO 8601 timestamp.
+    }],
 })
 
 
 RepositoryListing = Schema({
     'repositories': [RepositoryDetails],
+    'next': str,  # GET for the next page (only when there is one).
+})
+
+
+ListingQuery = Schema({
+    'limit': All(Coerce(int), Range(min=1)),  # page size (default: all).
+    'after': str,  # name of the last repository on the previous page.
+    'prefix': str,  # only list repositories whose name starts with this.
+})
+
+
+MaintenanceDetails = Schema({
+    Required('pushes'): int,  # since the last run.
+    Required('running'): bool,
+    Required('last_run'): Any(None, str),  # ISO 8601 timestamp.
+    Required('duration'): Any(None, float),  # seconds.
+    Required('tasks'): {str: float},  # duration of each step, in seconds.
+    Required('error'): Any(None, str),
+})
+
+
+RepositorySettings = Schema({
+    Required('hide_refs'): [str],  # `transfer.hideRefs` (e.g. refs/pull/).
+    Required('allow_filter'): bool,  # `uploadpack.allowFilter`.
+})
+
+
+SettingsRequest = Schema({
+    'hide_refs': [str],
+    'allow_filter': bool,
 })
 
 
+RepositoryName = All(str, check_name)
+
+
 CreateRequest = Schema({
+    Required('name'): RepositoryName,
+    'clone_url': str,  # will `git clone --mirror` this (see ImportJob).
+})
+
+
+ImportJob = Schema({
+    Required('id'): str,
+    Required('job'): str,  # GET to refresh, DELETE to cancel.
     Required('name'): str,
-    'clone_url': str,  # will `git clone` this.
+    Required('details'): str,  # repository details (once done).
+    Required('clone_url'): str,
+    Required('state'): Any(*IMPORT_STATES),
+    Required('progress'): Any(None, {
+        Required('phase'): str,  # e.g. "Receiving objects".
+        Required('percent'): int,
+    }),
+    Required('error'): Any(None, str),
+    Required('created'): str,  # ISO 8601 timestamp.
+    Required('duration'): Any(None, float),  # seconds.
+})
+
+
+ForkRequest = Schema({
+    Required('name'): RepositoryName,  # name of the fork.
+})
+
+
+BatchRequest = Schema({
+    Required('operations'): [{
+        Required('op'): Any('create', 'delete'),
+        Required('name'): RepositoryName,
+    }],
 })
 
 
+BatchResults = Schema({
+    Required('results'): [{  # same order as the operations.
+        Required('op'): str,
+        Required('name'): str,
+        Required('status'): int,  # HTTP status, as if done on its own.
+        'repository': RepositoryDetails,  # created repository.
+    }],
+})
+
+BATCH_SIZE_MAX = 10000
+"""Most operations accepted in a single batch request."""
+
+
 def _listing_url(request):
     return '%s://%s%s' % (
         request.scheme,
@@ -139,6 +244,38 @@ def _create_url(request):
     )
 
 
+def _batch_url(request):
+    return '%s://%s%s' % (
+        request.scheme,
+        request.host,
+        request.app.router['batch-repositories'].url(),
+    )
+
+
+def _job_url(request, job_id):
+    return '%s://%s%s' % (
+        request.scheme,
+        request.host,
+        request.app.router['get-job'].url(parts=dict(id=job_id)),
+    )
+
+
+def _import_job(request, job):
+    return ImportJob(dict(
+        job,
+        job=_job_url(request, job['id']),
+        details=_details_url(request, job['name']),
+    ))
+
+
+def _metrics_url(request):
+    return '%s://%s%s' % (
+        request.scheme,
+        request.host,
+        request.app.router['metrics'].url(),
+    )
+
+
 def _delete_url(request, name):
     return '%s://%s%s' % (
         request.scheme,
@@ -149,6 +286,28 @@ def _delete_url(request, name):
     )
 
 
+def _bundle_url(request, name, bundle):
+    return '%s://%s%s' % (
+        request.scheme,
+        request.host,
+        request.app.router['git-http-endpoint'].url(parts=dict(
+            name=name,
+            path='/%s/%s' % (BUNDLES_DIR, bundle),
+        )),
+    )
+
+
+async def _bundles(request, name):
+    return [
+        {
+            'url': _bundle_url(request, name, bundle['name']),
+            'size': bundle['size'],
+            'created': bundle['created'],
+        }
+        for bundle in await request.app['gitmesh.bundles'].list(name)
+    ]
+
+
 def _details_url(request, name):
     return '%s://%s%s' % (
         request.scheme,
@@ -159,6 +318,33 @@ def _details_url(request, name):
     )
 
 
+REVALIDATE_HEADERS = {
+    # Caches may keep the document, as long as they check with us first.
+    'Cache-Control': 'no-cache',
+}
+
+
+async def check_etag(request):
+    """Compute caching headers for a document derived from repository state.
+
+    Raises ``304 Not Modified`` when the client already has the current
+    version, without looking at the repositories.  Documents embed URLs,
+    so the ``ETag`` also depends on the host they were requested for.
+    """
+    storage = request.app['gitmesh.storage']
+    await storage.refresh()
+    etag = '"%s-%x-%08x"' % (
+        storage.epoch,
+        storage.generation,
+        zlib.crc32(('%s://%s' % (request.scheme, request.host)).encode()),
+    )
+    headers = {'ETag': etag}
+    headers.update(REVALIDATE_HEADERS)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        raise web.HTTPNotModified(headers=headers)
+    return headers
+
+
 async def index(request):
     """."""
 
@@ -168,36 +354,183 @@ async def index(request):
     return web.json_response(Index({
         'list': _listing_url(request),
         'create': _create_url(request),
+        'metrics': _metrics_url(request),
+        'batch': _batch_url(request),
     }))
 
 
+async def metrics(request):
+    """."""
+
+    return web.json_response({
+        'refs_cache': request.app['gitmesh.refs_cache'].stats(),
+        'pack_cache': (
+            request.app['gitmesh.pack_cache'] and
+            request.app['gitmesh.pack_cache'].stats()
+        ),
+        'scheduler': request.app['gitmesh.scheduler'].stats(),
+        'storage': request.app['gitmesh.storage'].stats(),
+        'trash': await request.app['gitmesh.reaper'].stats(),
+        'queue': await request.app['gitmesh.queue'].stats(),
+    })
+
+
+_NAME = '\0'
+
+
+class RepositoryURLs(object):
+    """Formats repository URLs from templates computed once.
+
+    Each URL is given for the (impossible) repository name ``_NAME``, which
+    is then substituted for each repository.  This avoids going through the
+    router for every repository in a listing.
+    """
+
+    def __init__(self, clone, details, delete):
+        self._clone = clone.split(_NAME, 1)
+        self._details = details.split(_NAME, 1)
+        self._delete = delete.split(_NAME, 1)
+
+    @classmethod
+    def for_request(cls, request):
+        return cls(
+            _clone_url(request, _NAME),
+            _details_url(request, _NAME),
+            _delete_url(request, _NAME),
+        )
+
+    def __call__(self, name):
+        return {
+            'name': name,
+            'clone': [
+                self._clone[0] + name + self._clone[1],
+            ],
+            'details': self._details[0] + name + self._details[1],
+            'delete': self._delete[0] + name + self._delete[1],
+        }
+
+
+def iter_json(key, items, tail=None, chunk_size=64*1024):
+    """Encode ``{key: [...items], ...tail()}`` as JSON, one chunk at a time.
+
+    ``items`` is consumed lazily and chunks are about ``chunk_size`` bytes,
+    so memory use doesn't depend on the number of items.  ``tail`` is
+    called once all items are consumed and returns extra members for the
+    document.
+    """
+    buffer = ['{%s: [' % json.dumps(key)]
+    size = 0
+    separator = ''
+    for item in items:
+        data = separator + json.dumps(item)
+        separator = ', '
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    buffer.append(']')
+    for k, v in sorted((tail() if tail else {}).items()):
+        buffer.append(', %s: %s' % (json.dumps(k), json.dumps(v)))
+    buffer.append('}')
+    yield ''.join(buffer).encode('utf-8')
+
+
+async def stream_json(request, chunks, status=200, headers=None):
+    """Send a JSON document produced by ``iter_json()``."""
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = 'application/json'
+    await response.prepare(request)
+    for chunk in chunks:
+        response.write(chunk)
+        await response.drain()
+    await response.write_eof()
+    return response
+
+
 async def list_repositories(request):
     """."""
 
+    # Validate request.
+    try:
+        q = ListingQuery(dict(request.GET))
+    except MultipleInvalid:
+        raise web.HTTPBadRequest
+    limit = q.get('limit')
+    prefix = q.get('prefix', '')
+
+    # Skip the listing if the client has it already (this also refreshes
+    # the repository index).
+    headers = await check_etag(request)
+
     storage = request.app['gitmesh.storage']
-    repository_names = await storage.list_repositories()
+    names = storage.iter_repositories(prefix=prefix, after=q.get('after'))
+    urls = RepositoryURLs.for_request(request)
+    page = {'size': 0, 'last': None, 'more': False}
+
+    def repositories():
+        for name in names:
+            if page['size'] == limit:
+                page['more'] = True
+                return
+            page['size'] += 1
+            page['last'] = name
+            yield urls(name)
+
+    def tail():
+        if not page['more']:
+            return {}
+        query = {'limit': limit, 'after': page['last']}
+        if prefix:
+            query['prefix'] = prefix
+        return {
+            'next': _listing_url(request) + '?' + urlencode(
+                sorted(query.items()),
+            ),
+        }
+
+    # Stream the response.
+    return await stream_json(
+        request, iter_json('repositories', repositories(), tail),
+        headers=headers,
+    )
 
-    # Format the response.
-    return web.json_response({
-        'repositories': [
-            {
-                'name': name,
-                'clone': [
-                    _clone_url(request, name),
-                ],
-                'details': _details_url(request, name),
-                'delete': _delete_url(request, name),
-            }
-            for name in sorted(repository_names)
+
+def _repository_details(request, name, bundles):
+    return RepositoryDetails({
+        'name': name,
+        'clone': [
+            _clone_url(request, name),
         ],
+        'details': _details_url(request, name),
+        'delete': _delete_url(request, name),
+        'bundles': bundles,
     })
 
 
+async def _create_repository(request, name):
+    """Create repository ``name`` (raises ``RepositoryExists``)."""
+    if request.app['gitmesh.imports'].importing(name):
+        raise RepositoryExists
+    storage = request.app['gitmesh.storage']
+    await storage.create_repo(name, install_hooks=True)
+    request.app['gitmesh.event_log'].info('repository.create', name=name)
+
+
+async def _delete_repository(request, name):
+    """Delete repository ``name`` (raises ``UnknownRepository``)."""
+    request.app['gitmesh.event_log'].info('repository.delete', name=name)
+    storage = request.app['gitmesh.storage']
+    await storage.delete_repo(name)
+    request.app['gitmesh.maintenance'].forget(name)
+    request.app['gitmesh.bundles'].forget(name)
+    request.app['gitmesh.reaper'].wake()
+
+
 async def create_repository(request):
     """."""
 
-    log = request.app['gitmesh.event_log']
-
     # Validate request.
     r = await request.json()
     try:
@@ -206,38 +539,71 @@ async def create_repository(request):
         raise web.HTTPBadRequest
     name = r['name']
 
+    # Import the project in the background.
+    if 'clone_url' in r:
+        storage = request.app['gitmesh.storage']
+        if await storage.repository_exists(name):
+            raise web.HTTPConflict()
+        try:
+            job = request.app['gitmesh.imports'].start(name, r['clone_url'])
+        except RepositoryExists:
+            raise web.HTTPConflict()
+        return web.HTTPAccepted(
+            content_type='application/json',
+            body=json.dumps(_import_job(request, job)).encode('utf-8'),
+            headers={
+                'Location': _job_url(request, job['id']),
+            },
+        )
+
     # Create the project.
-    storage = request.app['gitmesh.storage']
     try:
-        await storage.create_repo(name, install_hooks=True)
+        await _create_repository(request, name)
     except RepositoryExists:
         raise web.HTTPConflict()
 
-    log.info('repository.create', name=name)
-
     # Format response.
     return web.HTTPCreated(
         content_type='application/json',
-        body=json.dumps(RepositoryDetails({
-            'name': name,
-            'clone': [
-                _clone_url(request, name),
-            ],
-            'details': _details_url(request, name),
-            'delete': _delete_url(request, name),
-        })).encode('utf-8'),
+        body=json.dumps(
+            _repository_details(request, name, []),
+        ).encode('utf-8'),
         headers={
             'Location': _details_url(request, name),
         },
     )
 
 
+async def query_job(request):
+    """."""
+
+    job = request.app['gitmesh.imports'].get(request.match_info['id'])
+    if job is None:
+        raise web.HTTPNotFound
+    return web.json_response(_import_job(request, job))
+
+
+async def cancel_job(request):
+    """."""
+
+    imports = request.app['gitmesh.imports']
+    job_id = request.match_info['id']
+    if imports.get(job_id) is None:
+        raise web.HTTPNotFound
+    if imports.cancel(job_id):
+        await imports.wait(job_id)
+    return web.json_response(_import_job(request, imports.get(job_id)))
+
+
 async def query_repository(request):
     """."""
 
     # Validate request.
     name = request.match_info['name']
 
+    # Skip the details if the client has them already.
+    headers = await check_etag(request)
+
     # Check that the repository exists.
     storage = request.app['gitmesh.storage']
     exists = await storage.repository_exists(name)
@@ -245,30 +611,61 @@ async def query_repository(request):
         raise web.HTTPNotFound
 
     # Format response.
-    return web.json_response(RepositoryDetails({
-        'name': name,
-        'clone': [
-            _clone_url(request, name),
-        ],
-        'details': _details_url(request, name),
-        'delete': _delete_url(request, name),
-    }))
+    response = web.json_response(
+        _repository_details(request, name, await _bundles(request, name)),
+    )
+    response.headers.update(headers)
+    return response
 
 
-async def delete_repository(request):
+async def fork_repository(request):
     """."""
 
     log = request.app['gitmesh.event_log']
 
     # Validate request.
-    name = request.match_info['name']
+    parent = request.match_info['name']
+    r = await request.json()
+    try:
+        r = ForkRequest(r)
+    except MultipleInvalid:
+        raise web.HTTPBadRequest
+    name = r['name']
+
+    # Fork the project (unless an import is about to claim the name).
+    storage = request.app['gitmesh.storage']
+    try:
+        if request.app['gitmesh.imports'].importing(name):
+            raise RepositoryExists
+        await storage.fork_repo(parent, name, install_hooks=True)
+    except UnknownRepository:
+        raise web.HTTPNotFound
+    except RepositoryExists:
+        raise web.HTTPConflict()
+
+    log.info('repository.fork', name=name, parent=parent)
+
+    # Format response.
+    return web.HTTPCreated(
+        content_type='application/json',
+        body=json.dumps(
+            _repository_details(request, name, []),
+        ).encode('utf-8'),
+        headers={
+            'Location': _details_url(request, name),
+        },
+    )
+
+
+async def delete_repository(request):
+    """."""
 
-    log.info('repository.delete', name=name)
+    # Validate request.
+    name = request.match_info['name']
 
     # Delete the repository.
-    storage = request.app['gitmesh.storage']
     try:
-        await storage.delete_repo(name)
+        await _delete_repository(request, name)
     except UnknownRepository:
         raise web.HTTPNotFound
 
@@ -276,22 +673,987 @@ async def delete_repository(request):
     return web.json_response({})
 
 
-async def git_http_endpoint(request):
+async def batch_repositories(request):
+    """Create and/or delete many repositories at once.
+
+    Operations run concurrently (up to the batch concurrency), so each
+    repository may only appear once.  Each operation gets its own result.
+    """
+
+    # Validate request.
+    r = await request.json()
+    try:
+        r = BatchRequest(r)
+    except MultipleInvalid:
+        raise web.HTTPBadRequest
+    operations = r['operations']
+    if len(operations) > BATCH_SIZE_MAX:
+        raise web.HTTPRequestEntityTooLarge
+    if len(set(op['name'] for op in operations)) < len(operations):
+        raise web.HTTPBadRequest
+
+    budget = asyncio.Semaphore(request.app['gitmesh.batch_concurrency'])
+
+    async def run(op, name):
+        result = {'op': op, 'name': name}
+        async with budget:
+            if op == 'create':
+                try:
+                    await _create_repository(request, name)
+                except RepositoryExists:
+                    result['status'] = 409
+                else:
+                    result['status'] = 201
+                    result['repository'] = _repository_details(
+                        request, name, [],
+                    )
+            else:
+                try:
+                    await _delete_repository(request, name)
+                except UnknownRepository:
+                    result['status'] = 404
+                else:
+                    result['status'] = 200
+        return result
+
+    results = await asyncio.gather(*[
+        run(op['op'], op['name']) for op in operations
+    ])
+
+    # Format the response.
+    return web.json_response(BatchResults({
+        'results': results,
+    }))
+
+
+async def _read_settings(repo):
+    allow_filter = await repo.read_config('uploadpack.allowFilter')
+    return RepositorySettings({
+        'hide_refs': await repo.read_config('transfer.hideRefs'),
+        'allow_filter': allow_filter[-1:] == ['true'],
+    })
+
+
+async def query_settings(request):
+    """."""
+
+    # Validate request.
+    name = request.match_info['name']
+
+    # Check that the repository exists.
+    repo = await _open_repo(request, name)
+
+    # Format response.
+    return web.json_response(await _read_settings(repo))
+
+
+async def update_settings(request):
+    """."""
 
     log = request.app['gitmesh.event_log']
 
     # Validate request.
     name = request.match_info['name']
-    path = request.match_info['path']
-    data = await request.read()
+    r = await request.json()
+    try:
+        r = SettingsRequest(r)
+    except MultipleInvalid:
+        raise web.HTTPBadRequest
+
+    # Check that the repository exists.
+    repo = await _open_repo(request, name)
+
+    log.info('repository.settings', name=name, **r)
+
+    # Update the repository's Git config.
+    if 'hide_refs' in r:
+        await repo.write_config('transfer.hideRefs', r['hide_refs'])
+    if 'allow_filter' in r:
+        await repo.write_config('uploadpack.allowFilter', [
+            'true' if r['allow_filter'] else 'false',
+        ])
+    request.app['gitmesh.refs_cache'].invalidate(name)
+
+    # Format response.
+    return web.json_response(await _read_settings(repo))
+
+
+def _inflate(decoder, data, chunk_size):
+    """Decompress ``data`` without producing more than ``chunk_size`` at once.
+    """
+    data = decoder.decompress(data, chunk_size)
+    while data:
+        yield data
+        data = decoder.decompress(decoder.unconsumed_tail, chunk_size)
+
+
+def _request_decoder(request):
+    if request.headers.get('Content-Encoding') in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return None
+
+
+async def read_request_body(request, decoder=None, limit=1024*1024,
+                            chunk_size=64*1024):
+    """Read (and decode) the request payload, up to about ``limit`` bytes.
+
+    Returns the data and a flag telling whether that is the whole payload.
+    If it isn't, the rest can be streamed with ``pipe_request_body()``.
+    """
+    chunks = []
+    size = 0
+    while size <= limit:
+        chunk = await request.content.readany()
+        if not chunk:
+            return b''.join(chunks), True
+        if decoder is None:
+            chunks.append(chunk)
+            size += len(chunk)
+            continue
+        for chunk in _inflate(decoder, chunk, chunk_size):
+            chunks.append(chunk)
+            size += len(chunk)
+    return b''.join(chunks), False
+
+
+async def pipe_request_body(request, stream, decoder=None,
+                            chunk_size=64*1024, prefix=b''):
+    """Copy the request payload into ``stream``, one chunk at a time.
+
+    Waits for ``stream`` to drain after each chunk so that a slow consumer
+    applies backpressure to the client instead of buffering the payload in
+    memory.  Works the same for ``Content-Length`` and chunked
+    ``Transfer-Encoding`` payloads.  When ``decoder`` is set (e.g. a
+    ``zlib.decompressobj``), the payload is decompressed on the fly.
+    ``prefix`` is the part of the (decoded) payload that was already read.
+    """
+    try:
+        if prefix:
+            stream.write(prefix)
+            await stream.drain()
+        while True:
+            chunk = await request.content.readany()
+            if not chunk:
+                break
+            if decoder is None:
+                chunks = [chunk]
+            else:
+                chunks = _inflate(decoder, chunk, chunk_size)
+            for chunk in chunks:
+                stream.write(chunk)
+                await stream.drain()
+    except (BrokenPipeError, ConnectionResetError, zlib.error):
+        # The process exited without reading all its input (or we can't
+        # decode the input), its exit status will tell the rest of the story.
+        pass
+    finally:
+        stream.close()
+
+
+async def read_cgi_head(stream):
+    """Parse the CGI header block, leaving ``stream`` at the response body.
+
+    Returns ``None`` if the stream ends before the end of the header block.
+    """
+    head = {}
+    while True:
+        line = await stream.readline()
+        if not line.endswith(b'\n'):
+            return None
+        line = line.rstrip(b'\r\n')
+        if not line:
+            return head
+        key, value = line.decode('utf-8').split(':', 1)
+        head[key.strip()] = value.strip()
+
+
+async def pipe_response_body(stream, response, chunk_size=64*1024,
+                             capture=None):
+    """Forward ``stream`` to the client as it is produced.
+
+    Waits for the response to drain after each chunk so that a slow client
+    applies backpressure to the process instead of buffering its output in
+    memory.  If ``capture`` is a list, chunks are also appended to it.
+    Returns the number of bytes forwarded.
+    """
+    size = 0
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            return size
+        response.write(chunk)
+        await response.drain()
+        if capture is not None:
+            capture.append(chunk)
+        size += len(chunk)
+
+
+async def query_maintenance(request):
+    """."""
+
+    # Validate request.
+    name = request.match_info['name']
+
+    # Check that the repository exists.
     storage = request.app['gitmesh.storage']
-    repo = storage.open_repo(name, bare=True)
+    exists = await storage.repository_exists(name)
+    if not exists:
+        raise web.HTTPNotFound
+
+    # Format response.
+    maintenance = request.app['gitmesh.maintenance']
+    return web.json_response(MaintenanceDetails(
+        await maintenance.state(name),
+    ))
+
+
+async def start_maintenance(request):
+    """."""
+
+    log = request.app['gitmesh.event_log']
+
+    # Validate request.
+    name = request.match_info['name']
+
+    # Check that the repository exists.
+    storage = request.app['gitmesh.storage']
+    exists = await storage.repository_exists(name)
+    if not exists:
+        raise web.HTTPNotFound
+
+    log.info('repository.maintain', name=name)
+
+    # Start maintenance in the background.
+    maintenance = request.app['gitmesh.maintenance']
+    await maintenance.schedule(name)
+
+    # Format response.
+    return web.json_response(
+        MaintenanceDetails(await maintenance.state(name)),
+        status=202,
+    )
+
+
+class _Lane(object):
+    """Admission state for one class of Git processes."""
+
+    def __init__(self, concurrency, queue_size):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.queued = 0
+        self.queues = OrderedDict()  # repository name -> deque of waiters.
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'queue_size': self.queue_size,
+            'running': self.running,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+        }
+
+
+class _Slot(object):
+
+    def __init__(self, scheduler, kind, name):
+        self._scheduler = scheduler
+        self._kind = kind
+        self._name = name
+
+    async def __aenter__(self):
+        await self._scheduler.acquire(self._kind, self._name)
+
+    async def __aexit__(self, *args):
+        self._scheduler.release(self._kind)
+
+
+class Scheduler(object):
+    """Admission control for Git processes.
+
+    Each class of processes (``push``, ``fetch`` and ``advertise``) has a
+    cap on the number of processes that run concurrently and a bounded wait
+    queue.  Waiting requests are admitted round-robin across repositories so
+    that a clone storm on one repository doesn't starve the others.  When a
+    queue is full, requests are rejected right away with ``503`` and a
+    ``Retry-After`` hint.
+    """
+
+    KINDS = ('push', 'fetch', 'advertise')
+
+    def __init__(self, limits=None, retry_after=5, clock=None):
+        cpus = os.cpu_count() or 1
+        defaults = {
+            'push': (cpus, 64),
+            'fetch': (cpus, 64),
+            'advertise': (2 * cpus, 64),
+        }
+        defaults.update(limits or {})
+        self._lanes = {
+            kind: _Lane(*defaults[kind]) for kind in self.KINDS
+        }
+        self._retry_after = retry_after
+        self._clock = clock or timeit.default_timer
+
+    def slot(self, kind, name):
+        """``async with`` a slot to run a process of ``kind`` for ``name``."""
+        return _Slot(self, kind, name)
+
+    async def acquire(self, kind, name):
+        lane = self._lanes[kind]
+        if lane.running < lane.concurrency and lane.queued == 0:
+            lane.running += 1
+            lane.admitted += 1
+            return
+        if lane.queued >= lane.queue_size:
+            lane.rejected += 1
+            raise web.HTTPServiceUnavailable(headers={
+                'Retry-After': str(self._retry_after),
+            })
+        waiter = asyncio.Future()
+        lane.queues.setdefault(name, deque()).append(waiter)
+        lane.queued += 1
+        ref = self._clock()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self._dequeue(lane, name, waiter)
+            else:
+                self.release(kind)
+            raise
+        wait_time = self._clock() - ref
+        lane.wait_time_total += wait_time
+        lane.wait_time_max = max(lane.wait_time_max, wait_time)
+
+    def _dequeue(self, lane, name, waiter):
+        queue = lane.queues.get(name)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            lane.queued -= 1
+            if not queue:
+                del lane.queues[name]
+
+    def release(self, kind):
+        lane = self._lanes[kind]
+        lane.running -= 1
+        while lane.queued and lane.running < lane.concurrency:
+            # Serve repositories in turns.
+            name, queue = next(iter(lane.queues.items()))
+            waiter = queue.popleft()
+            lane.queued -= 1
+            if queue:
+                lane.queues.move_to_end(name)
+            else:
+                del lane.queues[name]
+            if waiter.done():
+                continue
+            lane.running += 1
+            lane.admitted += 1
+            waiter.set_result(None)
+
+    def stats(self):
+        return {
+            kind: lane.stats() for kind, lane in self._lanes.items()
+        }
+
+
+GIT_SERVICES = ('git-upload-pack', 'git-receive-pack')
+"""Smart HTTP services we serve without going through ``git http-backend``.
+"""
+
+PKT_FLUSH = b'0000'
+
+NO_CACHE_HEADERS = {
+    'Expires': 'Fri, 01 Jan 1980 00:00:00 GMT',
+    'Pragma': 'no-cache',
+    'Cache-Control': 'no-cache, max-age=0, must-revalidate',
+}
+
+
+def pkt_line(data):
+    """Encode ``data`` as a Git pkt-line."""
+    return ('%04x' % (len(data) + 4)).encode('ascii') + data
+
+
+async def _open_repo(request, name):
+    storage = request.app['gitmesh.storage']
+    try:
+        return await storage.find_repo(name)
+    except UnknownRepository:
+        raise web.HTTPNotFound
+
+
+def _service_headers(service, advertise):
+    headers = {
+        'Content-Type': 'application/x-%s-%s' % (
+            service, 'advertisement' if advertise else 'result',
+        ),
+    }
+    headers.update(NO_CACHE_HEADERS)
+    return headers
+
+
+def _service_announcement(service, protocol=None):
+    # Protocol v2 responses start with the capability advertisement (pushes
+    # don't support v2 yet and fall back to v0).
+    if service == 'git-upload-pack' and protocol_version(protocol) == 2:
+        return b''
+    return pkt_line(('# service=%s\n' % service).encode('utf-8')) + PKT_FLUSH
+
+
+_GIT_PROTOCOL = re.compile(r'^[0-9A-Za-z=:._-]+$')
+
+
+def _git_protocol(request):
+    """Validated ``Git-Protocol`` header (``None`` if missing or invalid)."""
+    protocol = request.headers.get('Git-Protocol')
+    if protocol and _GIT_PROTOCOL.match(protocol):
+        return protocol
+    return None
+
+
+def protocol_version(protocol):
+    """Git protocol version requested in a ``Git-Protocol`` header."""
+    version = 0
+    for parameter in (protocol or '').split(':'):
+        key, _, value = parameter.partition('=')
+        if key == 'version' and value.isdigit():
+            version = max(version, int(value))
+    return version
+
+
+def _hook_env(request):
+    """Tell hooks where the hook daemon and the work queue are.
+
+    See ``gitmesh.hookclient`` and ``gitmesh.workqueue``.
+    """
+    env = {
+        REPOSITORY_VAR: request.match_info['name'],
+        QUEUE_VAR: request.app['gitmesh.queue'].path,
+    }
+    hooks = request.app['gitmesh.hooks']
+    if hooks is not None:
+        env[SOCKET_VAR] = hooks.path
+    return env
+
+
+def _service_env(request):
+    env = {
+        # Same identity as `git http-backend` uses for reflogs.
+        'GIT_COMMITTER_NAME': 'acaron',
+        'GIT_COMMITTER_EMAIL': 'acaron@http.%s' % (
+            request.transport.get_extra_info('peername')[0],
+        ),
+        # Custom.
+        'GITMESH_REQUEST_ID': request['x-request-id'],
+    }
+    protocol = _git_protocol(request)
+    if protocol:
+        env['GIT_PROTOCOL'] = protocol
+    env.update(_hook_env(request))
+    return env
+
+
+def _bundle_env(request, repo, bundle):
+    """Have ``git-upload-pack`` advertise ``bundle`` via bundle-uri.
+
+    Only clients speaking protocol v2 ask for bundle URIs.
+    """
+    if bundle is None:
+        return {}
+    config = [
+        ('uploadpack.advertiseBundleURIs', 'true'),
+        ('bundle.version', '1'),
+        ('bundle.mode', 'all'),
+        ('bundle.latest.uri', _bundle_url(request, repo.name, bundle)),
+    ]
+    env = {'GIT_CONFIG_COUNT': str(len(config))}
+    for i, (key, value) in enumerate(config):
+        env['GIT_CONFIG_KEY_%d' % i] = key
+        env['GIT_CONFIG_VALUE_%d' % i] = value
+    return env
+
+
+def _service_kind(service, advertise):
+    if advertise:
+        return 'advertise'
+    if service == 'git-receive-pack':
+        return 'push'
+    return 'fetch'
+
+
+async def run_git_service(request, repo, service, advertise=False,
+                          capture=None, decoder=None, prefix=b''):
+    """Serve a smart HTTP request by running the Git service directly.
+
+    When ``advertise`` is true, this serves the ``info/refs`` ref
+    advertisement for ``service``, otherwise it streams the request body to
+    the service in stateless RPC mode and streams its output back.  If
+    ``capture`` is a list, the service's output is also appended to it.
+    ``decoder`` and ``prefix`` are forwarded to ``pipe_request_body()``.
+
+    The service only starts once the scheduler admits it.  Its exit status
+    is stored in ``request['git-returncode']``.
+    """
+    scheduler = request.app['gitmesh.scheduler']
+    async with scheduler.slot(_service_kind(service, advertise), repo.name):
+        return await _run_git_service(
+            request, repo, service, advertise, capture, decoder, prefix,
+        )
+
+
+async def _run_git_service(request, repo, service, advertise,
+                           capture, decoder, prefix):
+
+    log = request.app['gitmesh.event_log']
+
+    command = ['git', service[4:], '--stateless-rpc']
+    if advertise:
+        command.append('--advertise-refs')
+    command.append('.')
+
+    env = _service_env(request)
+    if service == 'git-upload-pack':
+        env.update(_bundle_env(
+            request, repo,
+            await request.app['gitmesh.bundles'].latest(repo.name),
+        ))
+
+    log.info('git-service.run', service=service, advertise=advertise)
+    process = await repo.start(
+        command,
+        env=env,
+        base_env=request.app['gitmesh.environ'],
+        split=True,
+    )
+    feed = asyncio.ensure_future(pipe_request_body(
+        request, process.stdin, decoder, prefix=prefix,
+    ))
+    errors = asyncio.ensure_future(process.stderr.read())
+    try:
+        # Don't commit to a successful response until the service has
+        # produced some output.
+        chunk = await process.stdout.read(64*1024)
+        if not chunk:
+            await feed
+            returncode = await process.wait()
+            request['git-returncode'] = returncode
+            if returncode != 0:
+                log.info('git-service.fail', service=service,
+                         returncode=returncode, errors=await errors)
+                raise web.HTTPInternalServerError
+
+        # Forward the response as it is produced.
+        response = web.StreamResponse(
+            headers=_service_headers(service, advertise),
+        )
+        await response.prepare(request)
+        if advertise:
+            response.write(_service_announcement(
+                service, _git_protocol(request),
+            ))
+        response.write(chunk)
+        await response.drain()
+        if capture is not None:
+            capture.append(chunk)
+        size = len(chunk) + await pipe_response_body(
+            process.stdout, response, capture=capture,
+        )
+        await response.write_eof()
+        await feed
+        returncode = await process.wait()
+        request['git-returncode'] = returncode
+        log.info('git-service.done', service=service, size=size,
+                 returncode=returncode, errors=await errors)
+        if returncode != 0 and capture is not None:
+            del capture[:]
+        return response
+    finally:
+        # Don't leave the process behind if the client went away.
+        if process.returncode is None:
+            kill_process(process)
+            await process.wait()
+        feed.cancel()
+        errors.cancel()
+
+
+async def git_info_refs(request):
+    """Smart HTTP ref advertisement (falls back to dumb HTTP)."""
+
+    # Validate request.
+    name = request.match_info['name']
+    service = request.GET.get('service')
+    repo = await _open_repo(request, name)
+    if service not in GIT_SERVICES:
+        return await serve_static_file(
+            request, os.path.join(repo.path, 'info', 'refs'),
+            'text/plain', immutable=False,
+        )
+
+    # Serve from cache when refs haven't changed since we last ran Git.  The
+    # advertised bundle is part of protocol v2 advertisements.
+    cache = request.app['gitmesh.refs_cache']
+    protocol = _git_protocol(request)
+    fingerprint = (
+        await request.app['gitmesh.storage'].ref_state(repo),
+        await request.app['gitmesh.bundles'].latest(repo.name),
+    )
+    data = cache.get(name, service, fingerprint, protocol)
+    if data is not None:
+        return web.Response(
+            headers=_service_headers(service, advertise=True),
+            body=_service_announcement(service, protocol) + data,
+        )
+
+    capture = []
+    response = await run_git_service(
+        request, repo, service, advertise=True, capture=capture,
+    )
+    if capture:
+        cache.put(name, service, fingerprint, b''.join(capture), protocol)
+    return response
+
+
+async def git_service_rpc(request):
+    """Smart HTTP stateless RPC for fetches and pushes."""
+
+    # Validate request.
+    name = request.match_info['name']
+    service = request.match_info['service']
+    if request.content_type != 'application/x-%s-request' % service:
+        raise web.HTTPUnsupportedMediaType
+    repo = await _open_repo(request, name)
+    decoder = _request_decoder(request)
+
+    if service == 'git-upload-pack':
+        cache = request.app['gitmesh.pack_cache']
+        if cache is None:
+            return await run_git_service(
+                request, repo, service, decoder=decoder,
+            )
+        return await run_cached_upload_pack(request, repo, cache, decoder)
+
+    try:
+        response = await run_git_service(
+            request, repo, service, decoder=decoder,
+        )
+    finally:
+        request.app['gitmesh.refs_cache'].invalidate(name)
+    # Pushes that failed (or never ran) don't get bundles, maintenance, etc.
+    if request.get('git-returncode') == 0:
+        for push_listener in request.app['gitmesh.push_listeners']:
+            push_listener(name)
+    return response
+
+
+class _Rejected(Exception):
+    """The scheduler turned down a shared upload-pack producer."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+async def run_cached_upload_pack(request, repo, cache, decoder):
+    """Serve ``git-upload-pack`` from the pack cache.
+
+    Identical requests for the same ref state get the same response, so
+    they're served from disk when possible, and share a single upload-pack
+    process otherwise.  Requests too large to be worth hashing bypass the
+    cache.
+
+    With protocol v2, each request runs a single command (``ls-refs`` or
+    ``fetch``) and both are cached the same way: the response only depends
+    on the ref state, the advertised bundle and the request body, which
+    all go into the key.  A v2 clone thus makes two cache lookups.
+    """
+
+    log = request.app['gitmesh.event_log']
+    service = 'git-upload-pack'
+
+    fingerprint = await request.app['gitmesh.storage'].ref_state(repo)
+    try:
+        body, complete = await read_request_body(request, decoder)
+    except zlib.error:
+        raise web.HTTPBadRequest
+    if not complete:
+        return await run_git_service(
+            request, repo, service, decoder=decoder, prefix=body,
+        )
+    # The advertised bundle is part of the response.
+    bundle = await request.app['gitmesh.bundles'].latest(repo.name)
+    key = cache.key(
+        repo.name, (fingerprint, bundle, _git_protocol(request)), body,
+    )
+    env = _service_env(request)
+    env.update(_bundle_env(request, repo, bundle))
+    scheduler = request.app['gitmesh.scheduler']
+
+    async def produce(write):
+        try:
+            async with scheduler.slot('fetch', repo.name):
+                await _produce(write)
+        except web.HTTPServiceUnavailable as error:
+            # Requests following this producer each get their own response.
+            raise _Rejected(error.headers['Retry-After'])
+
+    async def _produce(write):
+        log.info('git-service.run', service=service, cache=key)
+        output = repo.stream(
+            ['git', 'upload-pack', '--stateless-rpc', '.'],
+            env=env, base_env=request.app['gitmesh.environ'], input=body,
+        )
+        size = 0
+        try:
+            async for chunk in output:
+                await write(chunk)
+                size += len(chunk)
+        except CalledProcessError as error:
+            log.info('git-service.fail', service=service, size=size,
+                     returncode=error.returncode, errors=error.output,
+                     cache=key)
+            raise
+        finally:
+            await output.close()
+        log.info('git-service.done', service=service, size=size, cache=key)
+
+    response = web.StreamResponse(
+        headers=_service_headers(service, advertise=False),
+    )
+
+    async def consume(chunk):
+        if not response.prepared:
+            await response.prepare(request)
+        response.write(chunk)
+        await response.drain()
+
+    try:
+        await cache.fetch(key, produce, consume)
+    except _Rejected as error:
+        raise web.HTTPServiceUnavailable(headers={
+            'Retry-After': error.retry_after,
+        })
+    except CalledProcessError:
+        if not response.prepared:
+            raise web.HTTPInternalServerError
+        raise
+    if not response.prepared:
+        await response.prepare(request)
+    await response.write_eof()
+    return response
+
+
+STATIC_FILES = [
+    (re.compile(r'^/HEAD$'), 'text/plain', False),
+    (re.compile(r'^/info/refs$'), 'text/plain', False),
+    (re.compile(r'^/objects/info/(?:alternates|http-alternates)$'),
+     'text/plain', False),
+    (re.compile(r'^/objects/info/packs$'),
+     'text/plain; charset=utf-8', False),
+    (re.compile(r'^/objects/[0-9a-f]{2}/[0-9a-f]{38}$'),
+     'application/x-git-loose-object', True),
+    (re.compile(r'^/objects/pack/pack-[0-9a-f]{40}\.pack$'),
+     'application/x-git-packed-objects', True),
+    (re.compile(r'^/objects/pack/pack-[0-9a-f]{40}\.idx$'),
+     'application/x-git-packed-objects-toc', True),
+    (re.compile(r'^/%s/[0-9a-f]{32}\.bundle$' % BUNDLES_DIR),
+     'application/x-git-bundle', True),
+]
+"""Dumb HTTP files (and clone bundles) we serve straight from the repository.
+
+Each entry has a path pattern, a content type and a flag telling whether
+the file is content-addressed (i.e. never changes).
+"""
+
+IMMUTABLE_HEADERS = {
+    'Cache-Control': 'public, max-age=31536000, immutable',
+}
+
+
+def _static_file(path):
+    for pattern, content_type, immutable in STATIC_FILES:
+        if pattern.match(path):
+            return content_type, immutable
+    return None
+
+
+def etag_matches(header, etag):
+    """Check an ``If-None-Match`` header against ``etag``."""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in header.split(',')]
+    return any(
+        (tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags
+    )
+
+
+def parse_range(header, size):
+    """Parse a single ``bytes`` range into ``(start, end)`` (inclusive).
+
+    Returns ``None`` when there is no range or when we don't support it, in
+    which case the whole file should be served.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, sep, end = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if start:
+            start = int(start)
+            end = int(end) if end else size - 1
+        else:
+            start = max(0, size - int(end))
+            end = size - 1 if int(end) > 0 else -1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={
+            'Content-Range': 'bytes */%d' % size,
+        })
+    return start, end
+
+
+def _sendfile_cb(fut, out_fd, in_fd, offset, count, loop, registered):
+    if registered:
+        loop.remove_writer(out_fd)
+    try:
+        n = os.sendfile(out_fd, in_fd, offset, count)
+        if n == 0:  # EOF reached
+            n = count
+    except (BlockingIOError, InterruptedError):
+        n = 0
+    except Exception as exc:
+        fut.set_exception(exc)
+        return
+    if n < count:
+        loop.add_writer(out_fd, _sendfile_cb, fut, out_fd, in_fd,
+                        offset + n, count - n, loop, True)
+    else:
+        fut.set_result(None)
+
+
+async def sendfile(request, response, stream, offset, count,
+                   chunk_size=256*1024):
+    """Send ``count`` bytes of ``stream``, starting at ``offset``.
+
+    Uses the ``sendfile`` system call so that file contents never go through
+    Python, unless it's not available (or the connection uses TLS), in
+    which case the file is sent in chunks.
+    """
+    transport = request.transport
+    if not hasattr(os, 'sendfile') or \
+       transport.get_extra_info('sslcontext'):  # pragma: no cover
+        stream.seek(offset)
+        while count > 0:
+            chunk = stream.read(min(count, chunk_size))
+            if not chunk:
+                break
+            response.write(chunk)
+            await response.drain()
+            count -= len(chunk)
+        return
+
+    # Make sure the headers are out before we write to the socket.
+    await response.drain()
+
+    loop = asyncio.get_event_loop()
+    out_fd = transport.get_extra_info('socket').fileno()
+    fut = asyncio.Future()
+    _sendfile_cb(fut, out_fd, stream.fileno(), offset, count, loop, False)
+    await fut
+
+
+def _open_static_file(path):
+    stream = open(path, 'rb')
+    return stream, os.fstat(stream.fileno())
+
+
+async def serve_static_file(request, path, content_type, immutable):
+    """Serve a file with ``ETag``, ``Range`` and caching support."""
+    executor = request.app['gitmesh.storage'].executor
+    try:
+        stream, st = await executor.call('static', _open_static_file, path)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        raise web.HTTPNotFound
+    with stream:
+        size = st.st_size
+        if immutable:
+            # The file name is the hash of its contents.
+            etag = '"%s"' % os.path.basename(path)
+        else:
+            etag = '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, size)
+        headers = {'ETag': etag}
+        headers.update(IMMUTABLE_HEADERS if immutable else NO_CACHE_HEADERS)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            raise web.HTTPNotModified(headers=headers)
+        headers['Content-Type'] = content_type
+        headers['Accept-Ranges'] = 'bytes'
+
+        # Serve part of the file if asked to (and it hasn't changed).
+        status = 200
+        offset, count = 0, size
+        if request.headers.get('If-Range', etag) == etag:
+            byte_range = parse_range(request.headers.get('Range'), size)
+            if byte_range is not None:
+                status = 206
+                offset = byte_range[0]
+                count = byte_range[1] - byte_range[0] + 1
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    byte_range[0], byte_range[1], size,
+                )
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = count
+        response.set_tcp_cork(True)
+        try:
+            await response.prepare(request)
+            if count:
+                await sendfile(request, response, stream, offset, count)
+        finally:
+            response.set_tcp_nodelay(True)
+        return response
+
+
+async def git_http_endpoint(request):
+    """Static files are served directly, everything else Git asks for goes
+    through ``git http-backend``."""
+
+    # Validate request.
+    name = request.match_info['name']
+    path = request.match_info['path']
+
+    static_file = _static_file(path)
+    if static_file is not None and request.method == 'GET':
+        repo = await _open_repo(request, name)
+        return await serve_static_file(
+            request, repo.path + path, *static_file
+        )
+
+    return await run_http_backend(request, name, path)
+
+
+async def run_http_backend(request, name, path):
+
+    repo = await _open_repo(request, name)
 
     # TODO:
     # - authenticate on POST.
-    env = dict(os.environ.items())
-    env.update({
-        'CONTENT_LENGTH': str(len(data)),
+    env = {
         'CONTENT_TYPE': request.content_type,
         'GATEWAY_INTERFACE': 'CGI/1.1',
         'PATH_INFO': path,
@@ -310,7 +1672,15 @@ async def git_http_endpoint(request):
         # 'SERVER_SOFTWARE': '',
         # Custom.
         'GITMESH_REQUEST_ID': request['x-request-id'],
-    })
+    }
+    # NOTE: `git http-backend` turns this into `GIT_PROTOCOL`.
+    protocol = _git_protocol(request)
+    if protocol:
+        env['HTTP_GIT_PROTOCOL'] = protocol
+    # NOTE: chunked requests have no length, in which case Git reads the
+    #       request body until EOF.
+    if request.content_length is not None:
+        env['CONTENT_LENGTH'] = str(request.content_length)
     # env.update({
     # 'HTTP_'
     # })
@@ -318,32 +1688,61 @@ async def git_http_endpoint(request):
         'GIT_PROJECT_ROOT': '.',
         'GIT_HTTP_EXPORT_ALL': '1',
     })
+    env.update(_hook_env(request))
+
+    # Execute the CGI script, streaming the request body to it.
+    scheduler = request.app['gitmesh.scheduler']
+    async with scheduler.slot('fetch', name):
+        return await _run_http_backend(request, repo, env)
+
+
+async def _run_http_backend(request, repo, env):
+
+    log = request.app['gitmesh.event_log']
 
-    # Execute the CGI script.
     log.info('git-http-backend.run')
-    output, errors = await repo.run(
-        'git http-backend',
-        input=data,
-        binary=True,
+    process = await repo.start(
+        ['git', 'http-backend'],
         env=env,
+        base_env=request.app['gitmesh.environ'],
         split=True,
     )
-
-    # Format response.
-    head, body = output.split(b'\r\n\r\n', 1)
-    head = dict(
-        line.split(':', 1)
-        for line in head.decode('utf-8').split('\r\n')
-    )
-    status = head.get('Status', '200 OK').strip()
-    status = int(status.split(' ', 1)[0])
-    log.info('git-http-backend.done',
-             status=status, errors=errors, head=head)
-    return web.Response(status=status, headers=head, body=body)
+    feed = asyncio.ensure_future(pipe_request_body(request, process.stdin))
+    errors = asyncio.ensure_future(process.stderr.read())
+    try:
+        # Forward the response as it is produced.
+        head = await read_cgi_head(process.stdout)
+        if head is None:
+            await feed
+            returncode = await process.wait()
+            log.info('git-http-backend.fail',
+                     returncode=returncode, errors=await errors)
+            raise web.HTTPInternalServerError
+        status = head.pop('Status', '200 OK')
+        status = int(status.split(' ', 1)[0])
+        response = web.StreamResponse(status=status, headers=head)
+        await response.prepare(request)
+        size = await pipe_response_body(process.stdout, response)
+        await response.write_eof()
+        await feed
+        returncode = await process.wait()
+        log.info('git-http-backend.done', status=status, size=size,
+                 returncode=returncode, errors=await errors, head=head)
+        return response
+    finally:
+        # Don't leave the process behind if the client went away.
+        if process.returncode is None:
+            kill_process(process)
+            await process.wait()
+        feed.cancel()
+        errors.cancel()
 
 
 async def serve_until(cancel, *, storage, host, port, linger=1.0, log=None,
-                      loop=None):
+                      loop=None, pack_cache_size=1024**3, scheduler=None,
+                      maintenance=None, bundles=None, reaper=None,
+                      batch_concurrency=16, imports=None, hooks=None,
+                      queue=None):
     log = log or structlog.get_logger()
     loop = loop or asyncio.get_event_loop()
 
@@ -354,28 +1753,85 @@ async def serve_until(cancel, *, storage, host, port, linger=1.0, log=None,
     ])
     app.on_response_prepare.append(echo_request_id)
     app.router.add_route('GET', '/', index, name='index')
+    app.router.add_route('GET', '/metrics', metrics, name='metrics')
     app.router.add_route('GET', '/repositories',
                          list_repositories, name='list-repositories')
     app.router.add_route('POST', '/repositories',
                          create_repository, name='create-repository')
+    app.router.add_route('POST', '/repositories:batch',
+                         batch_repositories, name='batch-repositories')
+    app.router.add_route('GET', '/repositories/{name}.git/info/refs',
+                         git_info_refs, name='git-info-refs')
+    app.router.add_route('POST', '/repositories/{name}.git/'
+                         '{service:git-(?:upload|receive)-pack}',
+                         git_service_rpc, name='git-service-rpc')
     app.router.add_route('*', '/repositories/{name}.git{path:.+}',
                          git_http_endpoint, name='git-http-endpoint')
     app.router.add_route('GET', '/repositories/{name}',
                          query_repository, name='get-repository')
     app.router.add_route('DELETE', '/repositories/{name}',
                          delete_repository, name='delete-repository')
+    app.router.add_route('GET', '/jobs/{id}', query_job, name='get-job')
+    app.router.add_route('DELETE', '/jobs/{id}', cancel_job, name='cancel-job')
+    app.router.add_route('POST', '/repositories/{name}/forks',
+                         fork_repository, name='fork-repository')
+    app.router.add_route('GET', '/repositories/{name}/maintenance',
+                         query_maintenance, name='get-maintenance')
+    app.router.add_route('POST', '/repositories/{name}/maintenance',
+                         start_maintenance, name='start-maintenance')
+    app.router.add_route('GET', '/repositories/{name}/settings',
+                         query_settings, name='get-settings')
+    app.router.add_route('PATCH', '/repositories/{name}/settings',
+                         update_settings, name='update-settings')
 
     # Inject context.
     app['gitmesh.event_log'] = log
     app['gitmesh.storage'] = storage
     app['gitmesh.clock'] = timeit.default_timer
+    app['gitmesh.environ'] = dict(os.environ)
+    app['gitmesh.refs_cache'] = RefAdvertisementCache()
+    app['gitmesh.scheduler'] = scheduler or Scheduler()
+    app['gitmesh.batch_concurrency'] = batch_concurrency
+    app['gitmesh.pack_cache'] = None
+    if pack_cache_size:
+        app['gitmesh.pack_cache'] = PackCache(
+            os.path.join(storage.path, '.cache', 'packs'),
+            max_size=pack_cache_size, executor=storage.executor,
+        )
+    maintenance = maintenance or Maintenance(storage, log=log)
+    app['gitmesh.maintenance'] = maintenance
+    bundles = bundles or Bundles(storage, log=log)
+    app['gitmesh.bundles'] = bundles
+    reaper = reaper or Reaper(storage, log=log)
+    app['gitmesh.reaper'] = reaper
+    imports = imports or Imports(storage, reaper=reaper, log=log)
+    app['gitmesh.imports'] = imports
+    app['gitmesh.hooks'] = hooks
+    queue = queue or WorkQueue(
+        storage, runner=hooks and hooks.run, log=log,
+    )
+    app['gitmesh.queue'] = queue
+    app['gitmesh.push_listeners'] = [
+        storage.notify_push,
+        maintenance.notify_push,
+        bundles.notify_push,
+        queue.notify_push,
+    ]
+
+    # Start background work (hook workers first, they fork).
+    if hooks is not None:
+        await hooks.start()
+    maintenance_task = loop.create_task(maintenance.run())
+    reaper_task = loop.create_task(reaper.run())
+    queue_task = loop.create_task(queue.run())
+    watching = storage.watch(loop=loop)
 
     # Start accepting connections.
     handler = app.make_handler()
     log.info(event='bind', transport='tcp', host=host, port=port)
     server = await loop.create_server(handler, host, port)
     try:
-        log.info(event='ready')
+        log.info(event='ready', watching=watching)
         await cancel
     finally:
         log.info(event='shutdown', linger=linger, expected=cancel.done())
@@ -383,4 +1839,18 @@ async def serve_until(cancel, *, storage, host, port, linger=1.0, log=None,
         await server.wait_closed()
         await handler.finish_connections(linger)
         await app.finish()
+        maintenance_task.cancel()
+        await asyncio.wait([maintenance_task])
+        await maintenance.close()
+        await bundles.close()
+        await imports.close()
+        queue_task.cancel()
+        await asyncio.wait([queue_task])
+        await queue.close()
+        if hooks is not None:
+            await hooks.close()
+        reaper.close()
+        reaper_task.cancel()
+        await asyncio.wait([reaper_task])
+        storage.close()
         log.info(event='done')
@@ -2,14 +2,23 @@
 
 
 import asyncio
+import hashlib
 import os
+import shlex
+import signal
 import stat
-import shutil
 import sys
+import tempfile
+import timeit
+import uuid
+import weakref
 
 from asyncio import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, TimeoutExpired
+
+from gitmesh.index import RepositoryIndex, SHARD_DEPTH
 
 
 # TODO: make this work on Windows.
@@ -18,26 +27,135 @@ def resolve_script(name):
     return os.path.join(os.path.join(sys.exec_prefix, 'bin'), name)
 
 
-async def check_output(command, cwd=None, env={},
-                       input=None, binary=False, split=False):
-    if isinstance(command, list):
-        command = ' '.join([
-            '"%s"' % arg for arg in command
-        ])
-    cwd = cwd or os.getcwd()
-    env = {k: v for k, v in chain(os.environ.items(), env.items())}
-    process = await asyncio.create_subprocess_shell(
-        command,
-        cwd=cwd, env=env,
-        stdin=None if input is None else subprocess.PIPE,
+def _argv(command):
+    """Normalize ``command`` to an argument vector.
+
+    Strings are split using shell syntax, but no shell is involved.
+    """
+    if isinstance(command, str):
+        return shlex.split(command)
+    return list(command)
+
+
+def _environment(env, base_env):
+    """Compute the environment for a child process.
+
+    ``base_env`` defaults to ``os.environ`` and ``env`` overrides it.  Only
+    returns a new dictionary when there is something to override, the child
+    process inherits the environment as-is otherwise.
+    """
+    if env:
+        base_env = os.environ if base_env is None else base_env
+        return {k: v for k, v in chain(base_env.items(), env.items())}
+    return base_env
+
+
+def kill_process(process):
+    """Kill ``process`` and any process it started.
+
+    Only works for processes created with ``start_process()``, which places
+    each child in its own process group.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class OutputLimitExceeded(Exception):
+    """A command produced more output than its caller is willing to keep."""
+
+    def __init__(self, cmd, limit):
+        super().__init__(cmd, limit)
+        self.cmd = cmd
+        self.limit = limit
+
+
+async def start_process(command, cwd=None, env=None, split=False,
+                        base_env=None, stdin=subprocess.PIPE):
+    """Start a command with pipes connected to its standard streams.
+
+    The caller is responsible for feeding ``process.stdin``, consuming
+    ``process.stdout`` (and ``process.stderr`` when ``split`` is true) and
+    waiting for the process to exit.
+    """
+    return await asyncio.create_subprocess_exec(
+        *_argv(command),
+        cwd=cwd or os.getcwd(),
+        env=_environment(env, base_env),
+        stdin=stdin,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE if split else subprocess.STDOUT,
+        start_new_session=True,
     )
-    output, errors = await process.communicate(input)
+
+
+async def write_and_close(stream, data):
+    """Feed ``data`` to a process' input stream, then close it."""
+    try:
+        stream.write(data)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The process exited without reading all its input, its exit status
+        # will tell the rest of the story.
+        pass
+    finally:
+        stream.close()
+
+
+async def _read_all(stream, limit, cmd, chunk_size=64*1024):
+    chunks = []
+    size = 0
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if limit is not None and size > limit:
+            raise OutputLimitExceeded(cmd, limit)
+        chunks.append(chunk)
+
+
+async def check_output(command, cwd=None, env=None, input=None,
+                       binary=False, split=False, base_env=None,
+                       timeout=None, limit=None, returncodes=(0,)):
+    """Run a command and collect its output.
+
+    When ``timeout`` (in seconds) expires, the process and anything it
+    started are killed and ``subprocess.TimeoutExpired`` is raised.  When
+    the output exceeds ``limit`` bytes, the process is killed and
+    ``OutputLimitExceeded`` is raised.  Exit statuses other than
+    ``returncodes`` raise ``subprocess.CalledProcessError``.
+    """
+    command = _argv(command)
+    process = await start_process(
+        command, cwd=cwd, env=env, split=split, base_env=base_env,
+        stdin=None if input is None else subprocess.PIPE,
+    )
+
+    async def communicate():
+        readers = [_read_all(process.stdout, limit, command)]
+        if split:
+            readers.append(_read_all(process.stderr, limit, command))
+        if input is not None:
+            readers.append(write_and_close(process.stdin, input))
+        results = await asyncio.gather(*readers)
+        return results[0], (results[1] if split else None)
+
+    try:
+        output, errors = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_process(process)
+        await process.wait()
+        raise TimeoutExpired(command, timeout)
+    except OutputLimitExceeded:
+        kill_process(process)
+        await process.wait()
+        raise
     if not binary:
         output = output.decode('utf-8').strip()
     status = await process.wait()
-    if status != 0:
+    if status not in returncodes:
         print('OUTPUT:', output)
         raise CalledProcessError(status, command, output)
     if split:
@@ -46,75 +164,737 @@ async def check_output(command, cwd=None, env={},
         return output
 
 
+class OutputStream(object):
+    """Asynchronous iterator over the output of a command.
+
+    See ``stream_output()``.
+    """
+
+    def __init__(self, command, cwd=None, env=None, input=None,
+                 base_env=None, timeout=None, chunk_size=64*1024):
+        self._command = _argv(command)
+        self._cwd = cwd
+        self._env = env
+        self._input = input
+        self._base_env = base_env
+        self._timeout = timeout
+        self._chunk_size = chunk_size
+        self._deadline = None
+        self._process = None
+        self._tasks = []
+
+    @property
+    def process(self):
+        return self._process
+
+    def __aiter__(self):
+        return self
+
+    async def _start(self):
+        self._process = await start_process(
+            self._command, cwd=self._cwd, env=self._env, split=True,
+            base_env=self._base_env,
+            stdin=None if self._input is None else subprocess.PIPE,
+        )
+        if self._timeout is not None:
+            self._deadline = self._clock() + self._timeout
+        self._errors = asyncio.ensure_future(self._process.stderr.read())
+        self._tasks.append(self._errors)
+        if self._input is not None:
+            self._tasks.append(asyncio.ensure_future(
+                write_and_close(self._process.stdin, self._input)
+            ))
+
+    @staticmethod
+    def _clock():
+        return asyncio.get_event_loop().time()
+
+    async def __anext__(self):
+        if self._process is None:
+            await self._start()
+        timeout = None
+        if self._deadline is not None:
+            timeout = max(0.0, self._deadline - self._clock())
+        try:
+            chunk = await asyncio.wait_for(
+                self._process.stdout.read(self._chunk_size), timeout,
+            )
+        except asyncio.TimeoutError:
+            await self.close()
+            raise TimeoutExpired(self._command, self._timeout)
+        if chunk:
+            return chunk
+        status = await self._process.wait()
+        errors = await self._errors
+        if status != 0:
+            raise CalledProcessError(status, self._command, errors)
+        raise StopAsyncIteration
+
+    async def close(self):
+        """Kill the process, unless it exited already."""
+        if self._process is not None and self._process.returncode is None:
+            kill_process(self._process)
+            await self._process.wait()
+        for task in self._tasks:
+            task.cancel()
+
+
+def stream_output(command, cwd=None, env=None, input=None, base_env=None,
+                  timeout=None, chunk_size=64*1024):
+    """Run a command and iterate over its output as it is produced.
+
+    Use as ``async for chunk in stream_output(...)``.  Standard error is
+    collected separately and attached to the ``CalledProcessError`` raised
+    if the command fails.  Call ``close()`` when giving up on the output
+    early.
+    """
+    return OutputStream(command, cwd=cwd, env=env, input=input,
+                        base_env=base_env, timeout=timeout,
+                        chunk_size=chunk_size)
+
+
+REF_STAMP = 'gitmesh-refs'
+"""File touched by our post-receive hook whenever a push updates refs."""
+
+
+def _stat_state(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def ref_state(path):
+    """Compute a cheap fingerprint of the refs in the repository at ``path``.
+
+    Covers ``HEAD``, ``packed-refs``, our ref stamp and every directory under
+    ``refs/`` (updating a loose ref renames a lock file into place, which
+    changes the parent directory's mtime) without reading any refs.  Also
+    covers ``config``, which decides what refs get advertised (e.g.
+    ``transfer.hideRefs``).
+    """
+    state = [
+        _stat_state(os.path.join(path, 'HEAD')),
+        _stat_state(os.path.join(path, 'packed-refs')),
+        _stat_state(os.path.join(path, 'config')),
+    ]
+    try:
+        with open(os.path.join(path, REF_STAMP), 'r') as stream:
+            state.append(stream.read())
+    except FileNotFoundError:
+        state.append(None)
+    for root, _, _ in os.walk(os.path.join(path, 'refs')):
+        state.append((root, _stat_state(root)))
+    return tuple(state)
+
+
+def touch_ref_state(path):
+    """Change the ref state fingerprint of the repository at ``path``."""
+    stamp = os.path.join(path, REF_STAMP)
+    with open(stamp + '.tmp', 'w') as stream:
+        stream.write(uuid.uuid4().hex)
+    os.replace(stamp + '.tmp', stamp)
+
+
+LAYOUTS = ('flat', 'sharded')
+"""On-disk layouts: ``name.git`` or ``ab/cd/name.git`` (see ``shard()``)."""
+
+LAYOUT_FILE = '.gitmesh-layout'
+"""File, inside the storage folder, naming the layout for new repositories.
+"""
+
+TRASH_DIR = '.trash'
+"""Folder, inside the storage folder, where deleted repositories go."""
+
+FORKS_DIR = '.forks'
+"""Folder, inside the storage folder, where forks are put together."""
+
+PARENT_FILE = 'gitmesh-parent'
+"""File, inside each fork, naming the repository it borrows objects from."""
+
+FORKS_FILE = 'gitmesh-forks'
+"""File, inside each repository, listing forks borrowing its objects.
+
+Forks are recorded as they come and go (``+name`` and ``-name`` lines), so
+concurrent updates never have to rewrite the file (see ``_read_forks()``).
+"""
+
+ALTERNATES_FILE = os.path.join('objects', 'info', 'alternates')
+
+
+def _read_lines(path):
+    try:
+        with open(path) as stream:
+            return [line for line in stream.read().split('\n') if line]
+    except FileNotFoundError:
+        return []
+
+
+def _write_lines(path, lines):
+    """Replace the contents of ``path`` atomically (delete it if empty)."""
+    if not lines:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:  # pragma: no cover
+            pass
+        return
+    with open(path + '.tmp', 'w') as stream:
+        stream.write(''.join(line + '\n' for line in lines))
+    os.replace(path + '.tmp', path)
+
+
+def _append_line(path, line):
+    """Append ``line`` to ``path`` in a single ``write()``.
+
+    Appends to the same file never clobber each other, even across
+    processes, which rewriting the file (see ``_write_lines()``) can't say.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def _read_forks(path):
+    """Replay the ``+name``/``-name`` records of a ``FORKS_FILE``."""
+    forks = []
+    for line in _read_lines(path):
+        name = line[1:]
+        if name in forks:
+            forks.remove(name)
+        if line.startswith('+'):
+            forks.append(name)
+    return forks
+
+
+def shard(name):
+    """Compute the shard folder for repository ``name`` (e.g. ``ab/cd``)."""
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return os.path.join(*[
+        digest[2 * i:2 * i + 2] for i in range(SHARD_DEPTH)
+    ])
+
+
+class FileSystemExecutor(object):
+    """Bounded thread pool for blocking file system calls.
+
+    Keeps the event loop responsive when the storage folder is on a slow
+    disk (e.g. NFS).  At most ``max_workers`` calls run at once, and the
+    latency of each kind of operation (queueing included) is tracked.
+    """
+
+    def __init__(self, max_workers=4, clock=None):
+        self._max_workers = max_workers
+        self._clock = clock or timeit.default_timer
+        self._pool = None
+        self._ops = {}
+
+    async def call(self, op, fn, *args):
+        """Run ``fn(*args)`` in the pool, recording its latency as ``op``."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._max_workers)
+        stats = self._ops.setdefault(op, {
+            'count': 0,
+            'running': 0,
+            'time_total': 0.0,
+            'time_max': 0.0,
+        })
+        stats['running'] += 1
+        ref = self._clock()
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._pool, fn, *args)
+        finally:
+            duration = self._clock() - ref
+            stats['running'] -= 1
+            stats['count'] += 1
+            stats['time_total'] += duration
+            stats['time_max'] = max(stats['time_max'], duration)
+
+    def stats(self):
+        return {
+            'max_workers': self._max_workers,
+            'operations': {op: dict(stats) for op, stats in self._ops.items()},
+        }
+
+    def close(self):
+        """Release the threads (they are created again when needed)."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+class RepositoryTemplate(object):
+    """In-memory snapshot of a freshly initialized repository.
+
+    Stamping a copy of it only takes a few ``mkdir()``, ``write()`` and
+    ``symlink()`` calls, which is much faster than running ``git init``.
+    """
+
+    def __init__(self, entries):
+        self._entries = entries
+
+    @classmethod
+    def load(cls, path):
+        """Snapshot the repository at ``path`` (parent folders first)."""
+        entries = []
+        for root, folders, files in os.walk(path):
+            for name in folders + files:
+                src = os.path.join(root, name)
+                dst = os.path.relpath(src, path)
+                st = os.lstat(src)
+                if stat.S_ISLNK(st.st_mode):
+                    entries.append((dst, 'link', os.readlink(src), None))
+                elif stat.S_ISDIR(st.st_mode):
+                    entries.append((dst, 'folder', None, st.st_mode))
+                else:
+                    with open(src, 'rb') as stream:
+                        data = stream.read()
+                    entries.append((dst, 'file', data, st.st_mode))
+        return cls(entries)
+
+    def stamp(self, path):
+        """Populate (existing, empty) folder ``path`` with the snapshot."""
+        for dst, kind, data, mode in self._entries:
+            dst = os.path.join(path, dst)
+            if kind == 'link':
+                os.symlink(data, dst)
+            elif kind == 'folder':
+                os.mkdir(dst, stat.S_IMODE(mode))
+            else:
+                with open(dst, 'wb') as stream:
+                    stream.write(data)
+                os.chmod(dst, stat.S_IMODE(mode))
+
+
 class RepositoryExists(Exception):
     pass
 
 
+class InvalidRepositoryName(ValueError):
+    pass
+
+
+def check_name(name):
+    """Make sure ``name`` can be used as a repository name, returns it.
+
+    Names become folder names, so they can't contain ``/`` (or ``..``) and
+    can't start with ``.`` (those are hidden from the repository index).
+    """
+    if not name or name.startswith('.') or '..' in name or \
+       '/' in name or '\0' in name:
+        raise InvalidRepositoryName(name)
+    return name
+
+
 class UnknownRepository(Exception):
     pass
 
 
 class Storage(object):
-    def __init__(self, path):
+    """Folder full of bare repositories.
+
+    Repositories are either stored directly in the folder (flat layout) or
+    spread across shard folders (sharded layout).  Lookups check both
+    layouts, so the layout can be changed while the server runs (see
+    ``migrate()``).
+
+    Blocking file system calls made on behalf of coroutines go through
+    ``executor`` (see ``FileSystemExecutor``).
+    """
+
+    def __init__(self, path, executor=None):
         self._path = path
+        self._fs = executor or FileSystemExecutor()
+        self._templates = {}
+        self._parents = weakref.WeakValueDictionary()
+        self._layout = None
+        self._index = RepositoryIndex(path, on_change=self.bump)
+        self._epoch = uuid.uuid4().hex[:8]
+        self._generation = 0
 
     @property
     def path(self):
         return self._path
 
+    @property
+    def trash_path(self):
+        """Folder holding deleted repositories until they are reaped."""
+        return os.path.join(self._path, TRASH_DIR)
+
+    @property
+    def epoch(self):
+        """Random identifier for this ``Storage`` instance.
+
+        Generation numbers are only meaningful along with the epoch, since
+        they restart from zero each time the server starts.
+        """
+        return self._epoch
+
+    @property
+    def executor(self):
+        """Runs blocking file system calls (see ``FileSystemExecutor``)."""
+        return self._fs
+
+    @property
+    def generation(self):
+        """Number that increases whenever repositories change.
+
+        Covers repositories being created or deleted, pushes and anything
+        else reported through ``bump()``.  Repositories created or deleted
+        by other processes are covered once noticed (see ``refresh()``).
+        """
+        return self._generation
+
+    async def refresh(self):
+        """Notice repositories created or deleted by other processes.
+
+        Only touches the disk when the index isn't watching for changes
+        (see ``watch()``).
+        """
+        await self._fs.call('refresh', self._index.refresh)
+
+    def bump(self):
+        """Signal that something changed (see ``generation``)."""
+        self._generation += 1
+
+    def notify_push(self, name):
+        """Signal that repository ``name`` received a push."""
+        self.bump()
+
     async def run(self, *args, **kwds):
-        """Run a shell command inside the storage folder."""
+        """Run a command inside the storage folder."""
         return await check_output(*args, cwd=self._path, **kwds)
 
+    @property
+    def layout(self):
+        """Layout used for new repositories (see ``LAYOUTS``)."""
+        if self._layout is None:
+            try:
+                with open(os.path.join(self._path, LAYOUT_FILE)) as stream:
+                    self._layout = stream.read().strip()
+            except FileNotFoundError:
+                self._layout = 'flat'
+        return self._layout
+
+    def _layout_path(self, name, layout):
+        if layout == 'sharded':
+            return os.path.join(self._path, shard(name), name + '.git')
+        return os.path.join(self._path, name + '.git')
+
     def _repo_path(self, name, bare=True):
-        if bare:
-            return os.path.join(self._path, name + '.git')
-        else:
+        if not bare:
             return os.path.join(self._path, name)
+        # Look in the current layout first, then in the other one(s).
+        layouts = sorted(LAYOUTS, key=lambda layout: layout != self.layout)
+        for layout in layouts:
+            path = self._layout_path(name, layout)
+            if os.path.isdir(path):
+                return path
+        return self._layout_path(name, self.layout)
 
     async def create_repo(self, name, install_hooks=False):
-        """Create a new bare repository."""
-        path = self._repo_path(name)
+        """Create a new bare repository (from a template, see ``template()``).
+        """
+        template = await self.template(install_hooks=install_hooks)
+        path = await self._fs.call('create', self._create_folder, name)
+        await self._fs.call('index', self._index.add, name)
+        await self._fs.call('stamp', template.stamp, path)
+        return Repository(name, path, bare=True)
+
+    async def template(self, install_hooks=False):
+        """Template for new repositories (built once with ``git init``)."""
+        if install_hooks not in self._templates:
+            self._templates[install_hooks] = asyncio.ensure_future(
+                self._build_template(install_hooks),
+            )
+        try:
+            return await asyncio.shield(self._templates[install_hooks])
+        except Exception:
+            # Try again next time.
+            self._templates.pop(install_hooks, None)
+            raise
+
+    async def _build_template(self, install_hooks):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'template.git')
+            await check_output(['git', 'init', '--bare', path])
+            if install_hooks:
+                Repository('template', path, bare=True).install_hooks()
+            return await self._fs.call('template', RepositoryTemplate.load,
+                                       path)
+
+    def _create_folder(self, name):
+        check_name(name)
+        # The layout may have changed behind our back (see ``migrate()``).
+        self._layout = None
+        if os.path.isdir(self._repo_path(name)):
+            raise RepositoryExists
+        path = self._layout_path(name, self.layout)
+        if self.layout == 'sharded':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
         try:
             os.mkdir(path)
         except FileExistsError:
             raise RepositoryExists
-        await check_output(
-            'git init --bare',
-            cwd=path,
-        )
-        repository = Repository(name, path, bare=True)
+        return path
+
+    async def adopt_repo(self, name, path, install_hooks=False):
+        """Move the bare repository at ``path`` into the storage as ``name``.
+
+        ``path`` must be on the same file system (e.g. in the storage
+        folder), since the repository is renamed into place.
+        """
+        dst = await self._fs.call('create', self._create_folder, name)
+        # Atomically replaces the empty folder reserving the name.
+        await self._fs.call('adopt', os.rename, path, dst)
+        await self._fs.call('index', self._index.add, name)
+        repository = Repository(name, dst, bare=True)
         if install_hooks:
-            repository.install_hooks()
+            await self._fs.call('install_hooks', repository.install_hooks)
         return repository
 
     async def clone(self, link):
         """Clone an existing repository."""
         name = link.rsplit('/', 1)[1][:-4]
-        await check_output('git clone ' + link, cwd=self._path)
+        await check_output(['git', 'clone', link], cwd=self._path)
         return Repository(name, self._repo_path(name, bare=False), bare=False)
 
     async def repository_exists(self, name):
+        return await self._fs.call('exists', self._exists, name)
+
+    async def find_repo(self, name):
+        """Open bare repository ``name`` (raises ``UnknownRepository``)."""
+        return await self._fs.call('open', self._find_repo, name)
+
+    def _find_repo(self, name):
+        path = self._repo_path(name)
+        if not os.path.isdir(path):
+            raise UnknownRepository
+        return Repository(name, path, bare=True)
+
+    async def ref_state(self, repo):
+        """Compute ``repo.ref_state()`` without blocking the event loop."""
+        return await self._fs.call('ref_state', repo.ref_state)
+
+    def _exists(self, name):
         return os.path.isdir(self._repo_path(name))
 
-    async def list_repositories(self):
-        # TODO: run in background thread?
-        return [
-            name[:-4] for name in os.listdir(self._path)
-            if ((not name.startswith('.')) and
-                (os.path.isdir(os.path.join(self._path, name))))
-        ]
+    async def list_repositories(self, prefix='', after=None, limit=None):
+        """List repository names (in order) from the repository index.
+
+        See ``RepositoryIndex.names()``.
+        """
+        # Only touches the disk when the index isn't watching for changes.
+        await self._fs.call('list', self._index.refresh)
+        return self._index.names(prefix=prefix, after=after, limit=limit)
+
+    def iter_repositories(self, prefix='', after=None):
+        """Iterate over repository names (in order) from the repository index.
+
+        Doesn't touch the disk: repositories created or deleted by other
+        processes are only listed once noticed (see ``refresh()``).  See
+        ``RepositoryIndex.iter_names()``.
+        """
+        return self._index.iter_names(prefix=prefix, after=after,
+                                      refresh=False)
+
+    def watch(self, loop=None):
+        """Keep the repository index in sync with changes made by others."""
+        return self._index.watch(loop=loop)
+
+    def stats(self):
+        return self._fs.stats()
+
+    def close(self):
+        self._index.close()
+        self._fs.close()
 
     async def delete_repo(self, name):
-        """Delete a repository."""
+        """Delete a repository.
+
+        The repository is only renamed into the trash, which is instant no
+        matter its size.  Its files are deleted later (see ``Reaper``).
+        Forks borrowing its objects are detached first (see
+        ``detach_repo()``), which is not instant.
+        """
+        for fork in await self._fs.call('forks', self._forks, name):
+            try:
+                await self.detach_repo(fork)
+            except UnknownRepository:  # pragma: no cover
+                pass  # still being put together (see ``fork_repo()``).
+        await self._fs.call('delete', self._trash, name)
+        await self._fs.call('index', self._index.discard, name)
+
+    def _trash(self, name):
         path = self._repo_path(name)
         if not os.path.isdir(path):
             raise UnknownRepository
-        shutil.rmtree(path)
+        parent = _read_lines(os.path.join(path, PARENT_FILE))
+        os.makedirs(self.trash_path, exist_ok=True)
+        trash = '%s-%s' % (uuid.uuid4().hex, os.path.basename(path))
+        os.rename(path, os.path.join(self.trash_path, trash))
+        self._prune_shards(os.path.dirname(path))
+        if parent:
+            self._forget_fork(parent[0], name)
+
+    def _forks(self, name):
+        return _read_forks(os.path.join(self._repo_path(name), FORKS_FILE))
+
+    def _forget_fork(self, parent, name):
+        _append_line(os.path.join(self._repo_path(parent), FORKS_FILE),
+                     '-' + name)
+
+    def _link_fork(self, parent, name, path):
+        """Make ``name`` (at ``path``) borrow objects from ``parent``."""
+        objects = os.path.abspath(
+            os.path.join(self._repo_path(parent), 'objects'),
+        )
+        _write_lines(os.path.join(path, ALTERNATES_FILE), [objects])
+        _write_lines(os.path.join(path, PARENT_FILE), [parent])
+        _append_line(os.path.join(self._repo_path(parent), FORKS_FILE),
+                     '+' + name)
+
+    def _stage_fork(self, template):
+        """Stamp an empty repository in ``FORKS_DIR``, returns its path."""
+        staging = os.path.join(self._path, FORKS_DIR)
+        os.makedirs(staging, exist_ok=True)
+        path = os.path.join(staging, uuid.uuid4().hex + '.git')
+        os.mkdir(path)
+        template.stamp(path)
+        return path
+
+    def _discard_fork(self, path):
+        """Move a fork that couldn't be put together to the trash."""
+        os.makedirs(self.trash_path, exist_ok=True)
+        try:
+            os.rename(path, os.path.join(self.trash_path,
+                                         os.path.basename(path)))
+        except FileNotFoundError:  # pragma: no cover
+            pass  # adopted, then failed.
+
+    def _unlink_fork(self, name):
+        path = self._repo_path(name)
+        parent = _read_lines(os.path.join(path, PARENT_FILE))
+        _write_lines(os.path.join(path, ALTERNATES_FILE), [])
+        _write_lines(os.path.join(path, PARENT_FILE), [])
+        if parent:
+            self._forget_fork(parent[0], name)
+
+    async def fork_repo(self, parent, name, install_hooks=False):
+        """Create repository ``name`` as a fork of ``parent``.
+
+        The fork borrows the parent's objects through Git alternates, so
+        forking only copies refs, no matter how big the parent is.  The
+        parent is told to never prune objects, since its forks may still
+        need objects it no longer references.
+
+        The fork is put together in ``FORKS_DIR`` and only moved into place
+        (see ``adopt_repo()``) once its refs are copied.  If anything fails,
+        it goes to the trash and the parent forgets about it.
+        """
+        check_name(name)
+        source = await self.find_repo(parent)
+        if await self.repository_exists(name):
+            raise RepositoryExists
+        template = await self.template(install_hooks=install_hooks)
+        path = await self._fs.call('fork', self._stage_fork, template)
+        try:
+            repo = Repository(name, path, bare=True)
+            refs = await source.run([
+                'git', 'for-each-ref',
+                '--format=create %(refname) %(objectname)',
+            ])
+            await self._fs.call('fork', self._link_fork, parent, name, path)
+            try:
+                if refs:
+                    await repo.run(['git', 'update-ref', '--stdin'],
+                                   input=(refs + '\n').encode('utf-8'))
+                head = await source.run(['git', 'symbolic-ref', 'HEAD'])
+                await repo.run(['git', 'symbolic-ref', 'HEAD', head])
+                await self._keep_objects(source)
+                return await self.adopt_repo(name, path)
+            except Exception:
+                await self._fs.call('fork', self._forget_fork, parent, name)
+                raise
+        except Exception:
+            await self._fs.call('fork', self._discard_fork, path)
+            raise
+
+    async def _keep_objects(self, parent):
+        """Tell ``parent`` to never prune objects (see ``fork_repo()``)."""
+        # Concurrent ``git config`` calls fail on the config's lock file.
+        lock = self._parents.get(parent.name)
+        if lock is None:
+            lock = self._parents[parent.name] = asyncio.Lock()
+        async with lock:
+            if (await parent.read_config('gc.pruneExpire')) != ['never']:
+                await parent.write_config('gc.pruneExpire', ['never'])
+
+    async def detach_repo(self, name):
+        """Copy the objects fork ``name`` borrows, and stop borrowing them.
+
+        Returns ``False`` if ``name`` is not a fork (raises
+        ``UnknownRepository`` if it doesn't exist).  This repacks the fork,
+        so it takes as long as cloning the parent would have.
+        """
+        repo = await self.find_repo(name)
+        parent = await self._fs.call(
+            'detach', _read_lines, os.path.join(repo.path, PARENT_FILE),
+        )
+        if not parent:
+            return False
+        # Without ``-l``, objects from alternates are packed too.
+        await repo.run(['git', 'repack', '-a', '-d'])
+        await self._fs.call('detach', self._unlink_fork, name)
+        return True
 
     def open_repo(self, name, bare=True):
         return Repository(name, self._repo_path(name, bare=bare), bare=bare)
 
+    def migrate(self, layout):
+        """Move all repositories to ``layout``, one at a time.
+
+        New repositories use the new layout right away and existing ones
+        stay reachable throughout, so this is safe while the server runs.
+        Yields the name of each repository as it is moved.
+        """
+        if layout not in LAYOUTS:
+            raise ValueError('Invalid layout: "%s".' % layout)
+        marker = os.path.join(self._path, LAYOUT_FILE)
+        with open(marker + '.tmp', 'w') as stream:
+            stream.write(layout)
+        os.replace(marker + '.tmp', marker)
+        self._layout = layout
+        for name in list(self._index.iter_names()):
+            src = self._repo_path(name)
+            dst = self._layout_path(name, layout)
+            if src == dst:
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(src, dst)
+            self._prune_shards(os.path.dirname(src))
+            # Forks refer to our objects by path.
+            for fork in _read_forks(os.path.join(dst, FORKS_FILE)):
+                _write_lines(
+                    os.path.join(self._repo_path(fork), ALTERNATES_FILE),
+                    [os.path.abspath(os.path.join(dst, 'objects'))],
+                )
+            yield name
+
+    def _prune_shards(self, path):
+        """Delete shard folders left empty."""
+        for _ in range(SHARD_DEPTH):
+            if os.path.samefile(path, self._path):
+                return
+            try:
+                os.rmdir(path)
+            except OSError:  # not empty.
+                return
+            path = os.path.dirname(path)
+
 
 class Repository(object):
     def __init__(self, name, path, bare):
@@ -134,15 +914,65 @@ class Repository(object):
     def bare(self):
         return self._bare
 
+    @property
+    def parent(self):
+        """Name of the repository this fork borrows objects from (if any)."""
+        lines = _read_lines(os.path.join(self._path, PARENT_FILE))
+        return lines[0] if lines else None
+
+    @property
+    def forks(self):
+        """Names of forks borrowing objects from this repository."""
+        return _read_forks(os.path.join(self._path, FORKS_FILE))
+
+    def repack_options(self):
+        """Extra ``git repack`` options to keep sharing objects with forks.
+        """
+        options = []
+        if self.parent:
+            options.append('--local')  # keep borrowing from the parent.
+        if self.forks:
+            options.append('--keep-unreachable')  # forks may need them.
+        return options
+
+    def ref_state(self):
+        """Compute a cheap fingerprint of the repository's refs."""
+        if self._bare:
+            return ref_state(self._path)
+        return ref_state(os.path.join(self._path, '.git'))
+
+    async def read_config(self, key):
+        """List all values of a (multi-valued) Git config option."""
+        output = await self.run(
+            ['git', 'config', '--null', '--get-all', key],
+            binary=True, returncodes=(0, 1),  # 1: not set.
+        )
+        return [value.decode('utf-8') for value in output.split(b'\0')[:-1]]
+
+    async def write_config(self, key, values):
+        """Replace all values of a (multi-valued) Git config option."""
+        await self.run(['git', 'config', '--unset-all', key],
+                       returncodes=(0, 5))  # 5: not set.
+        for value in values:
+            await self.run(['git', 'config', '--add', key, value])
+
     def edit(self, path, data):
         """Write to a file inside the working tree."""
         with open(os.path.join(self._path, path), 'w') as stream:
             stream.write(data)
 
     async def run(self, *args, **kwds):
-        """Run a shell command inside the repository."""
+        """Run a command inside the repository."""
         return await check_output(*args, cwd=self._path, **kwds)
 
+    async def start(self, *args, **kwds):
+        """Start a command inside the repository (see ``start_process``)."""
+        return await start_process(*args, cwd=self._path, **kwds)
+
+    def stream(self, *args, **kwds):
+        """Stream a command's output (see ``stream_output``)."""
+        return stream_output(*args, cwd=self._path, **kwds)
+
     def install_hooks(self):
         """Install all our hooks."""
         for name in ['pre-receive', 'update', 'post-update', 'post-receive']:
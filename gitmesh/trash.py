@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import structlog
+import threading
+import timeit
+
+
+class _Stopped(Exception):
+    pass
+
+
+class Reaper(object):
+    """Deletes trashed repositories in the background.
+
+    ``Storage.delete_repo()`` only renames repositories into the trash
+    folder, which is instant.  The reaper removes them from a worker thread
+    (using ``executor``), at most ``rate`` bytes per second (``None`` means
+    as fast as possible), so that deleting a huge repository neither blocks
+    the event loop nor saturates the disk.  Trash left over by a previous
+    run is removed when the reaper starts.
+    """
+
+    def __init__(self, storage, rate=None, executor=None, log=None,
+                 clock=None):
+        self._path = storage.trash_path
+        self._rate = rate
+        self._executor = executor
+        self._fs = storage.executor
+        self._log = log or structlog.get_logger()
+        self._clock = clock or timeit.default_timer
+        self._wakeup = asyncio.Event()
+        self._stop = threading.Event()
+        self.reaped = 0
+        self.reaped_bytes = 0
+
+    async def pending(self):
+        """List entries waiting in the trash, oldest first."""
+        return await self._fs.call('trash', self._pending)
+
+    def _pending(self):
+        try:
+            entries = [
+                (os.lstat(os.path.join(self._path, entry)).st_mtime, entry)
+                for entry in os.listdir(self._path)
+            ]
+        except FileNotFoundError:
+            return []
+        return [entry for _, entry in sorted(entries)]
+
+    def wake(self):
+        """Signal that something was put in the trash."""
+        self._wakeup.set()
+
+    async def reap(self):
+        """Empty the trash (in a worker thread)."""
+        loop = asyncio.get_event_loop()
+        for entry in await self.pending():
+            self._log.info('trash.reap.start', entry=entry)
+            ref = self._clock()
+            size, done = await loop.run_in_executor(
+                self._executor, self._remove, os.path.join(self._path, entry),
+            )
+            self.reaped_bytes += size
+            if not done:
+                self._log.info('trash.reap.stop', entry=entry, size=size,
+                               duration=self._clock() - ref)
+                return
+            self.reaped += 1
+            self._log.info('trash.reap.done', entry=entry, size=size,
+                           duration=self._clock() - ref)
+
+    async def run(self):
+        """Empty the trash, now and whenever ``wake()`` is called."""
+        while True:
+            self._wakeup.clear()
+            await self.reap()
+            await self._wakeup.wait()
+
+    def _remove(self, path):
+        """Delete ``path`` recursively, slowly enough to respect the rate.
+
+        Runs in a worker thread.  Returns the number of bytes deleted and
+        whether ``path`` is completely gone (we stop early on ``close()``).
+        """
+        ref = self._clock()
+        total = 0
+
+        def throttle(size):
+            nonlocal total
+            total += size
+            if self._rate:
+                delay = total / self._rate - (self._clock() - ref)
+                if delay > 0:
+                    self._stop.wait(delay)
+            if self._stop.is_set():
+                raise _Stopped
+
+        def unlink(path):
+            try:
+                size = os.lstat(path).st_size
+                os.unlink(path)
+            except FileNotFoundError:  # pragma: no cover
+                return
+            throttle(size)
+
+        try:
+            if not os.path.isdir(path) or os.path.islink(path):
+                unlink(path)
+                return total, True
+            for root, folders, files in os.walk(path, topdown=False):
+                for name in files:
+                    unlink(os.path.join(root, name))
+                for name in folders:
+                    folder = os.path.join(root, name)
+                    if os.path.islink(folder):
+                        unlink(folder)
+                    else:
+                        os.rmdir(folder)
+            os.rmdir(path)
+        except _Stopped:
+            # We'll pick up where we left off next time.
+            return total, False
+        return total, True
+
+    async def stats(self):
+        return {
+            'pending': len(await self.pending()),
+            'reaped': self.reaped,
+            'reaped_bytes': self.reaped_bytes,
+            'rate': self._rate,
+        }
+
+    def close(self):
+        """Interrupt any deletion in progress (it resumes on next start)."""
+        self._stop.set()
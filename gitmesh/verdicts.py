@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import time
+
+
+VERDICTS_DIR = 'gitmesh-verdicts'
+"""Folder, inside the repository, where verdicts are left for bin/update."""
+
+PUSH_VAR = 'GITMESH_PUSH_ID'
+"""Environment variable identifying the push (``git-receive-pack``'s PID)."""
+
+MAX_AGE = 3600.0
+"""Seconds after which verdicts of pushes that didn't complete are removed."""
+
+
+def verdicts_path(git_dir, push_id):
+    """File holding verdicts for push ``push_id`` (``None`` if invalid)."""
+    if not (push_id or '').isdigit():
+        return None
+    return os.path.join(git_dir, VERDICTS_DIR, push_id)
+
+
+def write_verdicts(path, verdicts):
+    """Leave a verdict for each ref update, for bin/update to find.
+
+    ``verdicts`` is a list of ``(ref, old, new, accepted)`` tuples.  Each
+    line reads ``accept <old> <new> <ref>`` (or ``reject``), so that the
+    update hook can look its arguments up with ``grep``.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as stream:
+        for ref, old, new, accepted in verdicts:
+            stream.write('%s %s %s %s\n' % (
+                'accept' if accepted else 'reject', old, new, ref,
+            ))
+    os.replace(path + '.tmp', path)
+
+
+def discard_verdicts(path):
+    """Remove verdicts once the push is done."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def prune_verdicts(git_dir, max_age=MAX_AGE, clock=None):
+    """Remove verdicts left over by pushes that never completed."""
+    folder = os.path.join(git_dir, VERDICTS_DIR)
+    limit = (clock or time.time)() - max_age
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if os.stat(path).st_mtime < limit:
+                os.unlink(path)
+        except FileNotFoundError:  # pragma: no cover
+            # Removed by another hook in the mean time.
+            pass
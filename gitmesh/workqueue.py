@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import json
+import os
+import sqlite3
+import structlog
+import sys
+import time
+
+from gitmesh.storage import kill_process, start_process, UnknownRepository
+
+
+QUEUE_VAR = 'GITMESH_QUEUE'
+"""Environment variable naming the queue's database, for hooks."""
+
+REPOSITORY_VAR = 'GITMESH_REPOSITORY'
+"""Environment variable naming the repository, for hooks."""
+
+REPLAY_VAR = 'GITMESH_REPLAY'
+"""Environment variable set when the queue runs ``post-receive`` again."""
+
+QUEUE_FILE = '.gitmesh-queue.db'
+"""SQLite database, inside the storage folder, holding the queue."""
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo TEXT NOT NULL,
+    updates TEXT NOT NULL,
+    request_id TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, repo, id);
+'''
+
+
+def connect(path):
+    """Open the queue's database (created as needed)."""
+    db = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+    # Hooks (other processes) add jobs while the server takes them.
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(_SCHEMA)
+    return db
+
+
+def enqueue(path, repo, updates, request_id=None):
+    """Queue post-receive work for ``updates`` (``{ref: (old, new)}``).
+
+    Called by ``gitmesh post-receive``, returns the job ID.
+    """
+    db = connect(path)
+    try:
+        return db.execute(
+            'INSERT INTO jobs (repo, updates, request_id) VALUES (?, ?, ?)',
+            (repo, json.dumps(updates), request_id),
+        ).lastrowid
+    finally:
+        db.close()
+
+
+def coalesce(batches):
+    """Merge successive ``{ref: (old, new)}`` updates, oldest first.
+
+    Refs updated more than once go from their first old value to their last
+    new value.  Refs that end up where they started are dropped.
+    """
+    merged = {}
+    for updates in batches:
+        for ref, (old, new) in updates.items():
+            if ref in merged:
+                old = merged[ref][0]
+            merged[ref] = (old, new)
+    return {
+        ref: (old, new) for ref, (old, new) in merged.items() if old != new
+    }
+
+
+async def run_hook_process(argv, env, cwd, stdin):
+    """Run ``gitmesh <argv>`` in a new process, return its output and status.
+
+    Used when there is no ``HookDaemon`` to run hooks.
+    """
+    process = await start_process(
+        [sys.executable, '-m', 'gitmesh'] + argv,
+        cwd=cwd, env=env, base_env={},
+    )
+    try:
+        output, _ = await process.communicate(stdin)
+    except asyncio.CancelledError:
+        kill_process(process)
+        await process.wait()
+        raise
+    return output, process.returncode
+
+
+class WorkQueue(object):
+    """Post-receive work, done in the background by ``gitmesh serve``.
+
+    Running plug-ins registered under ``gitmesh.post_receive`` (e.g. to
+    deploy) can take minutes, which the client pushing shouldn't have to
+    wait for.  Instead, the post-receive hook only adds a job to an SQLite
+    database (see ``enqueue()``) and ``run()`` runs the plug-ins later,
+    with ``runner`` (``HookDaemon.run()`` or ``run_hook_process()``).
+
+    Jobs for a repository run one at a time, in push order, and pushes
+    waiting for their turn are merged (see ``coalesce()``), so that plug-ins
+    don't work on states that are already gone.  Failed jobs are retried
+    after ``retry_delay * 2 ** attempts`` seconds, at most ``max_attempts``
+    times.  Jobs interrupted by a shutdown run again on next start.
+    """
+
+    def __init__(self, storage, concurrency=4, max_attempts=5,
+                 retry_delay=1.0, poll_interval=5.0, runner=None,
+                 executor=None, log=None, clock=None):
+        self._storage = storage
+        self._path = os.path.abspath(os.path.join(storage.path, QUEUE_FILE))
+        self._concurrency = concurrency
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._poll_interval = poll_interval
+        self._runner = runner or run_hook_process
+        self._executor = executor
+        self._log = log or structlog.get_logger()
+        self._clock = clock or time.time
+        self._wakeup = asyncio.Event()
+        self._running = {}
+        self.done = 0
+        self.retried = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    def wake(self):
+        """Signal that jobs may have been added."""
+        self._wakeup.set()
+
+    def notify_push(self, name):
+        """Look for jobs queued by hooks run for the push."""
+        self.wake()
+
+    async def counts(self):
+        """Count jobs in the queue, by state."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._counts)
+
+    def _counts(self):
+        db = connect(self._path)
+        try:
+            return dict(db.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state',
+            ).fetchall())
+        finally:
+            db.close()
+
+    async def stats(self):
+        stats = {
+            'running': len(self._running),
+            'done': self.done,
+            'retried': self.retried,
+        }
+        counts = await self.counts()
+        stats['pending'] = counts.get('pending', 0)
+        stats['failed'] = counts.get('failed', 0)
+        return stats
+
+    def _claim(self, busy, now):
+        """Take the next job that can run (``None`` if there is none).
+
+        Also returns when the next job delayed by a retry can run.
+        """
+        db = connect(self._path)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            heads = db.execute(
+                'SELECT id, repo, not_before FROM jobs WHERE id IN ('
+                "  SELECT MIN(id) FROM jobs WHERE state = 'pending'"
+                '  GROUP BY repo'
+                ') ORDER BY id',
+            ).fetchall()
+            heads = [head for head in heads if head[1] not in busy]
+            ready = [head for head in heads if head[2] <= now]
+            later = min(
+                (head[2] for head in heads if head[2] > now), default=None,
+            )
+            if not ready:
+                db.execute('COMMIT')
+                return None, later
+            job_id, repo, _ = ready[0]
+            rows = db.execute(
+                'SELECT id, updates, request_id, attempts FROM jobs'
+                " WHERE repo = ? AND state = 'pending' ORDER BY id",
+                (repo,),
+            ).fetchall()
+            updates = coalesce(json.loads(row[1]) for row in rows)
+            # Don't let a retried push start over by merging a newer one.
+            attempts = max(row[3] for row in rows)
+            request_ids = [
+                request_id for row in rows if row[2]
+                for request_id in row[2].split(',')
+            ]
+            db.execute(
+                'UPDATE jobs SET updates = ?, request_id = ?, attempts = ?'
+                ' WHERE id = ?',
+                (json.dumps(updates), ','.join(request_ids) or None,
+                 attempts, job_id),
+            )
+            db.executemany('DELETE FROM jobs WHERE id = ?', [
+                (row[0],) for row in rows[1:]
+            ])
+            db.execute('COMMIT')
+        finally:
+            db.close()
+        return {
+            'id': job_id,
+            'repo': repo,
+            'updates': updates,
+            'request_ids': request_ids,
+            'attempts': attempts,
+        }, later
+
+    def _finish(self, job, error=None):
+        """Drop a job that's done, or schedule a retry."""
+        db = connect(self._path)
+        try:
+            if error is None:
+                db.execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+                return 'done'
+            attempts = job['attempts'] + 1
+            if attempts >= self._max_attempts:
+                db.execute(
+                    "UPDATE jobs SET state = 'failed', attempts = ?,"
+                    ' error = ? WHERE id = ?',
+                    (attempts, error, job['id']),
+                )
+                return 'failed'
+            db.execute(
+                'UPDATE jobs SET attempts = ?, not_before = ?, error = ?'
+                ' WHERE id = ?',
+                (attempts,
+                 self._clock() + self._retry_delay * 2 ** job['attempts'],
+                 error, job['id']),
+            )
+            return 'retry'
+        finally:
+            db.close()
+
+    async def _run(self, job):
+        """Run post-receive plug-ins for a job."""
+        if not job['updates']:
+            # Refs ended up where they were (e.g. created, then deleted).
+            return None
+        try:
+            repo = await self._storage.find_repo(job['repo'])
+        except UnknownRepository:
+            # Deleted since, there's nothing left to work on.
+            return None
+        env = {k: v for k, v in os.environ.items() if k != QUEUE_VAR}
+        env.update({
+            'GIT_DIR': repo.path,
+            REPOSITORY_VAR: job['repo'],
+            REPLAY_VAR: '1',
+            'GITMESH_REQUEST_ID': ','.join(job['request_ids']) or '?',
+        })
+        stdin = ''.join(
+            '%s %s %s\n' % (old, new, ref)
+            for ref, (old, new) in sorted(job['updates'].items())
+        ).encode('utf-8')
+        output, status = await self._runner(
+            ['post-receive'], env, repo.path, stdin,
+        )
+        if status != 0:
+            return output.decode('utf-8', 'replace')[-4096:]
+        return None
+
+    async def _work(self, job):
+        loop = asyncio.get_event_loop()
+        self._log.info('queue.start', job=job['id'], repo=job['repo'],
+                       refs=sorted(job['updates']), attempts=job['attempts'],
+                       requests=job['request_ids'])
+        ref = loop.time()
+        try:
+            error = await self._run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            error = '%s: %s' % (type(exception).__name__, exception)
+        outcome = await loop.run_in_executor(
+            self._executor, self._finish, job, error,
+        )
+        if outcome == 'done':
+            self.done += 1
+        elif outcome == 'retry':
+            self.retried += 1
+        self._log.info('queue.' + outcome, job=job['id'], repo=job['repo'],
+                       duration=loop.time() - ref, error=error)
+
+    async def dispatch(self):
+        """Start jobs that can run, return when to look again (seconds)."""
+        loop = asyncio.get_event_loop()
+        later = None
+        while len(self._running) < self._concurrency:
+            job, later = await loop.run_in_executor(
+                self._executor, self._claim, set(self._running),
+                self._clock(),
+            )
+            if job is None:
+                break
+            task = asyncio.ensure_future(self._work(job))
+            self._running[job['repo']] = task
+
+            def done(_, repo=job['repo']):
+                del self._running[repo]
+                self.wake()
+
+            task.add_done_callback(done)
+        if later is None:
+            return self._poll_interval
+        return max(0.0, min(self._poll_interval, later - self._clock()))
+
+    async def run(self):
+        """Run jobs, now and whenever ``wake()`` is called."""
+        while True:
+            self._wakeup.clear()
+            delay = await self.dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait(self):
+        """Wait for jobs in progress."""
+        tasks = list(self._running.values())
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def close(self):
+        """Interrupt jobs in progress (they run again on next start)."""
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
@@ -48,6 +48,7 @@ setup(
         'click>=6.6',
         'aiohttp>=0.20,<0.21',
         'fluent-logger>=0.4,<0.5',
+        'importlib_metadata>=1.6; python_version < "3.8"',
         'structlog>=16,<17',
         'voluptuous>=0.8,<0.9',
     ],
@@ -13,8 +13,9 @@ import testfixtures
 from contextlib import contextmanager
 from itertools import chain
 from gitmesh import __main__
+from gitmesh.imports import Imports
 from gitmesh.storage import Storage, check_output
-from gitmesh.server import serve_until
+from gitmesh.server import Scheduler, serve_until
 from unittest import mock
 
 
@@ -154,8 +155,7 @@ def fluent_server(event_loop):
     event_loop.run_until_complete(server.wait_closed())
 
 
-@pytest.yield_fixture(scope='function')
-def server(event_loop, storage, fluent_server):
+def run_server(event_loop, storage, fluent_server, **kwds):
     logging_endpoint = 'fluent://%s:%d/gitmesh' % fluent_server[0:2]
     __main__.configure_logging(
         log_format='kv', utc=False,
@@ -166,13 +166,34 @@ def server(event_loop, storage, fluent_server):
     cancel = asyncio.Future()
     with setenv({'GITMESH_LOGGING_ENDPOINT': logging_endpoint}):
         server = event_loop.create_task(
-            serve_until(cancel, storage=storage, host='127.0.0.1', port=8080)
+            serve_until(cancel, storage=storage, host='127.0.0.1', port=8080,
+                        **kwds)
         )
         yield '127.0.0.1:8080'
         cancel.set_result(None)
         event_loop.run_until_complete(server)
 
 
+@pytest.yield_fixture(scope='function')
+def server(event_loop, storage, fluent_server):
+    yield from run_server(event_loop, storage, fluent_server)
+
+
+@pytest.yield_fixture(scope='function')
+def file_import_server(event_loop, storage, fluent_server):
+    """Server that may import repositories from its own file system."""
+    imports = Imports(storage, protocols='file')
+    yield from run_server(event_loop, storage, fluent_server, imports=imports)
+
+
+@pytest.yield_fixture(scope='function')
+def busy_server(event_loop, storage, fluent_server):
+    """Server that turns down all fetches."""
+    scheduler = Scheduler(limits={'fetch': (0, 0)}, retry_after=7)
+    yield from run_server(event_loop, storage, fluent_server,
+                          scheduler=scheduler)
+
+
 @pytest.yield_fixture(scope='function')
 def client(event_loop):
     with aiohttp.ClientSession() as session:
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import pytest
+
+from gitmesh.bundles import Bundles, BUNDLES_DIR
+from unittest import mock
+
+
+async def _commit(workspace, repo, message):
+    fork = workspace.open_repo('foo', bare=False)
+    if not os.path.isdir(fork.path):
+        fork = await workspace.clone(repo.path)
+        await fork.run('git config user.name "py.test"')
+        await fork.run('git config user.email "noreply@example.org"')
+    fork.edit('README.txt', message)
+    await fork.run('git add README.txt')
+    await fork.run(['git', 'commit', '-m', message])
+    await fork.run('git push origin master')
+
+
+@pytest.mark.asyncio
+async def test_bundles(storage, workspace):
+    log = mock.MagicMock()
+    bundles = Bundles(storage, keep=2, log=log)
+
+    # Given an empty repository.
+    repo = await storage.create_repo('foo')
+    assert (await bundles.list('foo')) == []
+    assert (await bundles.latest('foo')) is None
+
+    # When we try to bundle it.
+    bundle = await bundles.generate('foo')
+
+    # Then there should be nothing to bundle.
+    assert bundle is None
+    assert (await bundles.list('foo')) == []
+    assert os.listdir(os.path.join(repo.path, BUNDLES_DIR)) == []
+
+    # When it gets some history and we bundle it.
+    await _commit(workspace, repo, 'First commit.')
+    generation = storage.generation
+    first = await bundles.generate('foo')
+
+    # Then we should get a valid bundle.
+    assert first
+    assert storage.generation > generation
+    assert (await bundles.latest('foo')) == first
+    await repo.run(['git', 'bundle', 'verify',
+                    os.path.join(BUNDLES_DIR, first)])
+
+    # When we bundle it a few more times.
+    await _commit(workspace, repo, 'Second commit.')
+    second = await bundles.generate('foo')
+    os.utime(os.path.join(repo.path, BUNDLES_DIR, first), (0, 0))
+    await _commit(workspace, repo, 'Third commit.')
+    third = await bundles.generate('foo')
+
+    # Then only the latest ones should be kept.
+    assert [b['name'] for b in (await bundles.list('foo'))] == [
+        third, second,
+    ]
+    assert (await bundles.list('foo'))[0]['size'] > 0
+
+
+@pytest.mark.asyncio
+async def test_bundles_unknown_repository(storage):
+    bundles = Bundles(storage)
+    assert (await bundles.generate('foo')) is None
+
+
+@pytest.mark.asyncio
+async def test_bundles_debounce(storage, workspace, event_loop):
+    bundles = Bundles(storage, delay=0.05)
+
+    # Given a repository with some history.
+    repo = await storage.create_repo('foo')
+    await _commit(workspace, repo, 'First commit.')
+
+    # When it receives a burst of pushes.
+    with mock.patch.object(bundles, 'generate') as generate:
+        generate.return_value = asyncio.sleep(0.0)
+        bundles.notify_push('foo')
+        bundles.notify_push('foo')
+        await asyncio.sleep(0.01)
+        bundles.notify_push('foo')
+
+        # Then a single bundle should be generated once things settle down.
+        assert generate.call_count == 0
+        await asyncio.sleep(0.1)
+        assert generate.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_bundles_busy(storage, workspace):
+    bundles = Bundles(storage, keep=5)
+
+    # Given a repository with some history.
+    repo = await storage.create_repo('foo')
+    await _commit(workspace, repo, 'First commit.')
+
+    # When we ask for a bundle while one is being generated.
+    assert bundles.schedule('foo')
+    assert not bundles.schedule('foo')
+
+    # Then it should be generated again once done.
+    while len(await bundles.list('foo')) < 2:
+        await asyncio.sleep(0.05)
+    await bundles.close()
+
+
+@pytest.mark.asyncio
+async def test_bundles_forget(storage):
+    bundles = Bundles(storage, delay=0.05)
+
+    # Given a repository has been pushed to.
+    await storage.create_repo('foo')
+    with mock.patch.object(bundles, 'generate') as generate:
+        bundles.notify_push('foo')
+
+        # When it is forgotten (e.g. deleted).
+        bundles.forget('foo')
+
+        # Then no bundle should be generated.
+        await asyncio.sleep(0.1)
+        assert generate.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_bundles_close(storage):
+    bundles = Bundles(storage, delay=60.0)
+
+    # Given a repository has been pushed to.
+    await storage.create_repo('foo')
+    bundles.notify_push('foo')
+
+    # When we shut down.
+    await bundles.close()
+
+    # Then the pending bundle should be dropped.
+    assert (await bundles.list('foo')) == []
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import pytest
+
+from gitmesh.cache import PackCache, RefAdvertisementCache
+from gitmesh.storage import FileSystemExecutor
+
+
+def test_ref_advertisement_cache():
+    cache = RefAdvertisementCache()
+
+    # Cache miss.
+    assert cache.get('foo', 'git-upload-pack', 1) is None
+    cache.put('foo', 'git-upload-pack', 1, b'...')
+
+    # Cache hit.
+    assert cache.get('foo', 'git-upload-pack', 1) == b'...'
+
+    # Other services are cached separately.
+    assert cache.get('foo', 'git-receive-pack', 1) is None
+
+    # So are other protocol versions.
+    assert cache.get('foo', 'git-upload-pack', 1, 'version=2') is None
+    cache.put('foo', 'git-upload-pack', 1, b'v2', 'version=2')
+    assert cache.get('foo', 'git-upload-pack', 1, 'version=2') == b'v2'
+    assert cache.get('foo', 'git-upload-pack', 1) == b'...'
+
+    # Stale fingerprint.
+    assert cache.get('foo', 'git-upload-pack', 2) is None
+    cache.put('foo', 'git-upload-pack', 2, b'!!!')
+    assert cache.get('foo', 'git-upload-pack', 2) == b'!!!'
+
+    assert cache.stats() == {
+        'entries': 1,
+        'hits': 4,
+        'misses': 4,
+        'invalidations': 0,
+    }
+
+
+def test_ref_advertisement_cache_invalidate():
+    cache = RefAdvertisementCache()
+    cache.put('foo', 'git-upload-pack', 1, b'...')
+
+    cache.invalidate('foo')
+    cache.invalidate('bar')
+
+    assert cache.get('foo', 'git-upload-pack', 1) is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_ref_advertisement_cache_eviction():
+    cache = RefAdvertisementCache(capacity=2)
+    assert cache.capacity == 2
+    cache.put('foo', 'git-upload-pack', 1, b'foo')
+    cache.put('bar', 'git-upload-pack', 1, b'bar')
+    assert cache.get('foo', 'git-upload-pack', 1) == b'foo'
+
+    # Least recently used entry is evicted first.
+    cache.put('meh', 'git-upload-pack', 1, b'meh')
+
+    assert cache.get('foo', 'git-upload-pack', 1) == b'foo'
+    assert cache.get('bar', 'git-upload-pack', 1) is None
+    assert cache.get('meh', 'git-upload-pack', 1) == b'meh'
+
+
+class Producer(object):
+    """Mock producer that writes chunks when told to."""
+
+    def __init__(self, chunks, error=None):
+        self.calls = 0
+        self.chunks = chunks
+        self.error = error
+        self.release = asyncio.Event()
+
+    async def __call__(self, write):
+        self.calls += 1
+        await self.release.wait()
+        for chunk in self.chunks:
+            await write(chunk)
+        if self.error:
+            raise self.error
+
+
+async def collect(cache, key, produce):
+    chunks = []
+
+    async def consume(chunk):
+        chunks.append(chunk)
+
+    await cache.fetch(key, produce, consume)
+    return b''.join(chunks)
+
+
+@pytest.mark.asyncio
+async def test_pack_cache(tempdir):
+    executor = FileSystemExecutor()
+    cache = PackCache('cache', max_size=1024, executor=executor)
+    assert cache.path == 'cache'
+    assert cache.max_size == 1024
+    key = cache.key('foo', (1, 2), b'want 123')
+    assert key != cache.key('foo', (1, 3), b'want 123')
+
+    # Concurrent misses share a single producer.
+    produce = Producer([b'abc', b'def'])
+    first = asyncio.ensure_future(collect(cache, key, produce))
+    await asyncio.sleep(0.01)
+    second = asyncio.ensure_future(collect(cache, key, produce))
+    await asyncio.sleep(0.01)
+    produce.release.set()
+    assert (await first) == b'abcdef'
+    assert (await second) == b'abcdef'
+    assert produce.calls == 1
+
+    # Subsequent requests are served from disk.
+    assert (await collect(cache, key, produce)) == b'abcdef'
+    assert produce.calls == 1
+    assert cache.size == 6
+    assert cache.stats() == {
+        'entries': 1,
+        'size': 6,
+        'max_size': 1024,
+        'in_flight': 0,
+        'hits': 1,
+        'misses': 1,
+        'joins': 1,
+        'evictions': 0,
+    }
+
+    # Files are read and written off the event loop.
+    operations = executor.stats()['operations']
+    assert list(operations) == ['pack_cache']
+    assert operations['pack_cache']['count'] > 0
+
+    # Entries survive restarts.
+    cache = PackCache('cache', max_size=1024)
+    assert (await collect(cache, key, produce)) == b'abcdef'
+    assert produce.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_pack_cache_failure(tempdir):
+    cache = PackCache('cache', max_size=1024)
+    key = cache.key('foo', (1, 2), b'want 123')
+
+    # When the producer fails.
+    produce = Producer([b'abc'], error=ValueError('oops'))
+    produce.release.set()
+    with pytest.raises(ValueError):
+        await collect(cache, key, produce)
+
+    # Then nothing is cached.
+    assert cache.stats()['entries'] == 0
+    assert os.listdir('cache') == []
+
+
+@pytest.mark.asyncio
+async def test_pack_cache_eviction(tempdir):
+    cache = PackCache('cache', max_size=8)
+    foo = cache.key('foo', (1, 2), b'want 123')
+    bar = cache.key('bar', (1, 2), b'want 123')
+    produce = Producer([b'12345'])
+    produce.release.set()
+
+    # When the cache grows too large.
+    await collect(cache, foo, produce)
+    await collect(cache, bar, produce)
+
+    # Then the least recently used entry is evicted.
+    assert cache.stats()['evictions'] == 1
+    assert os.listdir('cache') == [bar]
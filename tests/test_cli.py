@@ -3,11 +3,20 @@
 
 import asyncio
 import os
-import pkg_resources
+import pytest
 import signal
 import testfixtures
 
 from contextlib import contextmanager
+from gitmesh.plugins import batched, PluginRegistry
+from gitmesh.storage import REF_STAMP, shard
+from gitmesh.verdicts import (
+    PUSH_VAR,
+    VERDICTS_DIR,
+    verdicts_path,
+    write_verdicts,
+)
+from gitmesh.workqueue import connect, QUEUE_VAR, REPLAY_VAR, REPOSITORY_VAR
 from unittest import mock
 
 
@@ -58,18 +67,11 @@ def test_pre_receive(event_loop, cli):
 
     pre_receive = mock.MagicMock()
 
-    def mock_iter_entry_points(group):
+    def mock_entry_points(group):
         assert group == 'gitmesh.pre_receive'
-        return iter([
-            # echo = echo:pre_receive
-            pkg_resources.EntryPoint(
-                name='echo',
-                module_name='echo',
-                attrs=('pre_receive',),
-                extras={},
-                dist='echo',
-            ),
-        ])
+        return [
+            ('echo', 'echo:pre_receive'),
+        ]
 
     def mock_import_module(name, package=None):
         assert name == 'echo'
@@ -79,8 +81,8 @@ def test_pre_receive(event_loop, cli):
         })
 
     # When we execute the pre-receive hook.
-    with mock.patch('pkg_resources.iter_entry_points') as iter_entry_points:
-        iter_entry_points.side_effect = mock_iter_entry_points
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.side_effect = mock_entry_points
         with mock.patch('importlib.import_module') as import_module:
             import_module.side_effect = mock_import_module
             cli(event_loop, ['pre-receive'], input='\n'.join([
@@ -101,18 +103,11 @@ def test_update(event_loop, cli):
 
     update = mock.MagicMock()
 
-    def mock_iter_entry_points(group):
+    def mock_entry_points(group):
         assert group == 'gitmesh.update'
-        return iter([
-            # echo = echo:update
-            pkg_resources.EntryPoint(
-                name='echo',
-                module_name='echo',
-                attrs=('update',),
-                extras={},
-                dist='echo',
-            ),
-        ])
+        return [
+            ('echo', 'echo:update'),
+        ]
 
     def mock_import_module(name, package=None):
         assert name == 'echo'
@@ -122,8 +117,8 @@ def test_update(event_loop, cli):
         })
 
     # When we execute the update hook.
-    with mock.patch('pkg_resources.iter_entry_points') as iter_entry_points:
-        iter_entry_points.side_effect = mock_iter_entry_points
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.side_effect = mock_entry_points
         with mock.patch('importlib.import_module') as import_module:
             import_module.side_effect = mock_import_module
             cli(event_loop, ['update', 'a', 'b', 'c'])
@@ -140,18 +135,11 @@ def test_post_receive(event_loop, cli):
 
     post_receive = mock.MagicMock()
 
-    def mock_iter_entry_points(group):
+    def mock_entry_points(group):
         assert group == 'gitmesh.post_receive'
-        return iter([
-            # echo = echo:post_receive
-            pkg_resources.EntryPoint(
-                name='echo',
-                module_name='echo',
-                attrs=('post_receive',),
-                extras={},
-                dist='echo',
-            ),
-        ])
+        return [
+            ('echo', 'echo:post_receive'),
+        ]
 
     def mock_import_module(name, package=None):
         assert name == 'echo'
@@ -161,8 +149,8 @@ def test_post_receive(event_loop, cli):
         })
 
     # When we execute the post-receive hook.
-    with mock.patch('pkg_resources.iter_entry_points') as iter_entry_points:
-        iter_entry_points.side_effect = mock_iter_entry_points
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.side_effect = mock_entry_points
         with mock.patch('importlib.import_module') as import_module:
             import_module.side_effect = mock_import_module
             cli(event_loop, ['post-receive'], input='\n'.join([
@@ -183,18 +171,11 @@ def test_post_update(event_loop, cli):
 
     post_update = mock.MagicMock()
 
-    def mock_iter_entry_points(group):
+    def mock_entry_points(group):
         assert group == 'gitmesh.post_update'
-        return iter([
-            # echo = echo:post_update
-            pkg_resources.EntryPoint(
-                name='echo',
-                module_name='echo',
-                attrs=('post_update',),
-                extras={},
-                dist='echo',
-            ),
-        ])
+        return [
+            ('echo', 'echo:post_update'),
+        ]
 
     def mock_import_module(name, package=None):
         assert name == 'echo'
@@ -204,8 +185,8 @@ def test_post_update(event_loop, cli):
         })
 
     # When we execute the post-update hook.
-    with mock.patch('pkg_resources.iter_entry_points') as iter_entry_points:
-        iter_entry_points.side_effect = mock_iter_entry_points
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.side_effect = mock_entry_points
         with mock.patch('importlib.import_module') as import_module:
             import_module.side_effect = mock_import_module
             cli(event_loop, ['post-update', 'a', 'b', 'c', 'd', 'e', 'f'])
@@ -223,6 +204,136 @@ def test_post_update(event_loop, cli):
     )
 
 
+@pytest.mark.parametrize('error', [ValueError('Nope.'), SystemExit(1)])
+def test_pre_receive_updates(event_loop, cli, tempdir, error):
+    checked = []
+
+    def update(ref, old, new):
+        checked.append(ref)
+        if ref == 'refs/heads/bad':
+            raise error
+
+    @batched
+    def bulk_update(updates):
+        assert updates == {
+            'refs/heads/master': ('a', 'b'),
+            'refs/heads/bad': ('c', 'd'),
+            'refs/heads/nope': ('e', 'f'),
+        }
+        return ['refs/heads/nope']
+
+    def mock_entry_points(group):
+        if group == 'gitmesh.update':
+            return [('check', 'check:update'), ('bulk', 'bulk:update')]
+        return []
+
+    # Given verdicts left over by a push that never completed.
+    write_verdicts(verdicts_path('.', '1'), [])
+    os.utime(verdicts_path('.', '1'), (1000.0, 1000.0))
+
+    # When we execute the pre-receive hook for a push.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.side_effect = mock_entry_points
+        with mock.patch('importlib.import_module') as import_module:
+            import_module.side_effect = lambda name: DynamicObject({
+                'check': {'update': update},
+                'bulk': {'update': bulk_update},
+            }[name])
+            cli(event_loop, ['pre-receive'], input='\n'.join([
+                'a b refs/heads/master',
+                'c d refs/heads/bad',
+                'e f refs/heads/nope',
+            ]), env={
+                'GIT_DIR': '.',
+                PUSH_VAR: '123',
+            })
+
+    # Then update plug-ins should have run for each ref.
+    assert checked == ['refs/heads/master', 'refs/heads/bad']
+    with open(verdicts_path('.', '123'), 'r') as stream:
+        assert stream.read() == (
+            'accept a b refs/heads/master\n'
+            'reject c d refs/heads/bad\n'
+            'reject e f refs/heads/nope\n'
+        )
+    assert os.listdir(VERDICTS_DIR) == ['123']
+
+
+@pytest.mark.parametrize('error', [ValueError('Nope.'), SystemExit(1)])
+def test_pre_receive_batched_update_error(event_loop, cli, tempdir, error):
+
+    @batched
+    def bulk_update(updates):
+        raise error
+
+    def mock_entry_points(group):
+        if group == 'gitmesh.update':
+            return [('bulk', 'bulk:update')]
+        return []
+
+    # When a batched update plug-in fails.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.side_effect = mock_entry_points
+        with mock.patch('importlib.import_module') as import_module:
+            import_module.return_value = DynamicObject({
+                'update': bulk_update,
+            })
+            cli(event_loop, ['pre-receive'], input='a b refs/heads/master',
+                env={'GIT_DIR': '.', PUSH_VAR: '123'})
+
+    # Then all refs should be rejected.
+    with open(verdicts_path('.', '123'), 'r') as stream:
+        assert stream.read() == 'reject a b refs/heads/master\n'
+
+
+def test_post_receive_discards_verdicts(event_loop, cli, tempdir):
+    write_verdicts(verdicts_path('.', '123'), [])
+
+    # When we execute the post-receive hook for a push.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.return_value = []
+        cli(event_loop, ['post-receive'], input='a b c', env={
+            'GIT_DIR': '.',
+            PUSH_VAR: '123',
+        })
+
+    # Then verdicts left by the pre-receive hook should be gone.
+    assert os.listdir(VERDICTS_DIR) == []
+
+    # And cached ref advertisements should be invalidated.
+    assert os.path.exists(REF_STAMP)
+
+
+def test_post_receive_replay(event_loop, cli, tempdir):
+
+    # When the work queue runs the post-receive hook again.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.return_value = []
+        cli(event_loop, ['post-receive'], input='a b c', env={
+            'GIT_DIR': '.',
+            REPLAY_VAR: '1',
+        })
+
+    # Then the ref state shouldn't change again, the push already did that.
+    assert not os.path.exists(REF_STAMP)
+
+
+def test_update_timeout(event_loop, cli):
+
+    async def update(ref, old, new):
+        await asyncio.sleep(1.0)
+
+    # When a plug-in takes longer than allowed.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.return_value = [('slow', 'slow:update')]
+        with mock.patch('importlib.import_module') as import_module:
+            import_module.return_value = DynamicObject({'update': update})
+            with pytest.raises(asyncio.TimeoutError):
+                cli(event_loop, ['update', 'a', 'b', 'c'], env={
+                    'GITMESH_PLUGIN_TIMEOUT': '0.01',
+                })
+
+
 def test_serve(fluent_emit, event_loop, cli):
 
     # Make sure we eventually get a SIGINT/CTRL-C event.
@@ -253,3 +364,63 @@ def test_serve_default_event_loop(fluent_emit, event_loop, cli):
             cli(None, ['serve'])
     capture.compare('')
     assert fluent_emit.call_count > 0
+
+
+def test_post_receive_touches_ref_state(event_loop, cli, tempdir):
+
+    # When we execute the post-receive hook from within Git.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.return_value = []
+        cli(event_loop, ['post-receive'], input='a b c', env={
+            'GIT_DIR': '.',
+        })
+
+    # Then the ref state stamp should have been written.
+    assert os.path.isfile('gitmesh-refs')
+
+
+def test_post_receive_queue(event_loop, cli, tempdir):
+    post_receive = mock.MagicMock()
+
+    # When we execute the post-receive hook for `gitmesh serve`.
+    with mock.patch.object(PluginRegistry, 'entry_points') as entry_points:
+        entry_points.return_value = [('echo', 'echo:post_receive')]
+        with mock.patch('importlib.import_module') as import_module:
+            import_module.return_value = DynamicObject({
+                'post_receive': post_receive,
+            })
+            cli(event_loop, ['post-receive'], input='a b c', env={
+                QUEUE_VAR: os.path.abspath('queue.db'),
+                REPOSITORY_VAR: 'foo',
+                'GITMESH_REQUEST_ID': 'r1',
+            })
+
+    # Then plug-ins should run later.
+    post_receive.assert_not_called()
+    db = connect('queue.db')
+    try:
+        assert db.execute(
+            'SELECT repo, updates, request_id FROM jobs',
+        ).fetchall() == [
+            ('foo', '{"c": ["a", "b"]}', 'r1'),
+        ]
+    finally:
+        db.close()
+
+
+def test_migrate(event_loop, cli, tempdir):
+    # Given a storage folder with a flat layout.
+    os.mkdir('foo.git')
+    os.mkdir('bar.git')
+
+    # When we migrate to the sharded layout.
+    cli(event_loop, ['migrate', '--layout', 'sharded'])
+
+    # Then every repository should be moved to its shard.
+    assert sorted(os.listdir('.')) == sorted([
+        '.gitmesh-layout',
+        shard('foo').split(os.sep)[0],
+        shard('bar').split(os.sep)[0],
+    ])
+    assert os.path.isdir(os.path.join(shard('foo'), 'foo.git'))
+    assert os.path.isdir(os.path.join(shard('bar'), 'bar.git'))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import io
+import os
+import pytest
+import sys
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from gitmesh import hookclient
+from gitmesh.hookd import HookDaemon, run_hook
+from gitmesh.storage import check_output
+from subprocess import CalledProcessError
+from unittest import mock
+
+
+@pytest.mark.asyncio
+async def test_hook_daemon(tempdir):
+    log = mock.MagicMock()
+    hooks = HookDaemon(os.path.abspath('hooks.sock'), workers=1, log=log)
+    await hooks.start()
+    try:
+        # When Git runs a hook through the client.
+        output = await check_output(
+            [sys.executable, '-m', 'gitmesh.hookclient',
+             'post-update', 'refs/heads/master'],
+            env={hookclient.SOCKET_VAR: hooks.path},
+        )
+
+        # Then it should run in the daemon.
+        assert 'git.hooks.post-update' in output
+        assert "refs=('refs/heads/master',)" in output
+        log.info.assert_called_once_with(
+            'hook.run', argv=['post-update', 'refs/heads/master'],
+            status=0, duration=mock.ANY, request=None,
+        )
+
+        # When the hook fails.
+        with pytest.raises(CalledProcessError) as error:
+            await check_output(
+                [sys.executable, '-m', 'gitmesh.hookclient', 'unknown'],
+                env={hookclient.SOCKET_VAR: hooks.path},
+            )
+
+        # Then the client should exit with the hook's status.
+        assert error.value.returncode == 2
+        assert 'No such command' in error.value.output
+    finally:
+        await hooks.close()
+    assert not os.path.exists(hooks.path)
+
+
+@pytest.mark.asyncio
+async def test_hook_client(tempdir, event_loop):
+    hooks = HookDaemon(os.path.abspath('hooks.sock'), workers=1)
+    await hooks.start()
+    try:
+        # When we forward a hook to the daemon.
+        sock = hookclient.connect(hooks.path)
+        stdout = io.BytesIO()
+        status = await event_loop.run_in_executor(
+            None, hookclient.forward, sock, ['pre-receive'],
+            io.BytesIO(b'a b c\n'), stdout,
+        )
+
+        # Then we should get its output.
+        assert status == 0
+        assert b'Request ID: "?".' in stdout.getvalue()
+    finally:
+        await hooks.close()
+
+
+@pytest.mark.asyncio
+async def test_hook_client_lost_connection(tempdir, event_loop):
+
+    async def hang_up(reader, writer):
+        await reader.read()
+        writer.close()
+
+    # Given a daemon that crashes while running the hook.
+    path = os.path.abspath('hooks.sock')
+    server = await asyncio.start_unix_server(hang_up, path=path)
+    try:
+        # When we forward a hook to the daemon.
+        stdout = io.BytesIO()
+        status = await event_loop.run_in_executor(
+            None, hookclient.forward, hookclient.connect(path),
+            ['update', 'a', 'b', 'c'], io.BytesIO(b''), stdout,
+        )
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    # Then the hook should fail.
+    assert status == 1
+    assert stdout.getvalue() == b'Lost connection to the hook daemon.\n'
+
+
+def test_hook_client_fallback(tempdir):
+    # Given the daemon isn't running.
+    assert hookclient.connect(os.path.abspath('hooks.sock')) is None
+
+    # When we run a hook.
+    env = {hookclient.SOCKET_VAR: os.path.abspath('hooks.sock')}
+    with mock.patch.dict('os.environ', env):
+        with mock.patch('gitmesh.__main__.main') as main:
+            main.return_value = 0
+            status = hookclient.main(['update', 'a', 'b', 'c'])
+
+    # Then it should run in this process.
+    assert status == 0
+    main.assert_called_once_with()
+    assert sys.argv == ['gitmesh', 'update', 'a', 'b', 'c']
+
+
+@pytest.mark.parametrize('error,status,message', [
+    (None, 0, 'Running hook'),
+    (SystemExit(3), 3, ''),
+    (SystemExit('Nope.'), 1, ''),
+    (RuntimeError('Nope.'), 1, 'RuntimeError: Nope.'),
+])
+def test_run_hook(tempdir, error, status, message):
+    hook = mock.MagicMock()
+    hook.side_effect = error
+    env = dict(os.environ)
+
+    # When a hook worker runs a hook.
+    try:
+        with mock.patch('gitmesh.__main__.find_entry_points') as plugins:
+            plugins.return_value = iter([('echo', hook)])
+            output = run_hook(['pre-receive'], env, os.getcwd(), b'a b c\n')
+    finally:
+        # Don't leave the worker's (closed) event loop behind.
+        asyncio.set_event_loop(None)
+
+    # Then we should get its output and exit status.
+    assert output[1] == status
+    assert message.encode('utf-8') in output[0]
+    hook.assert_called_once_with(updates={'c': ('a', 'b')})
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+@pytest.mark.asyncio
+async def test_hook_daemon_broken_pool(tempdir):
+    hooks = HookDaemon(os.path.abspath('hooks.sock'), workers=1)
+    await hooks.start()
+    try:
+        # Given hooks are running when a worker dies.
+        futures = []
+
+        def submit(*args):
+            futures.append(Future())
+            return futures[-1]
+
+        pool = mock.MagicMock()
+        pool.submit.side_effect = submit
+        hooks._pool.shutdown()
+        hooks._pool = pool
+        fresh = mock.MagicMock()
+        fresh.submit.return_value = _done((b'Done.\n', 0))
+        with mock.patch('gitmesh.hookd.ProcessPoolExecutor') as new_pool:
+            new_pool.return_value = fresh
+            runs = asyncio.gather(*[
+                hooks.run(['update'], {}, '.', b'') for _ in range(3)
+            ])
+            while len(futures) < 3:
+                await asyncio.sleep(0)
+            for future in futures:
+                future.set_exception(BrokenProcessPool())
+
+            # When they fail.
+            results = await runs
+
+        # Then we should start over once, and run them again.
+        new_pool.assert_called_once_with(max_workers=1)
+        pool.shutdown.assert_called_once_with(wait=False)
+        assert hooks._pool is fresh
+        assert fresh.submit.call_count == 3
+        assert results == [(b'Done.\n', 0)] * 3
+    finally:
+        await hooks.close()
+
+
+@pytest.mark.asyncio
+async def test_hook_daemon_broken_pool_again(tempdir):
+    hooks = HookDaemon(os.path.abspath('hooks.sock'), workers=1)
+    await hooks.start()
+    try:
+        # Given workers die as soon as they run the hook.
+        pool = mock.MagicMock()
+        pool.submit.side_effect = BrokenProcessPool
+        hooks._pool.shutdown()
+        hooks._pool = pool
+
+        # When we run it.
+        with mock.patch('gitmesh.hookd.ProcessPoolExecutor') as new_pool:
+            new_pool.return_value = pool
+            output, status = await hooks.run(['update'], {}, '.', b'')
+
+        # Then it should fail after one more try, leaving fresh workers.
+        assert status == 1
+        assert output == b'Hook worker died.\n'
+        assert pool.submit.call_count == 2
+        assert new_pool.call_count == 2
+    finally:
+        await hooks.close()
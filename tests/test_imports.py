@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import pytest
+
+from asyncio import subprocess
+from gitmesh.imports import Imports, IMPORTS_DIR, parse_progress
+from gitmesh.storage import RepositoryExists, start_process
+from unittest import mock
+
+
+async def _upstream(workspace):
+    upstream = await workspace.create_repo('upstream')
+    clone = await workspace.clone(upstream.path)
+    await clone.run('git config user.name "py.test"')
+    await clone.run('git config user.email "noreply@example.org"')
+    clone.edit('README.txt', 'Hello!')
+    await clone.run('git add README.txt')
+    await clone.run(['git', 'commit', '-m', 'First commit.'])
+    await clone.run('git push origin master')
+    return upstream
+
+
+@pytest.mark.parametrize('line,progress', [
+    ('Receiving objects:  45% (9/20)', {
+        'phase': 'Receiving objects',
+        'percent': 45,
+    }),
+    ('remote: Counting objects: 100% (3/3), done.', {
+        'phase': 'Counting objects',
+        'percent': 100,
+    }),
+    ('Cloning into bare repository \'foo.git\'...', None),
+    ('fatal: repository not found', None),
+])
+def test_parse_progress(line, progress):
+    assert parse_progress(line) == progress
+
+
+@pytest.mark.asyncio
+async def test_import(storage, workspace):
+    imports = Imports(storage, protocols='file', log=mock.MagicMock())
+
+    # Given a repository on another server.
+    upstream = await _upstream(workspace)
+    commit = await upstream.run('git rev-parse master')
+
+    # When we import it.
+    job = imports.start('foo', 'file://' + upstream.path)
+    assert job['state'] == 'queued'
+    assert imports.importing('foo')
+    job = await imports.wait(job['id'])
+
+    # Then it should be in the storage.
+    assert job['state'] == 'done'
+    assert job['error'] is None
+    assert job['progress']['percent'] == 100
+    assert not imports.importing('foo')
+    repo = storage.open_repo('foo')
+    assert (await storage.repository_exists('foo'))
+    assert (await repo.run('git rev-parse master')) == commit
+    assert (await storage.list_repositories()) == ['foo']
+    assert os.listdir(os.path.join(storage.path, IMPORTS_DIR)) == []
+
+
+@pytest.mark.asyncio
+async def test_import_failure(storage, workspace):
+    imports = Imports(storage, protocols='file', log=mock.MagicMock())
+
+    # When we import a repository that doesn't exist.
+    job = imports.start('foo', 'file://' + os.path.join(workspace.path, 'x'))
+    job = await imports.wait(job['id'])
+
+    # Then the job should fail.
+    assert job['state'] == 'failed'
+    assert job['error']
+    assert not (await storage.repository_exists('foo'))
+
+
+@pytest.mark.asyncio
+async def test_import_protocols(storage, workspace):
+    imports = Imports(storage, log=mock.MagicMock())
+
+    # Given a repository on another server.
+    upstream = await _upstream(workspace)
+
+    # When we import it with a transport that isn't allowed by default.
+    job = imports.start('foo', 'file://' + upstream.path)
+    job = await imports.wait(job['id'])
+
+    # Then the job should fail.
+    assert job['state'] == 'failed'
+    assert 'transport' in job['error']
+
+
+@pytest.mark.asyncio
+async def test_import_exists(storage, workspace):
+    reaper = mock.MagicMock()
+    imports = Imports(storage, protocols='file', reaper=reaper,
+                      log=mock.MagicMock())
+
+    # Given a repository on another server.
+    upstream = await _upstream(workspace)
+
+    # When we import it, but the name gets taken in the mean time.
+    await storage.create_repo('foo')
+    job = imports.start('foo', 'file://' + upstream.path)
+    with pytest.raises(RepositoryExists):
+        imports.start('foo', 'file://' + upstream.path)
+    job = await imports.wait(job['id'])
+
+    # Then the job should fail and the clone should go to the trash.
+    assert job['state'] == 'failed'
+    assert job['error'] == 'Repository exists.'
+    assert os.listdir(storage.trash_path) == [job['id'] + '.git']
+    reaper.wake.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_import_cancel_queued(storage):
+    imports = Imports(storage, concurrency=0, log=mock.MagicMock())
+
+    # Given an import waiting for its turn.
+    job = imports.start('foo', 'file:///dev/null')
+    await asyncio.sleep(0.01)
+
+    # When we cancel it.
+    assert imports.cancel(job['id'])
+    job = await imports.wait(job['id'])
+
+    # Then it should never run.
+    assert job['state'] == 'cancelled'
+    assert job['duration'] is None
+    assert not imports.cancel(job['id'])
+
+
+@pytest.mark.asyncio
+async def test_import_cancel_running(storage):
+    imports = Imports(storage, log=mock.MagicMock())
+
+    async def slow_clone(*args, **kwds):
+        return await start_process(['sleep', '10'], split=True,
+                                   stdin=subprocess.DEVNULL)
+
+    # Given an import in progress.
+    with mock.patch('gitmesh.imports.start_process') as clone:
+        clone.side_effect = slow_clone
+        job = imports.start('foo', 'file:///dev/null')
+        while imports.get(job['id'])['state'] != 'running':
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+        # When we cancel it.
+        imports.cancel(job['id'])
+        job = await asyncio.wait_for(imports.wait(job['id']), 1.0)
+
+    # Then it should stop right away.
+    assert job['state'] == 'cancelled'
+    assert job['duration'] < 1.0
+
+
+@pytest.mark.asyncio
+async def test_import_keep(storage):
+    imports = Imports(storage, concurrency=0, keep=1, log=mock.MagicMock())
+
+    # When a few jobs end.
+    jobs = [imports.start(name, 'file:///dev/null') for name in 'abc']
+    await imports.close()
+
+    # Then only the latest should be kept.
+    assert imports.get(jobs[0]['id']) is None
+    assert imports.get(jobs[1]['id']) is None
+    assert imports.get(jobs[2]['id'])['state'] == 'cancelled'
+    assert imports.get('unknown') is None
+
+
+@pytest.mark.asyncio
+async def test_import_error(storage):
+    imports = Imports(storage, log=mock.MagicMock())
+
+    # When the import fails unexpectedly.
+    with mock.patch('gitmesh.imports.start_process') as clone:
+        clone.side_effect = OSError('Out of file descriptors.')
+        job = imports.start('foo', 'file:///dev/null')
+        job = await imports.wait(job['id'])
+
+    # Then the job should fail.
+    assert job['state'] == 'failed'
+    assert job['error'] == 'Out of file descriptors.'
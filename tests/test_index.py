@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import ctypes
+import errno
+import os
+import pytest
+
+from gitmesh.index import RepositoryIndex, _inotify
+from unittest import mock
+
+
+def test_repository_index(tempdir):
+    for name in ['foo.git', 'bar.git', 'baz.git', 'foobar.git']:
+        os.mkdir(name)
+    os.mkdir('.cache')
+    os.mkdir('misc')
+    with open('meh.git', 'w'):
+        pass
+    index = RepositoryIndex('.')
+
+    # Everything, in order.
+    assert index.names() == ['bar', 'baz', 'foo', 'foobar']
+    assert len(index) == 4
+
+    # One page at a time.
+    assert index.names(limit=3) == ['bar', 'baz', 'foo']
+    assert index.names(after='foo', limit=3) == ['foobar']
+    assert index.names(after='foobar', limit=3) == []
+
+    # By prefix.
+    assert index.names(prefix='ba') == ['bar', 'baz']
+    assert index.names(prefix='ba', after='bar') == ['baz']
+    assert index.names(prefix='foo', after='bar') == ['foo', 'foobar']
+    assert index.names(prefix='nope') == []
+
+
+def test_repository_index_updates(tempdir):
+    index = RepositoryIndex('.')
+    assert index.names() == []
+
+    # Updates from the storage.
+    os.mkdir('foo.git')
+    index.add('foo')
+    os.mkdir('bar.git')
+    index.add('bar')
+    index.add('foo')
+    assert index.names() == ['bar', 'foo']
+    os.rmdir('foo.git')
+    index.discard('foo')
+    index.discard('meh')
+    assert index.names() == ['bar']
+
+    # Changes made behind our back.
+    os.mkdir('meh.git')
+    assert index.names() == ['bar', 'meh']
+
+
+def test_repository_index_mtime(tempdir):
+    os.mkdir('foo.git')
+    os.utime('.', (0, 0))
+    index = RepositoryIndex('.')
+
+    # Given the folder hasn't changed in a while.
+    assert index.names() == ['foo']
+
+    # When something changes behind our back.
+    os.mkdir('bar.git')
+
+    # Then we should notice.
+    assert index.names() == ['bar', 'foo']
+
+
+def test_repository_index_iter_names(tempdir):
+    for name in ['foo.git', 'bar.git', 'baz.git', 'foobar.git']:
+        os.mkdir(name)
+    index = RepositoryIndex('.')
+
+    # Everything, in batches.
+    assert list(index.iter_names(batch_size=2)) == [
+        'bar', 'baz', 'foo', 'foobar',
+    ]
+    assert list(index.iter_names(prefix='foo', batch_size=1)) == [
+        'foo', 'foobar',
+    ]
+    assert list(index.iter_names(after='baz')) == ['foo', 'foobar']
+
+    # Changes while iterating.
+    names = index.iter_names(batch_size=2)
+    assert next(names) == 'bar'
+    os.mkdir('qux.git')
+    index.add('qux')
+    assert list(names) == ['baz', 'foo', 'foobar', 'qux']
+
+
+def test_repository_index_iter_names_unsettled(tempdir):
+    for i in range(10):
+        os.mkdir('repo-%d.git' % i)
+    index = RepositoryIndex('.')
+
+    # Given the folder just changed (so its mtime can't be trusted yet).
+    with mock.patch.object(index, 'load', wraps=index.load) as load:
+
+        # When we go through the names, in batches.
+        assert len(list(index.iter_names(batch_size=2))) == 10
+
+        # Then the folder should only be scanned once.
+        assert load.call_count == 1
+
+
+class CountingList(list):
+    """List that counts how many items are read."""
+
+    reads = 0
+
+    def __getitem__(self, key):
+        item = super().__getitem__(key)
+        self.reads += len(item) if isinstance(key, slice) else 1
+        return item
+
+    def __iter__(self):
+        for item in super().__iter__():
+            self.reads += 1
+            yield item
+
+
+def test_repository_index_large(tempdir):
+    os.utime('.', (0, 0))
+    index = RepositoryIndex('.')
+    assert index.names() == []
+
+    # Given lots of repositories.
+    index._names = CountingList('repo-%06d' % i for i in range(100000))
+
+    # When we fetch a page, then go through all of them.
+    assert index.names(after='repo-000009', limit=2) == [
+        'repo-000010', 'repo-000011',
+    ]
+    assert index._names.reads < 50
+    assert sum(1 for _ in index.iter_names(batch_size=1000)) == 100000
+
+    # Then it should only cost as much as the names we got.
+    assert index._names.reads < 2 * 100000
+
+
+@pytest.mark.asyncio
+async def test_repository_index_watch(tempdir, event_loop):
+    index = RepositoryIndex('.')
+    os.mkdir('foo.git')
+
+    # Given we watch the folder.
+    assert index.watch(loop=event_loop)
+    assert index.watch(loop=event_loop)
+    try:
+        assert index.names() == ['foo']
+
+        # When repositories are created, renamed and deleted by others.
+        os.mkdir('bar.git')
+        os.mkdir('meh')
+        os.rename('foo.git', 'qux.git')
+        await asyncio.sleep(0.1)
+
+        # Then the index should follow.
+        assert index.names() == ['bar', 'qux']
+        os.rmdir('bar.git')
+        await asyncio.sleep(0.1)
+        assert index.names() == ['qux']
+    finally:
+        index.close()
+    index.close()
+
+
+def test_repository_index_sharded(tempdir):
+    os.makedirs(os.path.join('ab', 'cd', 'foo.git'))
+    os.makedirs(os.path.join('ab', 'ef', 'bar.git'))
+    os.makedirs(os.path.join('ab', 'misc', 'meh.git'))
+    os.makedirs(os.path.join('ab', 'cd', 'ef', 'meh.git'))
+    os.mkdir('qux.git')
+    index = RepositoryIndex('.')
+
+    # Both layouts, but only at the right depths.
+    assert index.names() == ['bar', 'foo', 'qux']
+
+
+@pytest.mark.asyncio
+async def test_repository_index_watch_sharded(tempdir, event_loop):
+    os.makedirs(os.path.join('ab', 'cd', 'foo.git'))
+    index = RepositoryIndex('.')
+
+    # Given we watch the folder.
+    assert index.watch(loop=event_loop)
+    try:
+        assert index.names() == ['foo']
+
+        # When repositories are created in new and existing shards.
+        os.makedirs(os.path.join('ab', 'cd', 'bar.git'))
+        os.makedirs(os.path.join('12', '34', 'qux.git'))
+        await asyncio.sleep(0.1)
+
+        # Then the index should follow.
+        assert index.names() == ['bar', 'foo', 'qux']
+        os.makedirs(os.path.join('12', '34', 'meh.git'))
+        os.rmdir(os.path.join('ab', 'cd', 'foo.git'))
+        os.rmdir(os.path.join('ab', 'cd', 'bar.git'))
+        os.rmdir(os.path.join('ab', 'cd'))
+        await asyncio.sleep(0.1)
+        assert index.names() == ['meh', 'qux']
+    finally:
+        index.close()
+
+
+class OutOfWatches(object):
+    """C library that can't add any more inotify watches."""
+
+    def __init__(self, libc):
+        self.inotify_init1 = libc.inotify_init1
+
+    def inotify_add_watch(self, fd, path, mask):
+        ctypes.set_errno(errno.ENOSPC)
+        return -1
+
+
+@pytest.mark.asyncio
+async def test_repository_index_watch_failure(tempdir, event_loop):
+    os.makedirs(os.path.join('ab', 'cd', 'foo.git'))
+    log = mock.MagicMock()
+    index = RepositoryIndex('.', log=log)
+    libc = OutOfWatches(_inotify())
+
+    # When we can't watch the folders.
+    with mock.patch('gitmesh.index._inotify', return_value=libc):
+        assert not index.watch(loop=event_loop)
+
+    # Then we should say so, and check the folder's mtime instead.
+    log.info.assert_called_once_with(
+        'index.watch.fail', folder='', errno=errno.ENOSPC,
+        error=os.strerror(errno.ENOSPC),
+    )
+    assert index.names() == ['foo']
+    os.mkdir('bar.git')
+    assert index.names() == ['bar', 'foo']
+    index.close()
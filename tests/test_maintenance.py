@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import os
+import pytest
+
+from datetime import datetime
+from gitmesh.maintenance import (
+    Maintenance,
+    MAINTENANCE_STATE,
+    parse_quiet_hours,
+)
+from unittest import mock
+
+
+def test_parse_quiet_hours():
+    assert parse_quiet_hours('1-5') == (1, 5)
+    assert parse_quiet_hours('22-4') == (22, 4)
+
+
+@pytest.mark.parametrize('value', [
+    '',
+    '1',
+    '1-a',
+    '1-24',
+])
+def test_parse_quiet_hours_invalid(value):
+    with pytest.raises(ValueError) as error:
+        parse_quiet_hours(value)
+    assert str(error.value) == 'Invalid quiet hours: "%s".' % value
+
+
+@pytest.mark.parametrize('quiet_hours,hour,expected', [
+    (None, 12, True),
+    ((1, 5), 0, False),
+    ((1, 5), 1, True),
+    ((1, 5), 5, False),
+    ((22, 4), 23, True),
+    ((22, 4), 3, True),
+    ((22, 4), 12, False),
+])
+def test_quiet_hours(storage, quiet_hours, hour, expected):
+    maintenance = Maintenance(
+        storage,
+        quiet_hours=quiet_hours,
+        now=lambda: datetime(2016, 5, 8, hour, 0, 0),
+    )
+    assert maintenance.in_quiet_hours() == expected
+
+
+@pytest.mark.asyncio
+async def test_maintenance(storage, workspace):
+    log = mock.MagicMock()
+    maintenance = Maintenance(storage, threshold=2, log=log)
+
+    # Given a repository with some history.
+    repo = await storage.create_repo('foo')
+    fork = await workspace.clone(repo.path)
+    await fork.run('git config user.name "py.test"')
+    await fork.run('git config user.email "noreply@example.org"')
+    fork.edit('README', 'Hello!')
+    await fork.run('git add README')
+    await fork.run('git commit -m "Starts project."')
+    await fork.run('git push origin master')
+
+    # When it receives enough pushes.
+    maintenance.notify_push('foo')
+    await maintenance.flush()
+    assert maintenance.due() == []
+    maintenance.notify_push('foo')
+    assert maintenance.due() == ['foo']
+
+    # And we maintain it.
+    await maintenance.maintain('foo')
+
+    # Then it should be repacked with bitmaps and a commit-graph.
+    state = await maintenance.state('foo')
+    assert state['pushes'] == 0
+    assert state['running'] is False
+    assert state['error'] is None
+    assert state['last_run']
+    assert sorted(state['tasks']) == [
+        'commit-graph',
+        'multi-pack-index',
+        'repack',
+    ]
+    packs = os.listdir(os.path.join(repo.path, 'objects', 'pack'))
+    assert any(pack.endswith('.bitmap') for pack in packs)
+    assert os.path.isfile(os.path.join(
+        repo.path, 'objects', 'info', 'commit-graph',
+    ))
+    assert maintenance.due() == []
+
+    # And the state should survive restarts.
+    with open(os.path.join(repo.path, MAINTENANCE_STATE), 'r') as stream:
+        assert 'running' not in json.load(stream)
+    maintenance = Maintenance(storage, threshold=2, log=log)
+    assert (await maintenance.state('foo'))['last_run'] == state['last_run']
+
+
+@pytest.mark.asyncio
+async def test_maintenance_failure(storage):
+    log = mock.MagicMock()
+    maintenance = Maintenance(storage, log=log)
+
+    # Given a repository is corrupt.
+    repo = await storage.create_repo('foo')
+    os.unlink(os.path.join(repo.path, 'HEAD'))
+
+    # When we maintain it.
+    await maintenance.maintain('foo')
+
+    # Then the error should be recorded.
+    state = await maintenance.state('foo')
+    assert state['error'].startswith('repack: ')
+    assert list(state['tasks']) == ['repack']
+
+
+@pytest.mark.asyncio
+async def test_maintenance_schedule(storage):
+    log = mock.MagicMock()
+    maintenance = Maintenance(storage, log=log)
+    await storage.create_repo('foo')
+
+    # When we schedule maintenance.
+    assert await maintenance.schedule('foo')
+
+    # Then it should start in the background.
+    assert (await maintenance.state('foo'))['running']
+    assert not await maintenance.schedule('foo')
+    await maintenance.close()
+    assert not (await maintenance.state('foo'))['running']
+
+
+@pytest.mark.asyncio
+async def test_maintenance_push_counts(storage):
+    log = mock.MagicMock()
+    maintenance = Maintenance(storage, threshold=2, log=log)
+    await storage.create_repo('foo')
+    await storage.create_repo('bar')
+
+    # Given pushes were counted, including for a repository since deleted.
+    maintenance.notify_push('foo')
+    maintenance.notify_push('bar')
+    await storage.delete_repo('bar')
+
+    # When the server shuts down.
+    await maintenance.close()
+
+    # Then counts should survive the restart.
+    maintenance = Maintenance(storage, threshold=2, log=log)
+    assert (await maintenance.state('foo'))['pushes'] == 1
+    maintenance.notify_push('foo')
+    assert maintenance.due() == ['foo']
+
+    # And state files should be read and written off the event loop.
+    assert storage.stats()['operations']['maintenance']['count'] > 0
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import collections
+import os
+import pytest
+import sys
+import threading
+import time
+
+from gitmesh import plugins
+from gitmesh.plugins import (
+    batched,
+    cache_path,
+    CACHE_VAR,
+    find_entry_points,
+    independent,
+    is_batched,
+    load,
+    PluginRegistry,
+    registry,
+    run_plugins,
+)
+from unittest import mock
+
+
+def install(folder, name, entry_points):
+    """Fake the installation of a distribution (only its metadata)."""
+    path = os.path.join(folder, '%s-1.0.dist-info' % name)
+    os.makedirs(path)
+    with open(os.path.join(path, 'METADATA'), 'w') as stream:
+        stream.write('Metadata-Version: 2.1\nName: %s\nVersion: 1.0\n' % name)
+    with open(os.path.join(path, 'entry_points.txt'), 'w') as stream:
+        for group, members in entry_points.items():
+            stream.write('[%s]\n' % group)
+            for plugin in members:
+                stream.write('%s = %s\n' % plugin)
+
+
+def test_plugin_registry(tempdir):
+    folder = os.path.abspath('site-packages')
+    path = [folder, os.path.abspath('missing')]
+    cache = os.path.abspath(os.path.join('cache', 'plugins.json'))
+
+    # Given an installed plug-in.
+    install(folder, 'echo', {
+        'gitmesh.update': [('echo', 'echo:update')],
+        'console_scripts': [('echo', 'echo:main')],
+    })
+
+    # When we look for plug-ins.
+    registry = PluginRegistry(path=path, cache=cache)
+    assert registry.entry_points('gitmesh.update') == [
+        ('echo', 'echo:update'),
+    ]
+    assert registry.entry_points('gitmesh.pre_receive') == []
+    assert registry.entry_points('console_scripts') == []
+
+    # Then results should be cached, in memory and on disk.
+    assert os.path.isfile(cache)
+    with mock.patch('gitmesh.plugins.scan') as scan:
+        assert registry.entry_points('gitmesh.update') == [
+            ('echo', 'echo:update'),
+        ]
+        assert PluginRegistry(path=path, cache=cache).entry_points(
+            'gitmesh.update',
+        ) == [
+            ('echo', 'echo:update'),
+        ]
+    scan.assert_not_called()
+
+    # When another plug-in is installed.
+    install(folder, 'ping', {
+        'gitmesh.update': [('ping', 'ping:update')],
+    })
+
+    # Then it should be found.
+    assert sorted(registry.entry_points('gitmesh.update')) == [
+        ('echo', 'echo:update'),
+        ('ping', 'ping:update'),
+    ]
+
+
+def test_plugin_registry_shadowed(tempdir):
+    # Given two versions of the same plug-in.
+    install('a', 'echo', {'gitmesh.update': [('echo', 'a:update')]})
+    install('b', 'echo', {'gitmesh.update': [('echo', 'b:update')]})
+
+    # When we look for plug-ins.
+    registry = PluginRegistry(path=[os.path.abspath('a'), 'b'])
+
+    # Then the first one on the path should win.
+    assert registry.entry_points('gitmesh.update') == [
+        ('echo', 'a:update'),
+    ]
+
+
+@pytest.mark.parametrize('cache', [
+    'corrupt.json',
+    'list.json',
+    'README.txt/plugins.json',
+])
+def test_plugin_registry_cache_errors(tempdir, cache):
+    install('.', 'echo', {'gitmesh.update': [('echo', 'echo:update')]})
+
+    # Given a cache we can't use.
+    with open('corrupt.json', 'w') as stream:
+        stream.write('{')
+    with open('list.json', 'w') as stream:
+        stream.write('[]')
+    with open('README.txt', 'w') as stream:
+        stream.write('Not a folder.')
+
+    # When we look for plug-ins, they should still be found.
+    registry = PluginRegistry(path=[os.getcwd()], cache=cache)
+    assert registry.entry_points('gitmesh.update') == [
+        ('echo', 'echo:update'),
+    ]
+
+
+def test_find_entry_points(tempdir):
+    install('.', 'echo', {
+        'gitmesh.update': [('echo', 'os.path:join')],
+        'gitmesh.post_update': [('echo', 'collections:OrderedDict.copy')],
+    })
+
+    # When we load plug-ins.
+    registry = PluginRegistry(path=[os.getcwd()])
+    with mock.patch('gitmesh.plugins._registry', registry):
+        update = list(find_entry_points('gitmesh.update'))
+        post_update = list(find_entry_points('gitmesh.post_update'))
+
+    # Then we should get the objects they name.
+    assert update == [('echo', os.path.join)]
+    assert post_update == [('echo', collections.OrderedDict.copy)]
+    assert load('os') is os
+
+
+def test_registry():
+    with mock.patch('gitmesh.plugins._registry', None):
+        assert registry() is registry()
+        assert plugins._registry is registry()
+
+
+@pytest.mark.parametrize('env,path', [
+    ({CACHE_VAR: '/tmp/plugins.json'}, '/tmp/plugins.json'),
+    ({CACHE_VAR: ''}, None),
+    ({'XDG_CACHE_HOME': '/var/cache'}, '/var/cache/gitmesh/plugins.json'),
+    ({'HOME': '/home/git'}, '/home/git/.cache/gitmesh/plugins.json'),
+])
+def test_cache_path(env, path):
+    with mock.patch.dict('os.environ', env, clear=True):
+        assert cache_path() == path
+
+
+def test_independent():
+    @independent
+    def foo():
+        pass
+
+    @independent(timeout=5.0)
+    def bar():
+        pass
+
+    assert foo.gitmesh_independent is True
+    assert foo.gitmesh_timeout is None
+    assert bar.gitmesh_independent is True
+    assert bar.gitmesh_timeout == 5.0
+
+
+def test_batched():
+    @batched
+    def foo(updates):
+        pass
+
+    def bar(ref, old, new):
+        pass
+
+    assert is_batched(foo)
+    assert not is_batched(bar)
+    assert not is_batched(mock.MagicMock())
+
+
+@pytest.mark.asyncio
+async def test_run_plugins_results():
+
+    @independent
+    async def foo(updates):
+        await asyncio.sleep(0.05)
+        return ['refs/heads/foo']
+
+    def bar(updates):
+        return sorted(updates)
+
+    # When plug-ins return something, each in their own time.
+    results = await run_plugins('update', [('foo', foo), ('bar', bar)], {
+        'updates': {'refs/heads/master': ('a', 'b')},
+    }, mock.MagicMock())
+
+    # Then we should get results in plug-in order.
+    assert results == [['refs/heads/foo'], ['refs/heads/master']]
+
+
+@pytest.mark.asyncio
+async def test_run_plugins(capsys):
+    log = mock.MagicMock()
+    calls = []
+
+    def foo(ref):
+        calls.append(('foo', ref))
+
+    async def bar(ref):
+        calls.append(('bar', ref))
+
+    def qux(ref):
+        raise ValueError(ref)
+
+    # When plug-ins run, one after the other.
+    with pytest.raises(ValueError):
+        await run_plugins('update', [
+            ('foo', foo), ('bar', bar), ('qux', qux), ('meh', foo),
+        ], {'ref': 'refs/heads/master'}, log, timeout=1.0, verbose=True)
+
+    # Then they should run in order, until one fails.
+    assert calls == [
+        ('foo', 'refs/heads/master'),
+        ('bar', 'refs/heads/master'),
+    ]
+    assert log.info.call_args_list == [
+        mock.call('git.hooks.plugin', hook='update', plugin=name,
+                  independent=False, status=status, duration=mock.ANY)
+        for name, status in [('foo', 'ok'), ('bar', 'ok'), ('qux', 'failed')]
+    ]
+    out, _ = capsys.readouterr()
+    assert out == "Running hook 'foo'.\nRunning hook 'bar'.\n" \
+                  "Running hook 'qux'.\n"
+
+
+@pytest.mark.asyncio
+async def test_run_plugins_concurrently():
+    log = mock.MagicMock()
+    calls = []
+
+    @independent
+    async def foo(updates):
+        await asyncio.sleep(0.2)
+        calls.append('foo')
+
+    @independent
+    def bar(updates):
+        time.sleep(0.2)
+        calls.append('bar')
+
+    @independent
+    def qux(updates):
+        raise ValueError('Nope.')
+
+    def meh(updates):
+        calls.append('meh')
+
+    # When independent plug-ins run.
+    ref = time.monotonic()
+    with pytest.raises(ValueError):
+        await run_plugins('post-receive', [
+            ('foo', foo), ('bar', bar), ('qux', qux), ('meh', meh),
+        ], {'updates': {}}, log)
+
+    # Then they should run at the same time as other plug-ins, and errors
+    # should only be reported once they're all done.
+    assert time.monotonic() - ref < 0.4
+    assert sorted(calls) == ['bar', 'foo', 'meh']
+    assert sorted(
+        (call[1]['plugin'], call[1]['independent'], call[1]['status'])
+        for call in log.info.call_args_list
+    ) == [
+        ('bar', True, 'ok'),
+        ('foo', True, 'ok'),
+        ('meh', False, 'ok'),
+        ('qux', True, 'failed'),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_run_plugins_exit():
+    log = mock.MagicMock()
+    calls = []
+
+    @independent
+    async def foo(ref):
+        await asyncio.sleep(0.05)
+        sys.exit(2)
+
+    @independent
+    def bar(ref):
+        time.sleep(0.05)
+        calls.append('bar')
+        sys.exit(3)
+
+    def qux(ref):
+        sys.exit(1)
+
+    # When plug-ins exit, e.g. to reject an update.
+    with pytest.raises(SystemExit) as error:
+        await run_plugins('update', [
+            ('foo', foo), ('bar', bar), ('qux', qux),
+        ], {'ref': 'refs/heads/master'}, log)
+
+    # Then the first exit should be reported, once they're all done.
+    assert error.value.code == 1
+    assert calls == ['bar']
+    assert sorted(
+        (call[1]['plugin'], call[1]['status'])
+        for call in log.info.call_args_list
+    ) == [('bar', 'failed'), ('foo', 'failed'), ('qux', 'failed')]
+
+
+@pytest.mark.asyncio
+async def test_run_plugins_timeout():
+    log = mock.MagicMock()
+    done = threading.Event()
+
+    @independent(timeout=0.05)
+    def foo(updates):
+        done.wait()
+
+    # When an independent plug-in takes too long.
+    with pytest.raises(asyncio.TimeoutError):
+        await run_plugins('post-receive', [('foo', foo)], {'updates': {}},
+                          log, timeout=10.0)
+
+    # Then it should be reported, and its result ignored.
+    log.info.assert_called_once_with(
+        'git.hooks.plugin', hook='post-receive', plugin='foo',
+        independent=True, status='timeout', duration=mock.ANY,
+    )
+    done.set()
+    await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_run_plugins_deadline():
+    log = mock.MagicMock()
+
+    async def foo(refs):
+        await asyncio.sleep(10.0)
+
+    # When plug-ins take too long.
+    with pytest.raises(asyncio.TimeoutError):
+        await run_plugins('post-update', [('foo', foo)], {'refs': []},
+                          log, deadline=0.05)
+
+    # Then they should be cancelled.
+    await asyncio.sleep(0.01)
+    assert log.info.call_count == 2
+    log.info.assert_has_calls([
+        mock.call('git.hooks.plugin', hook='post-update', plugin='foo',
+                  independent=False, status='cancelled', duration=mock.ANY),
+        mock.call('git.hooks.timeout', hook='post-update', deadline=0.05),
+    ], any_order=True)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import pytest
+
+from aiohttp import web
+from gitmesh.server import Scheduler
+
+
+@pytest.mark.asyncio
+async def test_scheduler_admission():
+    scheduler = Scheduler(limits={'fetch': (1, 8)})
+    order = []
+    release = asyncio.Event()
+
+    async def fetch(name, i):
+        async with scheduler.slot('fetch', name):
+            order.append((name, i))
+            await release.wait()
+
+    # Given a fetch is running.
+    tasks = [asyncio.ensure_future(fetch('foo', 0))]
+    await asyncio.sleep(0.01)
+    assert order == [('foo', 0)]
+
+    # When more fetches queue up, mostly for the same repository.
+    tasks.extend([
+        asyncio.ensure_future(fetch('foo', 1)),
+        asyncio.ensure_future(fetch('foo', 2)),
+        asyncio.ensure_future(fetch('bar', 3)),
+    ])
+    await asyncio.sleep(0.01)
+    stats = scheduler.stats()['fetch']
+    assert stats['running'] == 1
+    assert stats['queued'] == 3
+
+    # Then they're admitted one at a time, taking turns across repositories.
+    release.set()
+    await asyncio.gather(*tasks)
+    assert order == [('foo', 0), ('foo', 1), ('bar', 3), ('foo', 2)]
+    stats = scheduler.stats()['fetch']
+    assert stats['running'] == 0
+    assert stats['queued'] == 0
+    assert stats['admitted'] == 4
+    assert stats['rejected'] == 0
+    assert stats['wait_time_max'] > 0.0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_rejection():
+    scheduler = Scheduler(limits={'push': (1, 1)}, retry_after=7)
+
+    # Given a push is running and another one is waiting.
+    await scheduler.acquire('push', 'foo')
+    waiter = asyncio.ensure_future(scheduler.acquire('push', 'foo'))
+    await asyncio.sleep(0.01)
+
+    # When yet another push comes in.
+    with pytest.raises(web.HTTPServiceUnavailable) as error:
+        await scheduler.acquire('push', 'bar')
+
+    # Then it should be rejected right away.
+    assert error.value.headers['Retry-After'] == '7'
+    assert scheduler.stats()['push']['rejected'] == 1
+
+    # Other classes are not affected.
+    await scheduler.acquire('advertise', 'bar')
+
+    scheduler.release('push')
+    await waiter
+    scheduler.release('push')
+    scheduler.release('advertise')
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancel_waiter():
+    scheduler = Scheduler(limits={'fetch': (1, 8)})
+
+    # Given a fetch is running and another one is waiting.
+    await scheduler.acquire('fetch', 'foo')
+    waiter = asyncio.ensure_future(scheduler.acquire('fetch', 'foo'))
+    await asyncio.sleep(0.01)
+
+    # When the waiting request goes away.
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    # Then it should leave the queue.
+    assert scheduler.stats()['fetch']['queued'] == 0
+    scheduler.release('fetch')
+    assert scheduler.stats()['fetch']['running'] == 0
@@ -1,10 +1,34 @@
 # -*- coding: utf-8 -*-
 
 
+import asyncio
+import binascii
 import json
 import logging
+import os
 import pytest
 
+from aiohttp import web
+from asyncio import subprocess
+from gitmesh.bundles import Bundles
+from gitmesh.server import (
+    BATCH_SIZE_MAX,
+    etag_matches,
+    iter_json,
+    parse_range,
+    pkt_line,
+    protocol_version,
+    read_cgi_head,
+    RepositoryURLs,
+)
+from gitmesh.storage import start_process
+from unittest import mock
+
+
+def listed(repo):
+    """Listings don't include bundles."""
+    return {k: v for k, v in repo.items() if k != 'bundles'}
+
 
 @pytest.mark.asyncio
 async def test_create_repository(server, client):
@@ -28,6 +52,7 @@ async def test_create_repository(server, client):
             ],
             'details': 'http://%s/repositories/foo' % server,
             'delete': 'http://%s/repositories/foo' % server,
+            'bundles': [],
         }
 
 
@@ -51,6 +76,7 @@ async def test_create_existing_repository(server, client):
             ],
             'details': 'http://%s/repositories/foo' % server,
             'delete': 'http://%s/repositories/foo' % server,
+            'bundles': [],
         }
 
     # When we try to create it again.
@@ -80,6 +106,27 @@ async def test_create_repository_invalid_request(server, client):
         assert rep.status == 400
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize('name', ['a/b', '../x', '.hidden', 'a..b', ''])
+async def test_create_repository_invalid_name(server, client, storage, name):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # When we try to create a repository whose name isn't a folder name.
+    req = json.dumps({
+        'name': name,
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+
+        # Then the request should be rejected.
+        assert rep.status == 400
+
+    # And nothing should have been created.
+    assert (await storage.list_repositories()) == []
+
+
 @pytest.mark.asyncio
 async def test_query_repository(server, client):
     # Given the server is running.
@@ -100,6 +147,7 @@ async def test_query_repository(server, client):
             ],
             'details': 'http://%s/repositories/foo' % server,
             'delete': 'http://%s/repositories/foo' % server,
+            'bundles': [],
         }
 
     # When we fetch the details.
@@ -168,12 +216,195 @@ async def test_repository_listing(server, client):
         # Then the listing shows our two repositories.
         assert listing == {
             'repositories': [
-                bar,
-                foo,
+                listed(bar),
+                listed(foo),
             ],
         }
 
 
+@pytest.mark.asyncio
+async def test_repository_listing_pages(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a few repositories exist.
+    for name in ('foo', 'bar', 'baz', 'qux', 'foobar'):
+        req = json.dumps({
+            'name': name,
+        }).encode('utf-8')
+        async with client.post(index['create'], data=req) as rep:
+            assert rep.status == 201
+
+    # When we fetch the listing, one page at a time.
+    names = []
+    url = index['list'] + '?limit=2'
+    while url:
+        async with client.get(url) as rep:
+            assert rep.status == 200
+            listing = await rep.json()
+        assert len(listing['repositories']) <= 2
+        names.extend(repo['name'] for repo in listing['repositories'])
+        url = listing.get('next')
+
+    # Then we should get all of them, in order.
+    assert names == ['bar', 'baz', 'foo', 'foobar', 'qux']
+
+    # When we only list some of them.
+    async with client.get(index['list'] + '?prefix=foo&limit=1') as rep:
+        assert rep.status == 200
+        listing = await rep.json()
+
+        # Then we should only get those.
+        assert [repo['name'] for repo in listing['repositories']] == ['foo']
+        assert listing['next'] == \
+            index['list'] + '?after=foo&limit=1&prefix=foo'
+    async with client.get(listing['next']) as rep:
+        assert rep.status == 200
+        listing = await rep.json()
+        assert [repo['name'] for repo in listing['repositories']] == [
+            'foobar',
+        ]
+        assert 'next' not in listing
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('query', [
+    'limit=0',
+    'limit=abc',
+    'order=name',
+])
+async def test_repository_listing_invalid_request(server, client, query):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # When we fetch the listing with an invalid query.
+    async with client.get(index['list'] + '?' + query) as rep:
+
+        # Then the request should be rejected.
+        assert rep.status == 400
+
+
+def test_iter_json():
+    urls = RepositoryURLs(
+        'http://localhost/repositories/\0.git/',
+        'http://localhost/repositories/\0',
+        'http://localhost/repositories/\0',
+    )
+    chunks = list(iter_json(
+        'repositories',
+        (urls(name) for name in ('foo', 'bar', 'meh')),
+        lambda: {'next': 'http://localhost/repositories?after=meh'},
+        chunk_size=100,
+    ))
+    assert len(chunks) > 1
+    assert json.loads(b''.join(chunks).decode('utf-8')) == {
+        'repositories': [
+            {
+                'name': name,
+                'clone': ['http://localhost/repositories/%s.git/' % name],
+                'details': 'http://localhost/repositories/%s' % name,
+                'delete': 'http://localhost/repositories/%s' % name,
+            }
+            for name in ('foo', 'bar', 'meh')
+        ],
+        'next': 'http://localhost/repositories?after=meh',
+    }
+    assert list(iter_json('repositories', [])) == [b'{"repositories": []}']
+
+
+@pytest.mark.asyncio
+async def test_repository_listing_etag(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And we have fetched the listing.
+    async with client.get(index['list']) as rep:
+        assert rep.status == 200
+        assert rep.headers['Cache-Control'] == 'no-cache'
+        etag = rep.headers['ETag']
+        await rep.json()
+
+    # When we fetch it again, with the ETag we got.
+    async with client.get(index['list'], headers={
+        'If-None-Match': etag,
+    }) as rep:
+
+        # Then it should not be sent again.
+        assert rep.status == 304
+        assert rep.headers['ETag'] == etag
+
+    # When a repository is created.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # Then the listing should be sent again.
+    async with client.get(index['list'], headers={
+        'If-None-Match': etag,
+    }) as rep:
+        assert rep.status == 200
+        assert rep.headers['ETag'] != etag
+        listing = await rep.json()
+        assert listing == {
+            'repositories': [listed(repo)],
+        }
+
+
+@pytest.mark.asyncio
+async def test_repository_details_etag(server, client, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # And we have fetched its details.
+    async with client.get(repo['details']) as rep:
+        assert rep.status == 200
+        etag = rep.headers['ETag']
+
+    # When we fetch them again, with the ETag we got.
+    async with client.get(repo['details'], headers={
+        'If-None-Match': etag,
+    }) as rep:
+
+        # Then they should not be sent again.
+        assert rep.status == 304
+
+    # When the repository receives a push.
+    await workspace.run('git clone %s foo' % repo['clone'][0])
+    fork = workspace.open_repo('foo', bare=False)
+    await fork.run('git config user.name "py.test"')
+    await fork.run('git config user.email "noreply@example.org"')
+    fork.edit('README.txt', 'Nothing to see here!')
+    await fork.run('git add README.txt')
+    await fork.run('git commit -m "Starts project."')
+    await fork.run('git push origin master')
+
+    # Then the details should be sent again.
+    async with client.get(repo['details'], headers={
+        'If-None-Match': etag,
+    }) as rep:
+        assert rep.status == 200
+        assert rep.headers['ETag'] != etag
+
+
 @pytest.mark.asyncio
 async def test_delete_repository(server, client):
     # Given the server is running.
@@ -203,8 +434,8 @@ async def test_delete_repository(server, client):
         # Then the listing shows our two repositories.
         assert listing == {
             'repositories': [
-                bar,
-                foo,
+                listed(bar),
+                listed(foo),
             ],
         }
 
@@ -222,7 +453,7 @@ async def test_delete_repository(server, client):
         # Then the listing shows only the remaining repository.
         assert listing == {
             'repositories': [
-                bar,
+                listed(bar),
             ],
         }
 
@@ -243,6 +474,288 @@ async def test_delete_unknown_repository(server, client):
         assert rep.status == 404
 
 
+@pytest.mark.asyncio
+async def test_import_repository(file_import_server, client, workspace):
+    server = file_import_server
+
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository on another server.
+    upstream = await workspace.create_repo('upstream')
+
+    # When we create a repository from it.
+    req = json.dumps({
+        'name': 'foo',
+        'clone_url': 'file://' + upstream.path,
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 202
+        job = await rep.json()
+        assert rep.headers['Location'] == job['job']
+
+    # Then the import should run in the background.
+    assert job['name'] == 'foo'
+    assert job['state'] in ('queued', 'running')
+    assert job['details'] == 'http://%s/repositories/foo' % server
+    while job['state'] in ('queued', 'running'):
+        await asyncio.sleep(0.05)
+        async with client.get(job['job']) as rep:
+            assert rep.status == 200
+            job = await rep.json()
+    assert job['state'] == 'done'
+    async with client.get(job['details']) as rep:
+        assert rep.status == 200
+
+    # And cancelling it should no longer have any effect.
+    async with client.delete(job['job']) as rep:
+        assert rep.status == 200
+        assert (await rep.json())['state'] == 'done'
+
+    # When we import it again.
+    async with client.post(index['create'], data=req) as rep:
+
+        # Then the request fails.
+        assert rep.status == 409
+
+
+@pytest.mark.asyncio
+async def test_import_repository_conflict(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    async def slow_clone(*args, **kwds):
+        return await start_process(['sleep', '10'], split=True,
+                                   stdin=subprocess.DEVNULL)
+
+    with mock.patch('gitmesh.imports.start_process') as clone:
+        clone.side_effect = slow_clone
+
+        # And an import is in progress.
+        req = json.dumps({
+            'name': 'foo',
+            'clone_url': 'file:///dev/null',
+        }).encode('utf-8')
+        async with client.post(index['create'], data=req) as rep:
+            assert rep.status == 202
+            job = await rep.json()
+
+        # When we create or import the same repository.
+        async with client.post(index['create'], data=req) as rep:
+            assert rep.status == 409
+        req = json.dumps({
+            'name': 'foo',
+        }).encode('utf-8')
+        async with client.post(index['create'], data=req) as rep:
+            assert rep.status == 409
+
+        # Or fork another repository under the same name.
+        req = json.dumps({
+            'name': 'bar',
+        }).encode('utf-8')
+        async with client.post(index['create'], data=req) as rep:
+            assert rep.status == 201
+        req = json.dumps({
+            'name': 'foo',
+        }).encode('utf-8')
+        fork = 'http://%s/repositories/bar/forks' % server
+        async with client.post(fork, data=req) as rep:
+            assert rep.status == 409
+
+        # When we cancel the import.
+        async with client.delete(job['job']) as rep:
+            assert rep.status == 200
+            job = await rep.json()
+
+    # Then it should be cancelled.
+    assert job['state'] == 'cancelled'
+
+
+@pytest.mark.asyncio
+async def test_unknown_job(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+
+    # Then unknown jobs can't be queried or cancelled.
+    job = 'http://%s/jobs/unknown' % server
+    async with client.get(job) as rep:
+        assert rep.status == 404
+    async with client.delete(job) as rep:
+        assert rep.status == 404
+
+
+@pytest.mark.asyncio
+async def test_fork_repository(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+    fork = 'http://%s/repositories/foo/forks' % server
+
+    # When we fork it.
+    req = json.dumps({
+        'name': 'bar',
+    }).encode('utf-8')
+    async with client.post(fork, data=req) as rep:
+        assert rep.status == 201
+        bar = await rep.json()
+
+    # Then the fork should exist.
+    assert bar == {
+        'name': 'bar',
+        'clone': [
+            'http://%s/repositories/bar.git/' % server,
+        ],
+        'details': 'http://%s/repositories/bar' % server,
+        'delete': 'http://%s/repositories/bar' % server,
+        'bundles': [],
+    }
+    async with client.get(bar['details']) as rep:
+        assert rep.status == 200
+
+    # When we fork it again.
+    async with client.post(fork, data=req) as rep:
+
+        # Then the request fails.
+        assert rep.status == 409
+
+    # When we fork an unknown repository.
+    async with client.post(fork.replace('foo', 'meh'), data=req) as rep:
+
+        # Then the request fails.
+        assert rep.status == 404
+
+    # When we don't name the fork.
+    async with client.post(fork, data=b'{}') as rep:
+
+        # Then the request fails.
+        assert rep.status == 400
+
+
+@pytest.mark.asyncio
+async def test_batch_repositories(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        foo = await rep.json()
+
+    # When we create and delete a bunch of repositories at once.
+    req = json.dumps({
+        'operations': [
+            {'op': 'create', 'name': 'repo-%02d' % i} for i in range(20)
+        ] + [
+            {'op': 'create', 'name': 'foo'},
+        ],
+    }).encode('utf-8')
+    async with client.post(index['batch'], data=req) as rep:
+        assert rep.status == 200
+        batch = await rep.json()
+
+    # Then each operation should have its own result, in order.
+    results = batch['results']
+    assert [r['status'] for r in results] == [201] * 20 + [409]
+    assert results[0] == {
+        'op': 'create',
+        'name': 'repo-00',
+        'status': 201,
+        'repository': {
+            'name': 'repo-00',
+            'clone': [
+                'http://%s/repositories/repo-00.git/' % server,
+            ],
+            'details': 'http://%s/repositories/repo-00' % server,
+            'delete': 'http://%s/repositories/repo-00' % server,
+            'bundles': [],
+        },
+    }
+    async with client.get(results[19]['repository']['details']) as rep:
+        assert rep.status == 200
+
+    # When we delete some of them (and an unknown one).
+    req = json.dumps({
+        'operations': [
+            {'op': 'delete', 'name': 'foo'},
+            {'op': 'delete', 'name': 'bar'},
+        ] + [
+            {'op': 'delete', 'name': 'repo-%02d' % i} for i in range(1, 20)
+        ],
+    }).encode('utf-8')
+    async with client.post(index['batch'], data=req) as rep:
+        assert rep.status == 200
+        batch = await rep.json()
+    assert [r['status'] for r in batch['results']] == [200, 404] + [200] * 19
+
+    # Then only the rest should be left.
+    async with client.get(index['list']) as rep:
+        assert rep.status == 200
+        listing = await rep.json()
+    assert [r['name'] for r in listing['repositories']] == ['repo-00']
+    async with client.get(foo['details']) as rep:
+        assert rep.status == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('operations', [
+    [{'op': 'rename', 'name': 'foo'}],
+    [{'op': 'create'}],
+    [{'op': 'create', 'name': 'foo'}, {'op': 'delete', 'name': 'foo'}],
+])
+async def test_batch_repositories_invalid(server, client, operations):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # When we send an invalid batch.
+    req = json.dumps({
+        'operations': operations,
+    }).encode('utf-8')
+    async with client.post(index['batch'], data=req) as rep:
+
+        # Then the request fails.
+        assert rep.status == 400
+
+
+@pytest.mark.asyncio
+async def test_batch_repositories_too_large(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # When we send a batch that is too large.
+    req = json.dumps({
+        'operations': [
+            {'op': 'create', 'name': 'repo-%d' % i}
+            for i in range(BATCH_SIZE_MAX + 1)
+        ],
+    }).encode('utf-8')
+    async with client.post(index['batch'], data=req) as rep:
+
+        # Then the request fails.
+        assert rep.status == 413
+
+
 @pytest.mark.asyncio
 async def test_clone_repository(server, client, run, workspace,
                                 fluent_emit, fluent_server):
@@ -266,6 +779,7 @@ async def test_clone_repository(server, client, run, workspace,
             ],
             'details': 'http://%s/repositories/foo' % server,
             'delete': 'http://%s/repositories/foo' % server,
+            'bundles': [],
         }
 
         assert rep.headers['X-Request-Id']
@@ -297,3 +811,644 @@ async def test_clone_repository(server, client, run, workspace,
     assert fluent_emit.call_count > 0
     # Git hook logs will be sent to our mock FluentD server.
     assert len(fluent_server[2]) > 0
+
+
+@pytest.mark.asyncio
+async def test_push_chunked(server, client, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # And we have a commit that is larger than the Git client's post buffer.
+    clone_url = repo['clone'][0]
+    await workspace.run('git clone ' + clone_url)
+    repo = workspace.open_repo(repo['name'], bare=False)
+    await repo.run('git config user.name "py.test"')
+    await repo.run('git config user.email "noreply@example.org"')
+    repo.edit('random.txt', binascii.hexlify(os.urandom(64 * 1024)).decode())
+    await repo.run('git add random.txt')
+    await repo.run('git commit -m "Adds random data."')
+    commit = await repo.run('git rev-parse HEAD')
+
+    # When we push it using chunked transfer encoding.
+    await repo.run('git -c http.postBuffer=1024 push origin master')
+
+    # Then the server should have received the commit.
+    output = await repo.run('git ls-remote origin refs/heads/master')
+    assert output == '%s\trefs/heads/master' % commit
+
+
+@pytest.mark.asyncio
+async def test_push_failure(server, client, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+    maintenance_url = repo['details'] + '/maintenance'
+
+    # When a push fails.
+    url = repo['clone'][0] + 'git-receive-pack'
+    headers = {'Content-Type': 'application/x-git-receive-pack-request'}
+    async with client.post(url, data=b'garbage', headers=headers) as rep:
+        assert rep.status == 500
+
+    # Then it should not count as a push.
+    async with client.get(maintenance_url) as rep:
+        assert rep.status == 200
+        state = await rep.json()
+        assert state['pushes'] == 0
+
+    # When a push succeeds.
+    await workspace.run('git clone ' + repo['clone'][0])
+    repo = workspace.open_repo(repo['name'], bare=False)
+    await repo.run('git config user.name "py.test"')
+    await repo.run('git config user.email "noreply@example.org"')
+    repo.edit('README.txt', 'Nothing to see here!')
+    await repo.run('git add README.txt')
+    await repo.run('git commit -m "Starts project."')
+    await repo.run('git push origin master')
+
+    # Then it should count.
+    async with client.get(maintenance_url) as rep:
+        assert rep.status == 200
+        state = await rep.json()
+        assert state['pushes'] == 1
+
+
+@pytest.mark.asyncio
+async def test_read_cgi_head(event_loop):
+    stream = asyncio.StreamReader(loop=event_loop)
+    stream.feed_data(b'Status: 404 Not Found\r\n')
+    stream.feed_data(b'Content-Type: text/plain\r\n')
+    stream.feed_data(b'\r\nNot found.')
+    stream.feed_eof()
+    head = await read_cgi_head(stream)
+    assert head == {
+        'Status': '404 Not Found',
+        'Content-Type': 'text/plain',
+    }
+    assert (await stream.read()) == b'Not found.'
+
+
+@pytest.mark.asyncio
+async def test_read_cgi_head_truncated(event_loop):
+    stream = asyncio.StreamReader(loop=event_loop)
+    stream.feed_data(b'Content-Type: text/plain\r\n')
+    stream.feed_eof()
+    head = await read_cgi_head(stream)
+    assert head is None
+
+
+def test_pkt_line():
+    assert pkt_line(b'# service=git-upload-pack\n') == \
+        b'001e# service=git-upload-pack\n'
+
+
+@pytest.mark.asyncio
+async def test_info_refs(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # When we fetch the ref advertisement.
+    url = repo['clone'][0] + 'info/refs?service=git-upload-pack'
+    async with client.get(url) as rep:
+
+        # Then we should get the smart HTTP advertisement.
+        assert rep.status == 200
+        assert rep.headers['Content-Type'] == \
+            'application/x-git-upload-pack-advertisement'
+        body = await rep.read()
+        assert body.startswith(b'001e# service=git-upload-pack\n0000')
+
+    # When we fetch it again.
+    async with client.get(url) as rep:
+
+        # Then we should get the same advertisement, from cache.
+        assert rep.status == 200
+        assert rep.headers['Content-Type'] == \
+            'application/x-git-upload-pack-advertisement'
+        assert (await rep.read()) == body
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        metrics = await rep.json()
+        assert metrics['refs_cache']['hits'] == 1
+        assert metrics['refs_cache']['misses'] == 1
+        assert metrics['queue']['pending'] == 0
+
+
+@pytest.mark.asyncio
+async def test_info_refs_protocol_v2(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # When we fetch the ref advertisement using protocol v2 (twice).
+    url = repo['clone'][0] + 'info/refs?service=git-upload-pack'
+    for _ in range(2):
+        headers = {'Git-Protocol': 'version=2'}
+        async with client.get(url, headers=headers) as rep:
+
+            # Then we should get the v2 capability advertisement.
+            assert rep.status == 200
+            body = await rep.read()
+            assert body.startswith(b'000eversion 2\n')
+            assert b'ls-refs' in body
+
+    # And it should not be mixed up with the v0 advertisement.
+    async with client.get(url) as rep:
+        assert rep.status == 200
+        body = await rep.read()
+        assert body.startswith(b'001e# service=git-upload-pack\n0000')
+
+
+def test_protocol_version():
+    assert protocol_version(None) == 0
+    assert protocol_version('') == 0
+    assert protocol_version('version=1') == 1
+    assert protocol_version('version=2') == 2
+    assert protocol_version('foo=bar:version=2') == 2
+    assert protocol_version('version=x') == 0
+
+
+@pytest.mark.asyncio
+async def test_info_refs_unknown_repository(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+
+    # But the repository does not exist.
+    url = 'http://%s/repositories/foo.git/info/refs' % server
+
+    # When we fetch the ref advertisement.
+    async with client.get(url + '?service=git-upload-pack') as rep:
+
+        # Then the request should fail.
+        assert rep.status == 404
+
+
+@pytest.mark.asyncio
+async def test_static_files(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # When we fetch its HEAD.
+    url = repo['clone'][0] + 'HEAD'
+    async with client.get(url) as rep:
+
+        # Then we should get the file as-is.
+        assert rep.status == 200
+        assert rep.headers['Content-Type'] == 'text/plain'
+        assert rep.headers['Accept-Ranges'] == 'bytes'
+        assert (await rep.read()) == b'ref: refs/heads/master\n'
+        etag = rep.headers['ETag']
+
+    # When we fetch part of it.
+    async with client.get(url, headers={'Range': 'bytes=5-'}) as rep:
+
+        # Then we should get only that part.
+        assert rep.status == 206
+        assert rep.headers['Content-Range'] == 'bytes 5-22/23'
+        assert (await rep.read()) == b'refs/heads/master\n'
+
+    # When we fetch it again, with the ETag we got.
+    async with client.get(url, headers={'If-None-Match': etag}) as rep:
+
+        # Then it should not be sent again.
+        assert rep.status == 304
+        assert rep.headers['ETag'] == etag
+
+
+def test_parse_range():
+    assert parse_range(None, 10) is None
+    assert parse_range('bytes=0-', 10) == (0, 9)
+    assert parse_range('bytes=2-4', 10) == (2, 4)
+    assert parse_range('bytes=2-40', 10) == (2, 9)
+    assert parse_range('bytes=-3', 10) == (7, 9)
+    assert parse_range('bytes=-30', 10) == (0, 9)
+    assert parse_range('bytes=0-1,4-5', 10) is None
+    assert parse_range('lines=0-1', 10) is None
+    assert parse_range('bytes=a-b', 10) is None
+    assert parse_range('bytes=3', 10) is None
+    with pytest.raises(web.HTTPRequestRangeNotSatisfiable) as exc:
+        parse_range('bytes=10-', 10)
+    assert exc.value.headers['Content-Range'] == 'bytes */10'
+
+
+def test_etag_matches():
+    assert not etag_matches(None, '"a"')
+    assert etag_matches('*', '"a"')
+    assert etag_matches('"a"', '"a"')
+    assert etag_matches('"b", W/"a"', '"a"')
+    assert not etag_matches('"b"', '"a"')
+
+
+@pytest.mark.asyncio
+async def test_clone_from_pack_cache(server, client, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository with some history exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+    clone_url = repo['clone'][0]
+    await workspace.run('git -c protocol.version=0 clone %s foo' % clone_url)
+    repo = workspace.open_repo('foo', bare=False)
+    await repo.run('git config user.name "py.test"')
+    await repo.run('git config user.email "noreply@example.org"')
+    repo.edit('README.txt', 'Nothing to see here!')
+    await repo.run('git add README.txt')
+    await repo.run('git commit -m "Starts project."')
+    await repo.run('git push origin master')
+
+    # When we clone it twice, using protocol v0.
+    await workspace.run('git -c protocol.version=0 clone %s bar' % clone_url)
+    await workspace.run('git -c protocol.version=0 clone %s meh' % clone_url)
+
+    # Then the second clone should be served from cache.
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        metrics = await rep.json()
+        assert metrics['pack_cache']['misses'] == 1
+        assert metrics['pack_cache']['hits'] == 1
+    repo = workspace.open_repo('meh', bare=False)
+    assert (await repo.run('git log --format=%s')) == 'Starts project.'
+
+
+@pytest.mark.asyncio
+async def test_clone_from_pack_cache_protocol_v2(server, client, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository with some history exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+    clone_url = repo['clone'][0]
+    await workspace.run('git -c protocol.version=2 clone %s foo' % clone_url)
+    repo = workspace.open_repo('foo', bare=False)
+    await repo.run('git config user.name "py.test"')
+    await repo.run('git config user.email "noreply@example.org"')
+    repo.edit('README.txt', 'Nothing to see here!')
+    await repo.run('git add README.txt')
+    await repo.run('git commit -m "Starts project."')
+    await repo.run('git push origin master')
+
+    # When we clone it twice, using protocol v2.
+    await workspace.run('git -c protocol.version=2 clone %s bar' % clone_url)
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        before = (await rep.json())['pack_cache']
+    await workspace.run('git -c protocol.version=2 clone %s meh' % clone_url)
+
+    # Then both requests of the second clone (``ls-refs`` and ``fetch``)
+    # should be served from cache.
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        after = (await rep.json())['pack_cache']
+        assert after['misses'] == before['misses']
+        assert after['hits'] == before['hits'] + 2
+    repo = workspace.open_repo('meh', bare=False)
+    assert (await repo.run('git log --format=%s')) == 'Starts project.'
+
+
+@pytest.mark.asyncio
+async def test_pack_cache_rejected(busy_server, client):
+    # Given the server is running, but turns down all fetches.
+    async with client.get('http://%s/' % busy_server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # When we fetch from it (twice).
+    url = repo['clone'][0] + 'git-upload-pack'
+    headers = {'Content-Type': 'application/x-git-upload-pack-request'}
+    for _ in range(2):
+        async with client.post(url, data=b'0000', headers=headers) as rep:
+
+            # Then we should be told to come back later.
+            assert rep.status == 503
+            assert rep.headers['Retry-After'] == '7'
+
+    # And nothing should be left in flight.
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        metrics = await rep.json()
+        assert metrics['scheduler']['fetch']['rejected'] == 2
+        assert metrics['pack_cache']['misses'] == 2
+        assert metrics['pack_cache']['in_flight'] == 0
+
+
+@pytest.mark.asyncio
+async def test_repository_bundles(server, client, storage, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository with some history exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+    clone_url = repo['clone'][0]
+    await workspace.run('git clone %s foo' % clone_url)
+    fork = workspace.open_repo('foo', bare=False)
+    await fork.run('git config user.name "py.test"')
+    await fork.run('git config user.email "noreply@example.org"')
+    fork.edit('README.txt', 'Nothing to see here!')
+    await fork.run('git add README.txt')
+    await fork.run('git commit -m "Starts project."')
+    await fork.run('git push origin master')
+
+    # And its protocol v2 ref advertisement is cached.
+    url = clone_url + 'info/refs?service=git-upload-pack'
+    headers = {'Git-Protocol': 'version=2'}
+    for _ in range(2):
+        async with client.get(url, headers=headers) as rep:
+            assert rep.status == 200
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        stats = (await rep.json())['refs_cache']
+
+    # When a bundle is generated for it.
+    bundle = await Bundles(storage).generate('foo')
+    assert bundle
+
+    # Then the ref advertisement should be refreshed (to advertise it).
+    async with client.get(url, headers=headers) as rep:
+        assert rep.status == 200
+    async with client.get(index['metrics']) as rep:
+        assert rep.status == 200
+        metrics = await rep.json()
+        assert metrics['refs_cache']['misses'] == stats['misses'] + 1
+        assert metrics['refs_cache']['hits'] == stats['hits']
+
+    # And it should be listed in the repository details.
+    async with client.get(repo['details']) as rep:
+        assert rep.status == 200
+        repo = await rep.json()
+    assert len(repo['bundles']) == 1
+    url = repo['bundles'][0]['url']
+    assert url == clone_url + 'gitmesh-bundles/' + bundle
+    size = repo['bundles'][0]['size']
+
+    # And it should be downloadable in parts.
+    async with client.get(url, headers={'Range': 'bytes=0-9'}) as rep:
+        assert rep.status == 206
+        assert rep.headers['Content-Type'] == 'application/x-git-bundle'
+        assert rep.headers['Content-Range'] == 'bytes 0-9/%d' % size
+        head = await rep.read()
+    async with client.get(url, headers={'Range': 'bytes=10-'}) as rep:
+        assert rep.status == 206
+        tail = await rep.read()
+    assert (head + tail).startswith(b'# v2 git bundle\n')
+    assert len(head + tail) == size
+
+
+@pytest.mark.asyncio
+async def test_repository_settings(server, client, workspace):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository with some hidden refs exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+    clone_url = repo['clone'][0]
+    await workspace.run('git clone %s foo' % clone_url)
+    fork = workspace.open_repo('foo', bare=False)
+    await fork.run('git config user.name "py.test"')
+    await fork.run('git config user.email "noreply@example.org"')
+    fork.edit('README.txt', 'Nothing to see here!')
+    await fork.run('git add README.txt')
+    await fork.run('git commit -m "Starts project."')
+    await fork.run('git push origin master master:refs/pull/1/head')
+    url = repo['details'] + '/settings'
+
+    # When we query its settings.
+    async with client.get(url) as rep:
+
+        # Then we should get the defaults.
+        assert rep.status == 200
+        assert (await rep.json()) == {
+            'hide_refs': [],
+            'allow_filter': False,
+        }
+    refs = await fork.run(['git', 'ls-remote', 'origin'])
+    assert 'refs/pull/1/head' in refs
+
+    # When we hide some refs and allow filters.
+    req = json.dumps({
+        'hide_refs': ['refs/pull/'],
+        'allow_filter': True,
+    }).encode('utf-8')
+    async with client.patch(url, data=req) as rep:
+
+        # Then the settings should be updated.
+        assert rep.status == 200
+        assert (await rep.json()) == {
+            'hide_refs': ['refs/pull/'],
+            'allow_filter': True,
+        }
+
+    # And the refs should no longer be advertised.
+    refs = await fork.run(['git', 'ls-remote', 'origin'])
+    assert 'refs/heads/master' in refs
+    assert 'refs/pull/1/head' not in refs
+
+    # And partial clones should work, with protocol v2.
+    await workspace.run([
+        'git', '-c', 'protocol.version=2', 'clone',
+        '--filter=blob:none', clone_url, 'bar',
+    ])
+    bar = workspace.open_repo('bar', bare=False)
+    assert (await bar.run('git log --format=%s')) == 'Starts project.'
+
+    # When we only change one setting.
+    req = json.dumps({
+        'allow_filter': False,
+    }).encode('utf-8')
+    async with client.patch(url, data=req) as rep:
+
+        # Then the others should be left alone.
+        assert rep.status == 200
+        assert (await rep.json()) == {
+            'hide_refs': ['refs/pull/'],
+            'allow_filter': False,
+        }
+
+
+@pytest.mark.asyncio
+async def test_repository_settings_invalid_request(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+
+    # When we send invalid settings.
+    req = json.dumps({
+        'hide_refs': 'refs/pull/',  # NOTE: intentionally not a list.
+    }).encode('utf-8')
+    async with client.patch(repo['details'] + '/settings', data=req) as rep:
+
+        # Then the request should be rejected.
+        assert rep.status == 400
+
+
+@pytest.mark.asyncio
+async def test_unknown_repository_settings(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+
+    # But the repository does not exist.
+    url = 'http://%s/repositories/foo/settings' % server
+
+    # When we query or update its settings.
+    async with client.get(url) as rep:
+
+        # Then the request should fail.
+        assert rep.status == 404
+    async with client.patch(url, data=b'{}') as rep:
+        assert rep.status == 404
+
+
+@pytest.mark.asyncio
+async def test_repository_maintenance(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+        index = await rep.json()
+
+    # And a repository exists.
+    req = json.dumps({
+        'name': 'foo',
+    }).encode('utf-8')
+    async with client.post(index['create'], data=req) as rep:
+        assert rep.status == 201
+        repo = await rep.json()
+    maintenance_url = repo['details'] + '/maintenance'
+
+    # When we query its maintenance state.
+    async with client.get(maintenance_url) as rep:
+
+        # Then it should never have been maintained.
+        assert rep.status == 200
+        state = await rep.json()
+        assert state == {
+            'pushes': 0,
+            'running': False,
+            'last_run': None,
+            'duration': None,
+            'tasks': {},
+            'error': None,
+        }
+
+    # When we request maintenance.
+    async with client.post(maintenance_url) as rep:
+
+        # Then it should start in the background.
+        assert rep.status == 202
+        state = await rep.json()
+        assert state['running'] is True
+
+
+@pytest.mark.asyncio
+async def test_unknown_repository_maintenance(server, client):
+    # Given the server is running.
+    async with client.get('http://%s/' % server) as rep:
+        assert rep.status == 200
+
+    # But the repository does not exist.
+    maintenance_url = 'http://%s/repositories/foo/maintenance' % server
+
+    # When we query its maintenance state.
+    async with client.get(maintenance_url) as rep:
+
+        # Then the request should fail.
+        assert rep.status == 404
+
+    # When we request maintenance.
+    async with client.post(maintenance_url) as rep:
+
+        # Then the request should fail.
+        assert rep.status == 404
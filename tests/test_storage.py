@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 
 
+import asyncio
 import os.path
 import pytest
 import sys
 
-from subprocess import CalledProcessError
-
-from gitmesh.storage import check_output
+from subprocess import CalledProcessError, TimeoutExpired
+
+from gitmesh.storage import (
+    check_output,
+    FileSystemExecutor,
+    FORKS_DIR,
+    InvalidRepositoryName,
+    OutputLimitExceeded,
+    RepositoryExists,
+    resolve_script,
+    shard,
+    Storage,
+    stream_output,
+    touch_ref_state,
+    UnknownRepository,
+)
+from unittest import mock
 
 
 here = os.path.dirname(os.path.abspath(__file__))
@@ -63,6 +78,22 @@ async def test_create_repository(storage):
     assert os.path.isdir(expected_path)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize('layout', ['flat', 'sharded'])
+@pytest.mark.parametrize('name', ['a/b', '../x', '.hidden', 'a..b', ''])
+async def test_create_repository_invalid_name(storage, layout, name):
+    if layout == 'sharded':
+        list(storage.migrate(layout))
+
+    # When we try to create a repository whose name isn't a folder name.
+    with pytest.raises(InvalidRepositoryName):
+        await storage.create_repo(name)
+
+    # Then nothing should be created, in or out of the storage folder.
+    assert sorted(os.listdir(storage.path)) in ([], ['.gitmesh-layout'])
+    assert not os.path.exists(os.path.join(storage.path, '..', 'x.git'))
+
+
 @pytest.mark.asyncio
 async def test_clone(storage, workspace):
     expected_path = os.path.join(workspace.path, 'foo')
@@ -158,3 +189,515 @@ async def test_install_client_hook(storage, workspace):
 
     # Then it should run as expected.
     assert output.strip() == 'Hello!'
+
+
+@pytest.mark.asyncio
+async def test_ref_state(storage, workspace):
+    # Given we have a remote repository.
+    repo = await storage.create_repo('foo')
+    state = repo.ref_state()
+    assert repo.ref_state() == state
+
+    # When we push a commit to it.
+    fork = await workspace.clone(repo.path)
+    await fork.run('git config user.name "py.test"')
+    await fork.run('git config user.email "noreply@example.org"')
+    fork.edit('README', 'Hello!')
+    await fork.run('git add README')
+    await fork.run('git commit -m "Starts project."')
+    await fork.run('git push origin master')
+
+    # Then its ref state should change.
+    assert repo.ref_state() != state
+
+
+@pytest.mark.asyncio
+async def test_list_repositories(storage):
+    # Given we have a few repositories.
+    for name in ('foo', 'bar', 'foobar'):
+        await storage.create_repo(name)
+
+    # Then they should be listed in order.
+    assert (await storage.list_repositories()) == ['bar', 'foo', 'foobar']
+    assert (await storage.list_repositories(prefix='foo', limit=1)) == [
+        'foo',
+    ]
+    assert list(storage.iter_repositories(after='bar')) == ['foo', 'foobar']
+
+    # When we delete one of them.
+    await storage.delete_repo('foo')
+
+    # Then it should no longer be listed.
+    assert (await storage.list_repositories()) == ['bar', 'foobar']
+
+
+@pytest.mark.asyncio
+async def test_storage_generation(storage):
+    generation = storage.generation
+    assert storage.epoch
+
+    # Creating a repository bumps the generation.
+    await storage.create_repo('foo')
+    assert storage.generation > generation
+    generation = storage.generation
+
+    # So do pushes.
+    storage.notify_push('foo')
+    assert storage.generation > generation
+    generation = storage.generation
+
+    # And deleting a repository.
+    await storage.delete_repo('foo')
+    assert storage.generation > generation
+    generation = storage.generation
+
+    # But not reading.
+    assert (await storage.list_repositories()) == []
+    assert storage.generation == generation
+
+
+@pytest.mark.asyncio
+async def test_storage_off_event_loop(storage):
+    await storage.create_repo('bar')
+    generation = storage.generation
+
+    # When another process creates a repository and we look for changes.
+    os.mkdir(os.path.join(storage.path, 'qux.git'))
+    await storage.refresh()
+
+    # Then we should notice (in the executor).
+    assert storage.generation > generation
+    assert storage.stats()['operations']['refresh']['count'] == 1
+
+    # And repositories should be looked up (in the executor) as well.
+    repo = await storage.find_repo('bar')
+    assert repo.path == os.path.join(storage.path, 'bar.git')
+    assert (await storage.ref_state(repo)) == repo.ref_state()
+    with pytest.raises(UnknownRepository):
+        await storage.find_repo('meh')
+    operations = storage.stats()['operations']
+    assert operations['open']['count'] == 2
+    assert operations['ref_state']['count'] == 1
+
+
+@pytest.mark.asyncio
+async def test_sharded_layout(storage):
+    # Given a few repositories in the flat layout.
+    assert storage.layout == 'flat'
+    foo = await storage.create_repo('foo')
+    await storage.create_repo('bar')
+    assert foo.path == os.path.join(storage.path, 'foo.git')
+
+    # When we migrate to the sharded layout, one repository at a time.
+    migration = storage.migrate('sharded')
+    next(migration)
+
+    # Then repositories should be reachable in either layout.
+    assert storage.layout == 'sharded'
+    assert (await storage.list_repositories()) == ['bar', 'foo']
+    for name in ('foo', 'bar'):
+        assert (await storage.repository_exists(name))
+        repo = storage.open_repo(name)
+        assert (await repo.run('git rev-parse --is-bare-repository')) == \
+            'true'
+    with pytest.raises(RepositoryExists):
+        await storage.create_repo('foo')
+    with pytest.raises(RepositoryExists):
+        await storage.create_repo('bar')
+
+    # When the migration completes.
+    assert list(migration) in (['foo'], ['bar'])
+
+    # Then all repositories should be sharded.
+    for name in ('foo', 'bar'):
+        assert storage.open_repo(name).path == os.path.join(
+            storage.path, shard(name), name + '.git',
+        )
+    assert not os.path.exists(os.path.join(storage.path, 'foo.git'))
+
+    # And new repositories should be sharded too.
+    meh = await storage.create_repo('meh')
+    assert meh.path == os.path.join(storage.path, shard('meh'), 'meh.git')
+    assert (await storage.list_repositories()) == ['bar', 'foo', 'meh']
+
+    # When we delete a repository.
+    await storage.delete_repo('meh')
+
+    # Then its (empty) shard folders should be gone.
+    assert not os.path.exists(os.path.join(
+        storage.path, shard('meh').split(os.sep)[0],
+    ))
+    with pytest.raises(UnknownRepository):
+        await storage.delete_repo('meh')
+
+    # When we go back to the flat layout.
+    assert sorted(storage.migrate('flat')) == ['bar', 'foo']
+
+    # Then everything should be back in place.
+    assert sorted(os.listdir(storage.path)) == [
+        '.gitmesh-layout', '.trash', 'bar.git', 'foo.git',
+    ]
+    assert (await storage.list_repositories()) == ['bar', 'foo']
+
+
+def test_migrate_invalid_layout(storage):
+    with pytest.raises(ValueError) as error:
+        list(storage.migrate('nested'))
+    assert str(error.value) == 'Invalid layout: "nested".'
+
+
+@pytest.mark.asyncio
+async def test_repository_config(storage, capsys):
+    # Given we have a repository.
+    repo = await storage.create_repo('foo')
+    state = repo.ref_state()
+    assert (await repo.read_config('transfer.hideRefs')) == []
+
+    # When we set a multi-valued option.
+    await repo.write_config('transfer.hideRefs', ['refs/a/', 'refs/b/'])
+
+    # Then we should get all values back.
+    assert (await repo.read_config('transfer.hideRefs')) == [
+        'refs/a/', 'refs/b/',
+    ]
+
+    # And the ref state should change (the config decides what's visible).
+    assert repo.ref_state() != state
+
+    # When we replace its values.
+    await repo.write_config('transfer.hideRefs', ['refs/c/'])
+
+    # Then the old ones should be gone.
+    assert (await repo.read_config('transfer.hideRefs')) == ['refs/c/']
+
+    # When we clear it (twice).
+    await repo.write_config('transfer.hideRefs', [])
+    await repo.write_config('transfer.hideRefs', [])
+
+    # Then it should be gone.
+    assert (await repo.read_config('transfer.hideRefs')) == []
+
+    # When we set an empty value.
+    await repo.write_config('transfer.hideRefs', [''])
+
+    # Then it should not be mistaken for an unset option.
+    assert (await repo.read_config('transfer.hideRefs')) == ['']
+
+    # And unset options should not be reported as command failures.
+    out, _ = capsys.readouterr()
+    assert out == ''
+
+
+@pytest.mark.asyncio
+async def test_repository_config_invalid_key(storage):
+    repo = await storage.create_repo('foo')
+    with pytest.raises(CalledProcessError):
+        await repo.write_config('invalid', [])
+
+
+@pytest.mark.asyncio
+async def test_touch_ref_state(storage):
+    # Given we have a remote repository.
+    repo = await storage.create_repo('foo')
+    state = repo.ref_state()
+
+    # When a hook signals that refs changed.
+    touch_ref_state(repo.path)
+
+    # Then its ref state should change.
+    assert repo.ref_state() != state
+
+
+@pytest.mark.asyncio
+async def test_check_output_returncodes():
+    output = await check_output(['sh', '-c', 'echo meh; exit 5'],
+                                returncodes=(0, 5))
+    assert output == 'meh'
+    with pytest.raises(CalledProcessError) as error:
+        await check_output(['sh', '-c', 'exit 1'], returncodes=(0, 5))
+    assert error.value.returncode == 1
+
+
+@pytest.mark.asyncio
+async def test_check_output_no_shell():
+    output = await check_output(['echo', 'it\'s "quoted" $HOME'])
+    assert output == 'it\'s "quoted" $HOME'
+
+
+@pytest.mark.asyncio
+async def test_check_output_input():
+    output = await check_output(['cat'], input=b'Hello!')
+    assert output == 'Hello!'
+
+
+@pytest.mark.asyncio
+async def test_check_output_env():
+    output = await check_output(
+        [sys.executable, '-c', 'import os; print(os.environ["FOO"])'],
+        env={'FOO': 'foo'},
+        base_env={'PATH': os.environ['PATH']},
+    )
+    assert output == 'foo'
+
+
+@pytest.mark.asyncio
+async def test_check_output_timeout():
+    with pytest.raises(TimeoutExpired) as exc:
+        await check_output(['sleep', '5'], timeout=0.1)
+    assert exc.value.timeout == 0.1
+
+
+@pytest.mark.asyncio
+async def test_check_output_limit():
+    with pytest.raises(OutputLimitExceeded) as exc:
+        await check_output(
+            [sys.executable, '-c', 'print("x" * 1024)'],
+            limit=100,
+        )
+    assert exc.value.limit == 100
+
+
+@pytest.mark.asyncio
+async def test_stream_output():
+    chunks = []
+    output = stream_output(
+        [sys.executable, '-c', 'import sys; sys.stdout.write("x" * 1024)'],
+        chunk_size=100,
+    )
+    async for chunk in output:
+        chunks.append(chunk)
+    assert b''.join(chunks) == b'x' * 1024
+    assert output.process.returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_output_failure():
+    with pytest.raises(CalledProcessError) as exc:
+        async for _ in stream_output([
+            sys.executable,
+            os.path.join(here, 'exit-failure.py'),
+            '1',
+        ]):
+            pass
+    assert exc.value.returncode == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_output_timeout():
+    output = stream_output(['sleep', '5'], timeout=0.1)
+    with pytest.raises(TimeoutExpired):
+        async for _ in output:
+            pass
+    assert output.process.returncode is not None
+
+
+@pytest.mark.asyncio
+async def test_filesystem_executor(tempdir):
+    clock = mock.MagicMock()
+    clock.return_value = 0.0
+    executor = FileSystemExecutor(max_workers=2, clock=clock)
+    storage = Storage('.', executor=executor)
+
+    # When we go through a few blocking operations.
+    await storage.create_repo('foo')
+    clock.side_effect = [1.0, 1.25]
+    assert (await storage.repository_exists('foo'))
+
+    # Then their latency should be tracked.
+    stats = storage.stats()
+    assert stats['max_workers'] == 2
+    assert sorted(stats['operations']) == [
+        'create', 'exists', 'index', 'stamp', 'template',
+    ]
+    assert stats['operations']['exists'] == {
+        'count': 1,
+        'running': 0,
+        'time_total': 0.25,
+        'time_max': 0.25,
+    }
+
+    # When the storage is closed, the threads come back as needed.
+    storage.close()
+    clock.side_effect = None
+    with pytest.raises(UnknownRepository):
+        await storage.delete_repo('bar')
+    assert storage.stats()['operations']['delete']['count'] == 1
+    storage.close()
+
+
+@pytest.mark.asyncio
+async def test_repository_template(storage):
+    # When we create a few repositories.
+    with mock.patch('gitmesh.storage.check_output',
+                    wraps=check_output) as git:
+        foo, bar = await asyncio.gather(
+            storage.create_repo('foo', install_hooks=True),
+            storage.create_repo('bar', install_hooks=True),
+        )
+        meh = await storage.create_repo('meh')
+
+    # Then `git init` should only run once per template.
+    assert git.call_count == 2
+
+    # And they should be complete repositories.
+    for repo in (foo, bar, meh):
+        output = await repo.run('git rev-parse --is-bare-repository')
+        assert output.strip() == 'true'
+    assert os.readlink(os.path.join(foo.path, 'hooks', 'update')) == \
+        resolve_script('update')
+    assert not os.path.exists(os.path.join(meh.path, 'hooks', 'update'))
+    assert sorted(os.listdir(os.path.join(foo.path, 'refs'))) == [
+        'heads', 'tags',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_repository_template_failure(storage):
+    # Given `git init` fails.
+    with mock.patch('gitmesh.storage.check_output') as git:
+        git.side_effect = CalledProcessError(1, 'git init')
+
+        # When we create a repository.
+        with pytest.raises(CalledProcessError):
+            await storage.create_repo('foo')
+
+    # Then we should try building the template again next time.
+    repo = await storage.create_repo('foo')
+    assert os.path.isfile(os.path.join(repo.path, 'HEAD'))
+
+
+async def _push_commit(workspace, repo, message):
+    clone = workspace.open_repo(repo.name, bare=False)
+    if not os.path.isdir(clone.path):
+        clone = await workspace.clone(repo.path)
+        await clone.run('git config user.name "py.test"')
+        await clone.run('git config user.email "noreply@example.org"')
+    clone.edit('README.txt', message)
+    await clone.run('git add README.txt')
+    await clone.run(['git', 'commit', '-m', message])
+    await clone.run('git push origin master')
+    return await clone.run('git rev-parse HEAD')
+
+
+@pytest.mark.asyncio
+async def test_fork_repository(storage, workspace):
+    # Given a repository with some history.
+    foo = await storage.create_repo('foo')
+    commit = await _push_commit(workspace, foo, 'First commit.')
+
+    # When we fork it.
+    bar = await storage.fork_repo('foo', 'bar')
+
+    # Then the fork should have the same refs, but borrow the objects.
+    assert (await bar.run('git rev-parse master')) == commit
+    assert bar.parent == 'foo'
+    assert foo.forks == ['bar']
+    assert readfile(os.path.join(bar.path, 'objects', 'info',
+                                 'alternates')).strip() == \
+        os.path.abspath(os.path.join(foo.path, 'objects'))
+    assert os.listdir(os.path.join(bar.path, 'objects', 'pack')) == []
+    await bar.run('git fsck --connectivity-only')
+
+    # And maintenance should keep it that way.
+    assert bar.repack_options() == ['--local']
+    assert foo.repack_options() == ['--keep-unreachable']
+    assert (await foo.read_config('gc.pruneExpire')) == ['never']
+
+    # When the parent is deleted.
+    await storage.delete_repo('foo')
+
+    # Then the fork should have its own copy of the objects.
+    assert bar.parent is None
+    assert bar.repack_options() == []
+    assert not os.path.exists(os.path.join(bar.path, 'objects', 'info',
+                                           'alternates'))
+    await bar.run('git fsck --connectivity-only')
+    assert (await bar.run('git rev-parse master')) == commit
+
+    # And it should no longer be a fork.
+    assert not (await storage.detach_repo('bar'))
+
+
+@pytest.mark.asyncio
+async def test_fork_repository_errors(storage):
+    # Given a repository and its fork.
+    await storage.create_repo('foo')
+    await storage.fork_repo('foo', 'bar')
+
+    # Then we can't fork unknown repositories or overwrite existing ones.
+    with pytest.raises(UnknownRepository):
+        await storage.fork_repo('meh', 'qux')
+    with pytest.raises(RepositoryExists):
+        await storage.fork_repo('foo', 'bar')
+
+    # When the fork is deleted.
+    await storage.delete_repo('bar')
+
+    # Then the parent should forget about it.
+    assert storage.open_repo('foo').forks == []
+    await storage.delete_repo('foo')
+
+
+@pytest.mark.asyncio
+async def test_fork_repository_concurrent(storage):
+    # Given a repository.
+    await storage.create_repo('foo')
+
+    # When it's forked many times at once.
+    names = ['fork-%d' % i for i in range(8)]
+    await asyncio.gather(*[storage.fork_repo('foo', name) for name in names])
+
+    # Then the parent should know about all its forks.
+    assert sorted(storage.open_repo('foo').forks) == names
+
+    # When one of them is deleted and forked again.
+    await storage.delete_repo('fork-0')
+    await storage.fork_repo('foo', 'fork-0')
+
+    # Then it should only be listed once.
+    assert sorted(storage.open_repo('foo').forks) == names
+
+    # And invalid names should be rejected up front.
+    with pytest.raises(InvalidRepositoryName):
+        await storage.fork_repo('foo', '.bar')
+
+
+@pytest.mark.asyncio
+async def test_fork_repository_failure(storage):
+    # Given a repository.
+    await storage.create_repo('foo')
+
+    # When forking it fails once the refs are copied.
+    with mock.patch.object(storage, 'adopt_repo',
+                           side_effect=OSError('No space left')):
+        with pytest.raises(OSError):
+            await storage.fork_repo('foo', 'bar')
+
+    # Then the fork shouldn't exist, nor be half made.
+    assert not (await storage.repository_exists('bar'))
+    assert (await storage.list_repositories()) == ['foo']
+    assert storage.open_repo('foo').forks == []
+    assert os.listdir(os.path.join(storage.path, FORKS_DIR)) == []
+    assert len(os.listdir(storage.trash_path)) == 1
+
+    # And detaching it should fail like for any unknown repository.
+    with pytest.raises(UnknownRepository):
+        await storage.detach_repo('bar')
+
+
+@pytest.mark.asyncio
+async def test_fork_repository_migrate(storage, workspace):
+    # Given a fork, in the flat layout.
+    foo = await storage.create_repo('foo')
+    commit = await _push_commit(workspace, foo, 'First commit.')
+    await storage.fork_repo('foo', 'bar')
+
+    # When we migrate to the sharded layout.
+    assert sorted(storage.migrate('sharded')) == ['bar', 'foo']
+
+    # Then the fork should still find its objects.
+    bar = storage.open_repo('bar')
+    assert bar.path == os.path.join(storage.path, shard('bar'), 'bar.git')
+    await bar.run('git fsck --connectivity-only')
+    assert (await bar.run('git rev-parse master^{tree}'))
+    assert (await bar.run('git rev-parse master')) == commit
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import pytest
+
+from gitmesh.trash import Reaper
+from unittest import mock
+
+
+@pytest.mark.asyncio
+async def test_delete_moves_to_trash(storage):
+    reaper = Reaper(storage, log=mock.MagicMock())
+
+    # Given a repository.
+    repo = await storage.create_repo('foo')
+
+    # When we delete it.
+    await storage.delete_repo('foo')
+
+    # Then it should be in the trash, waiting to be reaped.
+    assert not os.path.exists(repo.path)
+    assert not (await storage.repository_exists('foo'))
+    pending = await reaper.pending()
+    assert len(pending) == 1
+    assert pending[0].endswith('-foo.git')
+    assert os.path.isdir(os.path.join(storage.trash_path, pending[0], 'refs'))
+
+    # And we should be able to create it again right away.
+    await storage.create_repo('foo')
+    await storage.delete_repo('foo')
+    assert len(await reaper.pending()) == 2
+
+    # When the reaper runs.
+    await reaper.reap()
+
+    # Then the trash should be empty.
+    assert (await reaper.pending()) == []
+    assert os.listdir(storage.trash_path) == []
+    assert (await reaper.stats())['reaped'] == 2
+    assert (await reaper.stats())['reaped_bytes'] > 0
+
+
+@pytest.mark.asyncio
+async def test_reaper_resumes_leftovers(storage):
+    # Given trash left over by a previous run (e.g. a crash).
+    os.makedirs(os.path.join(storage.trash_path, 'abc-foo.git', 'objects'))
+    with open(os.path.join(storage.trash_path, 'abc-foo.git', 'HEAD'),
+              'w') as stream:
+        stream.write('ref: refs/heads/master\n')
+    os.symlink('HEAD', os.path.join(storage.trash_path, 'abc-foo.git', 'a'))
+    os.symlink('objects', os.path.join(storage.trash_path, 'abc-foo.git', 'b'))
+    with open(os.path.join(storage.trash_path, 'abc-bar.tmp'), 'w') as stream:
+        stream.write('...')
+
+    # When the reaper starts.
+    reaper = Reaper(storage, log=mock.MagicMock())
+    task = asyncio.ensure_future(reaper.run())
+    try:
+        while await reaper.pending():
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        await asyncio.wait([task])
+
+    # Then the trash should be emptied.
+    assert (await reaper.stats())['reaped'] == 2
+
+
+@pytest.mark.asyncio
+async def test_reaper_wake(storage):
+    reaper = Reaper(storage, log=mock.MagicMock())
+    assert (await reaper.pending()) == []
+
+    # Given the reaper is running with nothing to do.
+    task = asyncio.ensure_future(reaper.run())
+    try:
+        await asyncio.sleep(0.01)
+
+        # When a repository is deleted.
+        await storage.create_repo('foo')
+        await storage.delete_repo('foo')
+        reaper.wake()
+
+        # Then it should be reaped.
+        while await reaper.pending():
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        await asyncio.wait([task])
+    assert (await reaper.stats())['reaped'] == 1
+
+
+@pytest.mark.asyncio
+async def test_reaper_rate(storage):
+    clock = mock.MagicMock()
+    clock.side_effect = [0.0, 0.0, 0.0, 5.0, 5.0]
+    reaper = Reaper(storage, rate=1024, log=mock.MagicMock(), clock=clock)
+
+    # Given a few files in the trash.
+    path = os.path.join(storage.trash_path, 'abc-foo.git')
+    os.makedirs(path)
+    for name in ('a', 'b'):
+        with open(os.path.join(path, name), 'wb') as stream:
+            stream.write(b'.' * 512)
+
+    # When we reap them (and the disk is fast, then slow).
+    with mock.patch.object(reaper._stop, 'wait') as wait:
+        await reaper.reap()
+
+    # Then we should have waited only when over the rate.
+    wait.assert_called_once_with(0.5)
+    assert (await reaper.pending()) == []
+
+
+@pytest.mark.asyncio
+async def test_reaper_close(storage):
+    reaper = Reaper(storage, log=mock.MagicMock())
+
+    # Given a repository in the trash.
+    await storage.create_repo('foo')
+    await storage.delete_repo('foo')
+
+    # When the reaper is interrupted.
+    reaper.close()
+    await reaper.reap()
+
+    # Then the rest should be left for next time.
+    assert len(await reaper.pending()) == 1
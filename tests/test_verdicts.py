@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import pytest
+
+from gitmesh.storage import check_output
+from gitmesh.verdicts import (
+    discard_verdicts,
+    prune_verdicts,
+    VERDICTS_DIR,
+    verdicts_path,
+    write_verdicts,
+)
+from subprocess import CalledProcessError
+
+
+UPDATE_HOOK = os.path.join(os.path.dirname(__file__), '..', 'bin', 'update')
+
+
+@pytest.mark.parametrize('push_id,path', [
+    ('123', os.path.join('.', VERDICTS_DIR, '123')),
+    ('', None),
+    (None, None),
+    ('../123', None),
+])
+def test_verdicts_path(push_id, path):
+    assert verdicts_path('.', push_id) == path
+
+
+@pytest.mark.asyncio
+async def test_update_hook(tempdir):
+    # Given the pre-receive hook decided on each ref.
+    path = verdicts_path('.', str(os.getpid()))
+    write_verdicts(path, [
+        ('refs/heads/master', 'a', 'b', True),
+        ('refs/heads/topic', 'c', 'd', False),
+    ])
+    with open(path, 'r') as stream:
+        assert stream.read() == (
+            'accept a b refs/heads/master\n'
+            'reject c d refs/heads/topic\n'
+        )
+
+    # When Git runs the update hook for each ref.
+    output = await check_output(
+        ['sh', UPDATE_HOOK, 'refs/heads/master', 'a', 'b'],
+    )
+    assert output == ''
+    with pytest.raises(CalledProcessError) as error:
+        await check_output(['sh', UPDATE_HOOK, 'refs/heads/topic', 'c', 'd'])
+
+    # Then it should follow these verdicts.
+    assert error.value.returncode == 1
+    assert error.value.output == \
+        'Update of refs/heads/topic rejected by plug-ins.'
+
+    # When the push is done.
+    discard_verdicts(path)
+    discard_verdicts(path)
+
+    # Then the verdicts should be gone.
+    assert os.listdir(VERDICTS_DIR) == []
+
+
+def test_prune_verdicts(tempdir):
+    # Nothing to do until a push leaves verdicts.
+    prune_verdicts('.')
+
+    # Given verdicts left by pushes, including one that didn't complete.
+    write_verdicts(verdicts_path('.', '1'), [])
+    write_verdicts(verdicts_path('.', '2'), [])
+    os.utime(verdicts_path('.', '1'), (1000.0, 1000.0))
+    os.utime(verdicts_path('.', '2'), (5000.0, 5000.0))
+
+    # When we prune old verdicts.
+    prune_verdicts('.', max_age=3600.0, clock=lambda: 5000.0)
+
+    # Then only recent ones should be kept.
+    assert os.listdir(VERDICTS_DIR) == ['2']
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import os
+import pytest
+import sys
+
+from gitmesh.storage import start_process
+from gitmesh.workqueue import (
+    coalesce,
+    connect,
+    enqueue,
+    QUEUE_VAR,
+    REPLAY_VAR,
+    REPOSITORY_VAR,
+    run_hook_process,
+    WorkQueue,
+)
+from unittest import mock
+
+
+class Runner(object):
+    """Fake ``HookDaemon.run()``."""
+
+    def __init__(self, status=0, error=None):
+        self.calls = []
+        self.status = status
+        self.error = error
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, argv, env, cwd, stdin):
+        self.calls.append((argv, env, cwd, stdin.decode('utf-8')))
+        await self.release.wait()
+        if self.error:
+            raise self.error
+        return b'Boom.\n', self.status
+
+
+@pytest.mark.parametrize('batches,updates', [
+    ([{'master': ('a', 'b')}], {'master': ('a', 'b')}),
+    ([{'master': ('a', 'b')}, {'master': ('b', 'c')}], {'master': ('a', 'c')}),
+    ([{'master': ('a', 'b')}, {'topic': ('0', 'c')}], {
+        'master': ('a', 'b'),
+        'topic': ('0', 'c'),
+    }),
+    ([{'topic': ('0', 'a')}, {'topic': ('a', '0')}], {}),
+])
+def test_coalesce(batches, updates):
+    assert coalesce(batches) == updates
+
+
+@pytest.mark.asyncio
+async def test_work_queue(storage):
+    runner = Runner()
+    queue = WorkQueue(storage, runner=runner, log=mock.MagicMock())
+    repo = await storage.create_repo('foo')
+
+    # Given a few pushes, including to a repository that's gone.
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('a', 'b')}, 'r1')
+    enqueue(queue.path, 'bar', {'refs/heads/master': ('a', 'b')}, 'r2')
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('b', 'c')}, 'r3')
+    enqueue(queue.path, 'foo', {'refs/heads/topic': ('0', 'd')})
+    assert (await queue.stats()) == {
+        'pending': 4,
+        'running': 0,
+        'done': 0,
+        'retried': 0,
+        'failed': 0,
+    }
+
+    # When the queue is processed.
+    assert (await queue.dispatch()) == 5.0
+    assert (await queue.stats())['running'] == 2
+    await queue.wait()
+
+    # Then plug-ins should run once for each repository that still exists.
+    assert runner.calls == [(
+        ['post-receive'],
+        mock.ANY,
+        repo.path,
+        'a c refs/heads/master\n0 d refs/heads/topic\n',
+    )]
+    env = runner.calls[0][1]
+    assert env['GIT_DIR'] == repo.path
+    assert env[REPOSITORY_VAR] == 'foo'
+    assert env[REPLAY_VAR] == '1'
+    assert env['GITMESH_REQUEST_ID'] == 'r1,r3'
+    assert QUEUE_VAR not in env
+    assert (await queue.counts()) == {}
+    assert (await queue.stats())['done'] == 2
+
+
+@pytest.mark.asyncio
+async def test_work_queue_order(storage):
+    runner = Runner()
+    queue = WorkQueue(storage, runner=runner, log=mock.MagicMock())
+    await storage.create_repo('foo')
+    task = asyncio.ensure_future(queue.run())
+    try:
+        # Given plug-ins are running for a push.
+        runner.release.clear()
+        enqueue(queue.path, 'foo', {'refs/heads/master': ('a', 'b')})
+        queue.notify_push('foo')
+        while not runner.calls:
+            await asyncio.sleep(0.01)
+
+        # When the repository is pushed to again, twice.
+        enqueue(queue.path, 'foo', {'refs/heads/master': ('b', 'c')})
+        enqueue(queue.path, 'foo', {'refs/heads/master': ('c', 'd')})
+        queue.notify_push('foo')
+        await asyncio.sleep(0.05)
+        assert len(runner.calls) == 1
+
+        # Then plug-ins should run again once done, for both pushes at once.
+        runner.release.set()
+        while len(runner.calls) < 2:
+            await asyncio.sleep(0.01)
+        await queue.wait()
+        assert [call[3] for call in runner.calls] == [
+            'a b refs/heads/master\n',
+            'b d refs/heads/master\n',
+        ]
+        assert (await queue.stats())['done'] == 2
+    finally:
+        task.cancel()
+        await asyncio.wait([task])
+        await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_work_queue_retry(storage):
+    now = [1000.0]
+    runner = Runner(status=1)
+    queue = WorkQueue(storage, runner=runner, max_attempts=2,
+                      retry_delay=2.0, log=mock.MagicMock(),
+                      clock=lambda: now[0])
+    await storage.create_repo('foo')
+
+    # Given plug-ins fail.
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('a', 'b')})
+    await queue.dispatch()
+    await queue.wait()
+    assert (await queue.stats())['retried'] == 1
+
+    # When we look again, it shouldn't be retried too soon.
+    assert (await queue.dispatch()) == 2.0
+    assert len(runner.calls) == 1
+
+    # Then it should be retried later, until we give up.
+    now[0] += 2.0
+    await queue.dispatch()
+    await queue.wait()
+    assert len(runner.calls) == 2
+    assert (await queue.counts()) == {'failed': 1}
+    assert (await queue.stats())['failed'] == 1
+
+
+@pytest.mark.asyncio
+async def test_work_queue_retry_coalesced(storage):
+    runner = Runner(status=1)
+    queue = WorkQueue(storage, runner=runner, max_attempts=3,
+                      log=mock.MagicMock())
+    await storage.create_repo('foo')
+
+    # Given a push that already failed twice, behind a fresh one.
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('a', 'b')})
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('b', 'c')})
+    db = connect(queue.path)
+    try:
+        db.execute('UPDATE jobs SET attempts = 2 WHERE id = 2')
+    finally:
+        db.close()
+
+    # When they run together, and fail.
+    await queue.dispatch()
+    await queue.wait()
+
+    # Then we should give up, as we would have for the older push.
+    assert len(runner.calls) == 1
+    assert (await queue.counts()) == {'failed': 1}
+
+
+@pytest.mark.asyncio
+async def test_work_queue_error(storage):
+    log = mock.MagicMock()
+    queue = WorkQueue(storage, runner=Runner(error=OSError('Nope.')), log=log)
+    await storage.create_repo('foo')
+
+    # When plug-ins can't run.
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('a', 'b')})
+    await queue.dispatch()
+    await queue.wait()
+
+    # Then it should be retried.
+    assert (await queue.counts()) == {'pending': 1}
+    log.info.assert_called_with('queue.retry', job=1, repo='foo',
+                                duration=mock.ANY, error='OSError: Nope.')
+
+
+@pytest.mark.asyncio
+async def test_work_queue_close(storage):
+    runner = Runner()
+    runner.release.clear()
+    queue = WorkQueue(storage, runner=runner, log=mock.MagicMock())
+    await storage.create_repo('foo')
+
+    # Given plug-ins are running.
+    enqueue(queue.path, 'foo', {'refs/heads/master': ('a', 'b')})
+    await queue.dispatch()
+    await asyncio.sleep(0.01)
+
+    # When the server shuts down.
+    await queue.close()
+
+    # Then the job should run again on next start.
+    assert (await queue.counts()) == {'pending': 1}
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_run_hook_process(workspace):
+    repo = await workspace.create_repo('foo')
+
+    # When we run a hook in a new process.
+    output, status = await run_hook_process(
+        ['post-receive'], dict(os.environ), repo.path, b'a b c\n',
+    )
+
+    # Then we should get its output.
+    assert status == 0
+    assert b'git.hooks.post-receive' in output
+
+
+@pytest.mark.asyncio
+async def test_run_hook_process_cancel(workspace):
+
+    async def slow_hook(*args, **kwds):
+        return await start_process(['sleep', '10'])
+
+    # Given a hook is running.
+    with mock.patch('gitmesh.workqueue.start_process') as hook:
+        hook.side_effect = slow_hook
+        task = asyncio.ensure_future(run_hook_process(
+            ['post-receive'], {}, workspace.path, b'',
+        ))
+        await asyncio.sleep(0.1)
+
+        # When we give up on it.
+        task.cancel()
+
+        # Then it should stop right away.
+        await asyncio.wait_for(asyncio.wait([task]), 1.0)
+    assert task.cancelled()
+    hook.assert_called_once_with(
+        [sys.executable, '-m', 'gitmesh', 'post-receive'],
+        cwd=workspace.path, env={}, base_env={},
+    )